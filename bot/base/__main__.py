@@ -7,18 +7,26 @@ import logging
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram_dialog import setup_dialogs
 
 from bot.base.config_reader import config, get_bot_token_str
 from bot.base.db_middleware import build_session_maker, DbSessionMiddleware
+from bot.base.metrics import observe_caches
+from bot.base.metrics_server import MetricsServer
+from bot.base.query_stats import QueryStatsMiddleware
+from bot.base.update_metrics import UpdateMetricsMiddleware, dialog_state_middleware
+from bot.base.storage import build_storage, build_events_isolation
+from bot.base.webhook import get_webhook_url, get_webhook_secret, serve_webhook, run_webhook_workers, worker_index
+from bot.db.invalidation import InvalidationListener
+from bot.db.popular_systems import popular_systems_cache
+from bot.db.requests import game_candidates_cache
 
 # --- handlers / routers ---
 try:
     from bot.handlers.default_commands import router as default_commands_router  # type: ignore
 except Exception:
     default_commands_router = None
-from bot.handlers.default_commands import set_main_menu
+from bot.handlers.default_commands import set_main_menu, KNOWN_COMMANDS
 
 # --- dialogs (каждый Dialog — это Router) ---
 from bot.dialogs.registration.registration import registration_dialog
@@ -32,19 +40,60 @@ from bot.dialogs.games.game_inspection import game_inspection_dialog
 from bot.dialogs.games.searching_game import searching_game_dialog
 
 
-async def main() -> None:
-    logging.basicConfig(level=logging.INFO)
-
-    # Бот и диспетчер
-    bot = Bot(
+def build_bot() -> Bot:
+    return Bot(
         token=get_bot_token_str(),
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
-    dp = Dispatcher(storage=MemoryStorage())
+
+
+def build_dispatcher() -> Dispatcher:
+    storage = build_storage(config)
+    # Одна изоляция на диспетчер и aiogram-dialog: при FSM_STORAGE=redis — блокировки в Redis
+    events_isolation = build_events_isolation(storage)
+    dp = Dispatcher(storage=storage, events_isolation=events_isolation)
+
+    # Попадания и промахи кэшей в памяти процесса — в метрики trg_cache_*
+    observe_caches()
 
     # БД: engine + sessionmaker + middleware (кладёт AsyncSession в data['db_session'])
-    engine, session_maker = build_session_maker(config.postgres_dsn, echo=False)
+    engine, session_maker = build_session_maker(
+        config.postgres_dsn,
+        echo=False,
+        pool_size=config.db_pool_size,
+        max_overflow=config.db_max_overflow,
+        pool_timeout=config.db_pool_timeout,
+        pool_recycle=config.db_pool_recycle,
+        pool_pre_ping=config.db_pool_pre_ping,
+        statement_cache_size=config.db_statement_cache_size,
+        slow_query_log=config.slow_query_log or None,
+        slow_query_threshold=config.slow_query_threshold_ms / 1000,
+        slow_query_explain_rate=config.slow_query_explain_rate,
+    )
+    # Задержка и ошибки апдейтов (внешний middleware — в замер попадает всё остальное).
+    # Счётчик SQL на апдейт оборачивает DbSessionMiddleware; состояние диалога
+    # известно только на уровне сообщений и колбэков
+    dp.update.outer_middleware(UpdateMetricsMiddleware(KNOWN_COMMANDS))
+    dp.update.middleware(QueryStatsMiddleware(config.db_query_budget, config.db_query_repeat_budget))
     dp.update.middleware(DbSessionMiddleware(session_maker))
+    dp.message.middleware(dialog_state_middleware)
+    dp.callback_query.middleware(dialog_state_middleware)
+
+    # Популярные системы для форм обновляются в фоне, геттеры читают их из памяти.
+    # Кэши воркера сбрасываются по уведомлениям о записях других воркеров (только PostgreSQL).
+    listener = InvalidationListener(config.postgres_dsn) if engine.dialect.name == "postgresql" else None
+    metrics_server = MetricsServer(config.metrics_host, config.metrics_port + worker_index()) \
+        if config.metrics_port else None
+
+    async def start_background_tasks() -> None:
+        popular_systems_cache.start(session_maker)
+        game_candidates_cache.start(session_maker)
+        if listener is not None:
+            listener.start()
+        if metrics_server is not None:
+            await metrics_server.start()
+
+    dp.startup.register(start_background_tasks)
 
     # Роутеры с командами/хэндлерами
     if default_commands_router is not None:
@@ -62,20 +111,63 @@ async def main() -> None:
     dp.include_router(searching_game_dialog)
 
     # Инициализация aiogram-dialog
-    setup_dialogs(dp)
+    setup_dialogs(dp, events_isolation=events_isolation)
+
+    async def close_resources() -> None:
+        await popular_systems_cache.stop()
+        await game_candidates_cache.stop()
+        if listener is not None:
+            await listener.stop()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        await dp.storage.close()
+        await events_isolation.close()
+        await engine.dispose()
+
+    dp.shutdown.register(close_resources)
+    return dp
+
 
+async def prepare_bot(bot: Bot) -> None:
     # Меню команд
     try:
         await set_main_menu(bot)
     except Exception as e:
         logging.warning("Failed to set main menu: %s", e)
 
-    # Старт
+
+async def run_polling() -> None:
+    bot = build_bot()
+    dp = build_dispatcher()
+    await prepare_bot(bot)
+    await dp.start_polling(bot)
+
+
+async def register_webhook() -> None:
+    # Диспетчер здесь не создаётся: роутеры диалогов — синглтоны модулей,
+    # и каждый воркер подключает их к своему диспетчеру сам.
+    bot = build_bot()
     try:
-        await dp.start_polling(bot)
+        await prepare_bot(bot)
+        await bot.set_webhook(get_webhook_url(config), secret_token=get_webhook_secret(config))
     finally:
-        await engine.dispose()
+        await bot.session.close()
+
+
+def webhook_worker() -> None:
+    logging.basicConfig(level=logging.INFO)
+    serve_webhook(build_dispatcher(), build_bot(), config)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+
+    if config.run_mode == "webhook":
+        asyncio.run(register_webhook())
+        run_webhook_workers(webhook_worker, config.webhook_workers)
+    else:
+        asyncio.run(run_polling())
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
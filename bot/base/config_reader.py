@@ -2,9 +2,9 @@
 from __future__ import annotations
 
 from pathlib import Path
-from typing import Optional
+from typing import Literal, Optional
 
-from pydantic import Field, SecretStr
+from pydantic import Field, SecretStr, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -36,7 +36,13 @@ class TelegramConfig(BaseSettings):
     """
     Environment-driven configuration (Pydantic v2).
     - BOT_TOKEN is read from env or the chosen .env file.
-    - POSTGRES_DSN likewise.
+    - POSTGRES_DSN likewise; DB_POOL_* tune its connection pool,
+      DB_QUERY_BUDGET / DB_QUERY_REPEAT_BUDGET the per-update SQL warning,
+      SLOW_QUERY_* the opt-in slow-query log.
+    - FSM_STORAGE selects where FSM/dialog state lives: "memory" or "redis" (REDIS_DSN).
+    - RUN_MODE selects "polling" or "webhook" (WEBHOOK_* settings, WEBHOOK_WORKERS processes).
+      Several webhook workers need FSM_STORAGE=redis: dialog state and locks must be shared.
+    - METRICS_HOST / METRICS_PORT expose Prometheus metrics on /metrics.
     """
     # Point pydantic-settings to the chosen .env (or None -> only OS env)
     model_config = SettingsConfigDict(
@@ -48,6 +54,48 @@ class TelegramConfig(BaseSettings):
     bot_token: SecretStr = Field(validation_alias="BOT_TOKEN")
     postgres_dsn: str = Field(default="", validation_alias="POSTGRES_DSN")
 
+    # Пул соединений с БД
+    db_pool_size: int = Field(default=10, ge=1, validation_alias="DB_POOL_SIZE")
+    db_max_overflow: int = Field(default=20, ge=0, validation_alias="DB_MAX_OVERFLOW")
+    db_pool_timeout: float = Field(default=30.0, gt=0, validation_alias="DB_POOL_TIMEOUT")
+    db_pool_recycle: int = Field(default=1800, validation_alias="DB_POOL_RECYCLE")
+    db_pool_pre_ping: bool = Field(default=True, validation_alias="DB_POOL_PRE_PING")
+    db_statement_cache_size: Optional[int] = Field(default=None, ge=0, validation_alias="DB_STATEMENT_CACHE_SIZE")
+    # Бюджет SQL на апдейт: больше запросов или повторов одного запроса — предупреждение в лог
+    db_query_budget: int = Field(default=20, ge=1, validation_alias="DB_QUERY_BUDGET")
+    db_query_repeat_budget: int = Field(default=5, ge=1, validation_alias="DB_QUERY_REPEAT_BUDGET")
+    # Журнал медленных запросов (JSONL с ротацией); пустой путь — выключен
+    slow_query_log: str = Field(default="", validation_alias="SLOW_QUERY_LOG")
+    slow_query_threshold_ms: float = Field(default=200.0, ge=0, validation_alias="SLOW_QUERY_THRESHOLD_MS")
+    slow_query_explain_rate: float = Field(default=0.1, ge=0, le=1, validation_alias="SLOW_QUERY_EXPLAIN_RATE")
+
+    # FSM / aiogram-dialog storage
+    fsm_storage: Literal["memory", "redis"] = Field(default="memory", validation_alias="FSM_STORAGE")
+    redis_dsn: str = Field(default="redis://localhost:6379/0", validation_alias="REDIS_DSN")
+    fsm_state_ttl: Optional[int] = Field(default=7 * 24 * 3600, validation_alias="FSM_STATE_TTL")
+    fsm_data_ttl: Optional[int] = Field(default=7 * 24 * 3600, validation_alias="FSM_DATA_TTL")
+
+    # Получение апдейтов: long polling или webhook с несколькими процессами-воркерами
+    run_mode: Literal["polling", "webhook"] = Field(default="polling", validation_alias="RUN_MODE")
+    webhook_base_url: str = Field(default="", validation_alias="WEBHOOK_BASE_URL")
+    webhook_path: str = Field(default="/webhook", validation_alias="WEBHOOK_PATH")
+    webhook_secret: Optional[SecretStr] = Field(default=None, validation_alias="WEBHOOK_SECRET")
+    webhook_host: str = Field(default="0.0.0.0", validation_alias="WEBHOOK_HOST")
+    webhook_port: int = Field(default=8080, validation_alias="WEBHOOK_PORT")
+    webhook_workers: int = Field(default=1, ge=1, validation_alias="WEBHOOK_WORKERS")
+
+    # Prometheus: /metrics на METRICS_HOST:METRICS_PORT (воркер webhook номер i — на METRICS_PORT + i), 0 — выключено
+    metrics_host: str = Field(default="127.0.0.1", validation_alias="METRICS_HOST")
+    metrics_port: int = Field(default=9108, ge=0, validation_alias="METRICS_PORT")
+
+    @model_validator(mode="after")
+    def _check_workers_storage(self) -> "TelegramConfig":
+        # Апдейты одного пользователя попадают в разные процессы: стек диалога в памяти
+        # одного воркера другому не виден, блокировки тоже
+        if self.run_mode == "webhook" and self.webhook_workers > 1 and self.fsm_storage == "memory":
+            raise ValueError("WEBHOOK_WORKERS > 1 requires FSM_STORAGE=redis")
+        return self
+
 
 # Single, ready-to-use instance
 config = TelegramConfig()
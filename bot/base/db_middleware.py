@@ -1,15 +1,24 @@
 # bot/base/db_middleware.py
 from __future__ import annotations
 
-from typing import Optional, Callable, Awaitable, Any
+import time
+from typing import Optional, Callable, Awaitable, Any, Dict
 
 from aiogram import BaseMiddleware
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import (
     AsyncEngine,
     AsyncSession,
     create_async_engine,
     async_sessionmaker,
 )
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from bot.base.metrics import DB_POOL_SIZE, DB_POOL_CHECKED_OUT, DB_POOL_OVERFLOW, DB_POOL_WAIT_SECONDS, \
+    DB_UPDATE_SESSIONS
+from bot.base.query_stats import instrument_queries
+from bot.base.slow_queries import SlowQueryLog
+from bot.db.lazy_session import LazySession
 
 
 def normalize_async_dsn(dsn: str) -> str:
@@ -29,17 +38,96 @@ def normalize_async_dsn(dsn: str) -> str:
     return dsn
 
 
-def build_session_maker(dsn: str, echo: bool = False) -> tuple[AsyncEngine, async_sessionmaker[AsyncSession]]:
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений, замеряющий время получения соединения
+    (ожидание свободного соединения или открытие нового).
+    """
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def _pool_kwargs(
+        dsn: str,
+        pool_size: int,
+        max_overflow: int,
+        pool_timeout: float,
+        pool_recycle: int,
+        pool_pre_ping: bool,
+        statement_cache_size: Optional[int],
+) -> Dict[str, Any]:
+    url = make_url(dsn)
+    # in-memory SQLite (тесты) живёт на одном соединении, настраивать там нечего
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}
+
+    kwargs: Dict[str, Any] = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pool_pre_ping,
+    }
+    if url.get_driver_name() == "asyncpg" and statement_cache_size is not None:
+        # 0 отключает кэш подготовленных запросов (нужно за pgbouncer в transaction mode)
+        kwargs["connect_args"] = {
+            "statement_cache_size": statement_cache_size,
+            "prepared_statement_cache_size": statement_cache_size,
+        }
+    return kwargs
+
+
+def instrument_pool(engine: AsyncEngine) -> None:
+    """Привязывает метрики пула к engine; значения читаются в момент сбора метрик."""
+    pool = engine.pool
+    if not isinstance(pool, AsyncAdaptedQueuePool):
+        return
+    DB_POOL_SIZE.set(pool.size())
+    DB_POOL_CHECKED_OUT.set_function(pool.checkedout)
+    DB_POOL_OVERFLOW.set_function(lambda: max(pool.overflow(), 0))
+
+
+def build_session_maker(
+        dsn: str,
+        echo: bool = False,
+        *,
+        pool_size: int = 10,
+        max_overflow: int = 20,
+        pool_timeout: float = 30.0,
+        pool_recycle: int = 1800,
+        pool_pre_ping: bool = True,
+        statement_cache_size: Optional[int] = None,
+        slow_query_log: Optional[str] = None,
+        slow_query_threshold: float = 0.2,
+        slow_query_explain_rate: float = 0.1,
+) -> tuple[AsyncEngine, async_sessionmaker[AsyncSession]]:
     dsn_async = normalize_async_dsn(dsn)
-    engine = create_async_engine(dsn_async, echo=echo, future=True)
+    engine = create_async_engine(
+        dsn_async,
+        echo=echo,
+        future=True,
+        **_pool_kwargs(dsn_async, pool_size, max_overflow, pool_timeout,
+                       pool_recycle, pool_pre_ping, statement_cache_size),
+    )
+    instrument_pool(engine)
+    instrument_queries(engine)
+    if slow_query_log:
+        SlowQueryLog(slow_query_log, slow_query_threshold, slow_query_explain_rate).attach(engine)
     maker = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
     return engine, maker
 
 
 class DbSessionMiddleware(BaseMiddleware):
     """
-    Кладёт AsyncSession в data['db_session'] для каждого апдейта.
+    Кладёт LazySession в data['db_session'] для каждого апдейта.
     aiogram-dialog перенесёт это в dialog_manager.middleware_data['db_session'].
+    Доля апдейтов, обошедшихся без БД, видна в метрике trg_db_update_sessions_total.
     """
 
     def __init__(self, session_maker: async_sessionmaker[AsyncSession]):
@@ -52,6 +140,10 @@ class DbSessionMiddleware(BaseMiddleware):
         event: Any,
         data: dict
     ) -> Any:
-        async with self._session_maker() as session:
-            data["db_session"] = session
+        session = LazySession(self._session_maker)
+        data["db_session"] = session
+        try:
             return await handler(event, data)
+        finally:
+            await session.close()
+            DB_UPDATE_SESSIONS.labels(used="true" if session.touched else "false").inc()
@@ -0,0 +1,82 @@
+# bot/base/metrics.py
+from __future__ import annotations
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from bot.db.cache import CacheStats, set_cache_stats
+
+# --- пул соединений с БД ---
+DB_POOL_SIZE = Gauge("trg_db_pool_size", "Configured size of the DB connection pool")
+DB_POOL_CHECKED_OUT = Gauge("trg_db_pool_checked_out", "DB connections currently checked out of the pool")
+DB_POOL_OVERFLOW = Gauge("trg_db_pool_overflow", "DB connections opened above pool_size")
+DB_POOL_WAIT_SECONDS = Histogram(
+    "trg_db_pool_wait_seconds",
+    "Time spent acquiring a DB connection from the pool",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+# --- кэши в памяти процесса ---
+CACHE_HITS = Counter("trg_cache_hits_total", "Lookups served from an in-process cache", ["cache"])
+CACHE_MISSES = Counter("trg_cache_misses_total", "Lookups that went past an in-process cache", ["cache"])
+CACHE_EVICTIONS = Counter("trg_cache_evictions_total", "Entries dropped from an in-process cache", ["cache", "reason"])
+CACHE_SIZE = Gauge("trg_cache_size", "Entries currently held by an in-process cache", ["cache"])
+
+
+class _PrometheusCacheStats(CacheStats):
+    def hit(self, cache: str) -> None:
+        CACHE_HITS.labels(cache).inc()
+
+    def miss(self, cache: str) -> None:
+        CACHE_MISSES.labels(cache).inc()
+
+    def evicted(self, cache: str, reason: str) -> None:
+        CACHE_EVICTIONS.labels(cache, reason).inc()
+
+    def size(self, cache: str, size: int) -> None:
+        CACHE_SIZE.labels(cache).set(size)
+
+
+def observe_caches() -> None:
+    """Считать попадания и вытеснения всех TTLCache (bot.db.cache) в метриках trg_cache_*."""
+    set_cache_stats(_PrometheusCacheStats())
+
+# --- SQL на один апдейт (bot.base.query_stats) ---
+DB_UPDATE_STATEMENTS = Histogram(
+    "trg_db_update_statements",
+    "SQL statements executed while handling one update",
+    ["state"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89),
+)
+DB_UPDATE_SECONDS = Histogram(
+    "trg_db_update_seconds",
+    "Time spent in SQL statements while handling one update",
+    ["state"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+DB_UPDATE_REPEATED_STATEMENTS = Counter(
+    "trg_db_update_repeated_statements_total",
+    "SQL statements that repeated an identical statement of the same update (N+1 candidates)",
+    ["state"],
+)
+DB_UPDATE_OVER_BUDGET = Counter(
+    "trg_db_update_over_budget_total", "Updates that exceeded the SQL statement budget", ["state"]
+)
+DB_UPDATE_SESSIONS = Counter(
+    "trg_db_update_sessions_total",
+    "Updates handled by DbSessionMiddleware, by whether they opened a DB session",
+    ["used"],
+)
+
+# --- обработка апдейтов (bot.base.update_metrics) ---
+UPDATE_SECONDS = Histogram(
+    "trg_update_seconds",
+    "Time spent handling one update",
+    ["update_type", "command", "state"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+UPDATE_ERRORS = Counter(
+    "trg_update_errors_total",
+    "Updates whose handling raised an unhandled exception",
+    ["update_type", "command", "state", "error"],
+)
+UPDATES_IN_FLIGHT = Gauge("trg_updates_in_flight", "Updates currently being handled", ["update_type"])
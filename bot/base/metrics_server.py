@@ -0,0 +1,49 @@
+# bot/base/metrics_server.py
+from __future__ import annotations
+
+import logging
+from typing import Optional
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
+
+logger = logging.getLogger(__name__)
+
+
+def build_metrics_app(registry: CollectorRegistry = REGISTRY) -> web.Application:
+    async def metrics(request: web.Request) -> web.Response:
+        response = web.Response(body=generate_latest(registry))
+        response.content_type = CONTENT_TYPE_LATEST.split(";", 1)[0]
+        response.charset = "utf-8"
+        return response
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    return app
+
+
+class MetricsServer:
+    """
+    HTTP-сервер с одним адресом /metrics для Prometheus. Работает в цикле событий бота
+    отдельно от webhook: по умолчанию слушает только localhost.
+    """
+
+    def __init__(self, host: str, port: int, registry: CollectorRegistry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        if self._runner is not None:
+            return
+        runner = web.AppRunner(build_metrics_app(self.registry), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, self.host, self.port).start()
+        self._runner = runner
+        logger.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,130 @@
+# bot/base/query_stats.py
+"""
+Счётчик SQL-запросов на один апдейт.
+
+QueryStatsMiddleware заводит QueryStats на время обработки апдейта, а события engine
+(instrument_queries) дописывают в него каждый выполненный запрос: число, время и
+сколько раз повторялся один и тот же текст запроса — повтор с разными параметрами
+обычно означает N+1 (запрос в цикле). Состояние aiogram-dialog, в котором
+обрабатывался апдейт, проставляет bot.base.update_metrics.dialog_state_middleware.
+
+По итогам апдейта счётчики уходят в метрики trg_db_update_*, а при превышении
+бюджета (DB_QUERY_BUDGET запросов или DB_QUERY_REPEAT_BUDGET повторов одного
+запроса) пишется предупреждение с самым частым запросом.
+"""
+from __future__ import annotations
+
+import logging
+import time
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from bot.base.metrics import DB_UPDATE_STATEMENTS, DB_UPDATE_SECONDS, DB_UPDATE_REPEATED_STATEMENTS, \
+    DB_UPDATE_OVER_BUDGET
+
+logger = logging.getLogger(__name__)
+
+NO_STATE = "-"
+
+
+@dataclass
+class QueryStats:
+    state: str = NO_STATE
+    statements: int = 0
+    seconds: float = 0.0
+    texts: Counter = field(default_factory=Counter)
+
+    @property
+    def repeated(self) -> int:
+        """Сколько запросов повторили уже выполненный текст."""
+        return self.statements - len(self.texts)
+
+    def most_repeated(self) -> Optional[Tuple[str, int]]:
+        return self.texts.most_common(1)[0] if self.texts else None
+
+
+_current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+def current_stats() -> Optional[QueryStats]:
+    return _current.get()
+
+
+# --- события engine ---
+# Синхронные события выполняются в greenlet SQLAlchemy, который наследует контекст
+# вызывающей задачи, поэтому _current в них тот же, что у обработчика апдейта.
+
+# Время старта хранится на контексте выполнения, а не в conn.info: after_cursor_execute
+# не вызывается, если запрос упал, и запись в conn.info осталась бы на соединении пула.
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    if context is not None and _current.get() is not None:
+        context._query_stats_started = time.perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    stats = _current.get()
+    started = getattr(context, "_query_stats_started", None)
+    if stats is None or started is None:
+        return
+    stats.seconds += time.perf_counter() - started
+    stats.statements += 1
+    stats.texts[statement] += 1
+
+
+def instrument_queries(engine: AsyncEngine) -> None:
+    """Подписывает engine на подсчёт запросов; вне апдейта подсчёт ничего не делает."""
+    sync_engine = engine.sync_engine
+    if not event.contains(sync_engine, "before_cursor_execute", _before_execute):
+        event.listen(sync_engine, "before_cursor_execute", _before_execute)
+        event.listen(sync_engine, "after_cursor_execute", _after_execute)
+
+
+# --- middleware ---
+
+class QueryStatsMiddleware(BaseMiddleware):
+    """
+    Считает SQL-запросы каждого апдейта. Регистрируется на dp.update раньше
+    DbSessionMiddleware, чтобы в счёт попало и закрытие сессии.
+    """
+
+    def __init__(self, max_statements: int = 20, max_repeats: int = 5):
+        super().__init__()
+        self.max_statements = max_statements
+        self.max_repeats = max_repeats
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, dict], Awaitable[Any]],
+        event: Any,
+        data: dict
+    ) -> Any:
+        stats = QueryStats()
+        token = _current.set(stats)
+        try:
+            return await handler(event, data)
+        finally:
+            _current.reset(token)
+            self.observe(stats)
+
+    def observe(self, stats: QueryStats) -> None:
+        DB_UPDATE_STATEMENTS.labels(stats.state).observe(stats.statements)
+        DB_UPDATE_SECONDS.labels(stats.state).observe(stats.seconds)
+        if stats.repeated:
+            DB_UPDATE_REPEATED_STATEMENTS.labels(stats.state).inc(stats.repeated)
+
+        top = stats.most_repeated()
+        if stats.statements > self.max_statements or (top is not None and top[1] > self.max_repeats):
+            DB_UPDATE_OVER_BUDGET.labels(stats.state).inc()
+            logger.warning(
+                "Update in state %s ran %d SQL statements in %.1f ms (%d repeated); most repeated x%d: %s",
+                stats.state, stats.statements, stats.seconds * 1000, stats.repeated,
+                top[1], " ".join(top[0].split())[:300],
+            )
+
@@ -0,0 +1,147 @@
+# bot/base/slow_queries.py
+"""
+Журнал медленных SQL-запросов (включается SLOW_QUERY_LOG=<путь>).
+
+Запросы дольше порога пишутся строкой JSON в файл с ротацией: текст, параметры
+(значения заменены типами — в них бывают имена, города и telegram_id), длительность,
+метки апдейта (тип, команда, состояние диалога) и — для доли explain_rate запросов —
+план выполнения. Для PostgreSQL это EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) в
+SAVEPOINT на отдельном курсоре того же соединения, для SQLite — EXPLAIN QUERY PLAN.
+
+ANALYZE выполняет запрос повторно, поэтому план снимается только для SELECT/WITH:
+повтор INSERT/UPDATE изменил бы данные. Запись в файл синхронная — она случается
+только для медленных запросов.
+"""
+from __future__ import annotations
+
+import datetime
+import json
+import logging
+import logging.handlers
+import random
+import time
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from bot.base.update_metrics import current_labels
+
+SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+EXPLAIN_PREFIX = {
+    "postgresql": "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ",
+    "sqlite": "EXPLAIN QUERY PLAN ",
+}
+
+logger = logging.getLogger(__name__)
+
+
+def redact(value: Any) -> Any:
+    """Параметры без значений: None и bool как есть, остальное — имя типа."""
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, dict):
+        return {k: redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return f"<{type(value).__name__}>"
+
+
+def _explainable(statement: str) -> bool:
+    head = statement.lstrip().split(None, 1)
+    return bool(head) and head[0].upper() in ("SELECT", "WITH")
+
+
+class SlowQueryLog:
+    def __init__(
+            self,
+            path: str,
+            threshold: float = 0.2,
+            explain_rate: float = 0.1,
+            max_bytes: int = SLOW_QUERY_LOG_MAX_BYTES,
+            backups: int = SLOW_QUERY_LOG_BACKUPS,
+            sample: Callable[[], float] = random.random,
+    ):
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        self._sample = sample
+        # Отдельный логгер без распространения вверх: строки идут только в файл
+        self._log = logging.getLogger(f"{__name__}.{path}")
+        self._log.propagate = False
+        self._log.setLevel(logging.INFO)
+        self._handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+        self._handler.setFormatter(logging.Formatter("%(message)s"))
+        self._log.addHandler(self._handler)
+
+    def attach(self, engine: AsyncEngine) -> None:
+        sync_engine = engine.sync_engine
+        if not event.contains(sync_engine, "after_cursor_execute", self._after_execute):
+            event.listen(sync_engine, "before_cursor_execute", self._before_execute)
+            event.listen(sync_engine, "after_cursor_execute", self._after_execute)
+
+    def close(self) -> None:
+        self._log.removeHandler(self._handler)
+        self._handler.close()
+
+    # Старт — на контексте выполнения: для упавшего запроса after_cursor_execute не вызывается,
+    # и запись в conn.info осталась бы на соединении пула навсегда
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        if context is not None:
+            context._slow_query_started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        started = getattr(context, "_slow_query_started", None)
+        if started is None:
+            return
+        duration = time.perf_counter() - started
+        if duration < self.threshold:
+            return
+
+        labels = current_labels()
+        record: Dict[str, Any] = {
+            "ts": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "duration_ms": round(duration * 1000, 3),
+            "statement": statement,
+            "parameters": redact(parameters[0] if executemany and parameters else parameters),
+            "executemany": len(parameters) if executemany else None,
+            "update_type": labels.update_type if labels else None,
+            "command": labels.command if labels else None,
+            "state": labels.state if labels else None,
+        }
+        prefix = EXPLAIN_PREFIX.get(conn.dialect.name)
+        if prefix and not executemany and _explainable(statement) and self._sample() < self.explain_rate:
+            try:
+                record["plan"] = self._explain(conn, prefix + statement, parameters)
+            except Exception as e:
+                record["explain_error"] = f"{type(e).__name__}: {e}"
+        try:
+            self._log.info(json.dumps(record, ensure_ascii=False, default=str))
+        except Exception:
+            logger.exception("Failed to write slow query record")
+
+    @staticmethod
+    def _explain(conn, sql: str, parameters: Any) -> List[Any]:
+        """План на отдельном курсоре DBAPI: события SQLAlchemy и результат исходного запроса не задеты."""
+        cursor = conn.connection.cursor()
+        savepoint = conn.dialect.name == "postgresql"
+        try:
+            if savepoint:
+                # Ошибка EXPLAIN не должна оборвать транзакцию обработчика
+                cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(sql, parameters)
+                rows = cursor.fetchall()
+            except Exception:
+                if savepoint:
+                    cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                raise
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        finally:
+            cursor.close()
+        if conn.dialect.name == "postgresql":
+            plan = rows[0][0]
+            return json.loads(plan) if isinstance(plan, str) else plan
+        return [list(row) for row in rows]
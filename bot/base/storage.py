@@ -0,0 +1,99 @@
+# bot/base/storage.py
+from __future__ import annotations
+
+import datetime
+from typing import TYPE_CHECKING, Any, Dict, Mapping
+
+import msgpack
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
+from aiogram.fsm.storage.redis import RedisEventIsolation, RedisStorage
+
+if TYPE_CHECKING:
+    from bot.base.config_reader import TelegramConfig
+
+# Коды ext-типов msgpack для значений, которые msgpack не умеет сам
+_EXT_DATETIME = 1
+_EXT_DATE = 2
+
+
+def _pack_default(obj: Any) -> Any:
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(_EXT_DATETIME, obj.isoformat().encode())
+    if isinstance(obj, datetime.date):
+        return msgpack.ExtType(_EXT_DATE, obj.isoformat().encode())
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Cannot serialize {type(obj).__name__} into FSM storage")
+
+
+def _unpack_ext(code: int, data: bytes) -> Any:
+    if code == _EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode())
+    if code == _EXT_DATE:
+        return datetime.date.fromisoformat(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+def pack_data(data: Mapping[str, Any]) -> bytes:
+    return msgpack.packb(data, default=_pack_default, use_bin_type=True)
+
+
+def unpack_data(raw: bytes) -> Dict[str, Any]:
+    return msgpack.unpackb(raw, ext_hook=_unpack_ext, raw=False, strict_map_key=False)
+
+
+class MsgpackRedisStorage(RedisStorage):
+    """
+    RedisStorage, хранящий данные FSM и стеки aiogram-dialog в msgpack вместо JSON.
+    Состояния остаются строками, как в RedisStorage.
+    """
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        redis_key = self.key_builder.build(key, "data")
+        if not data:
+            await self.redis.delete(redis_key)
+            return
+        await self.redis.set(redis_key, pack_data(data), ex=self.data_ttl)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        redis_key = self.key_builder.build(key, "data")
+        value = await self.redis.get(redis_key)
+        if value is None:
+            return {}
+        return unpack_data(value)
+
+
+def build_storage(config: TelegramConfig) -> BaseStorage:
+    """
+    Хранилище FSM по настройке FSM_STORAGE:
+      memory — в памяти процесса (один воркер, всё теряется при перезапуске);
+      redis  — в Redis, общее для всех воркеров.
+    """
+    if config.fsm_storage == "memory":
+        return MemoryStorage()
+    if config.fsm_storage == "redis":
+        return MsgpackRedisStorage.from_url(
+            config.redis_dsn,
+            # aiogram-dialog хранит стеки и контексты под отдельными destiny
+            key_builder=DefaultKeyBuilder(with_destiny=True),
+            state_ttl=config.fsm_state_ttl,
+            data_ttl=config.fsm_data_ttl,
+        )
+    raise ValueError(f"Unknown FSM storage: {config.fsm_storage}")
+
+
+def build_events_isolation(storage: BaseStorage) -> BaseEventIsolation:
+    """
+    Изоляция апдейтов одного пользователя для Dispatcher и aiogram-dialog.
+    aiogram-dialog читает и переписывает стек и контекст диалога целиком, поэтому два
+    апдейта одного чата не должны обрабатываться одновременно. С Redis апдейты могут
+    попасть в разные воркеры — блокировка берётся в том же Redis; в памяти процесса
+    хватает локальных блокировок.
+    """
+    if isinstance(storage, RedisStorage):
+        return RedisEventIsolation(storage.redis, key_builder=storage.key_builder)
+    return SimpleEventIsolation()
@@ -0,0 +1,109 @@
+# bot/base/update_metrics.py
+"""
+Метрики обработки апдейтов: задержка, ошибки и апдейты в работе.
+
+UpdateMetricsMiddleware — внешний middleware dp.update: замеряет всю обработку апдейта
+(включая middleware диалогов и сессии БД) и пишет её в trg_update_seconds с метками
+типа апдейта, команды и состояния диалога. Состояние известно только на уровне
+сообщений и колбэков — его проставляет dialog_state_middleware.
+
+Команды в метках — только известные боту (остальные — "other"), иначе любой
+текст вида "/что-угодно" заводил бы новую серию метрик.
+"""
+from __future__ import annotations
+
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from aiogram_dialog.api.internal import CONTEXT_KEY
+
+from bot.base.metrics import UPDATE_SECONDS, UPDATE_ERRORS, UPDATES_IN_FLIGHT
+from bot.base.query_stats import NO_STATE, current_stats
+
+NO_COMMAND = "-"
+OTHER_COMMAND = "other"
+
+
+@dataclass
+class UpdateLabels:
+    update_type: str
+    command: str = NO_COMMAND
+    state: str = NO_STATE
+
+
+_current: ContextVar[Optional[UpdateLabels]] = ContextVar("update_labels", default=None)
+
+
+def current_labels() -> Optional[UpdateLabels]:
+    return _current.get()
+
+
+def update_type(event: Any) -> str:
+    try:
+        return event.event_type if isinstance(event, Update) else type(event).__name__.lower()
+    except Exception:
+        return "unknown"
+
+
+def command_name(event: Any, known: frozenset) -> str:
+    """Команда из текста сообщения: "/games@trg_bot 2" -> "games"."""
+    message = getattr(event, "message", None) if isinstance(event, Update) else None
+    text = getattr(message, "text", None)
+    if not isinstance(text, str) or not text.startswith("/"):
+        return NO_COMMAND
+    command = text.split(maxsplit=1)[0][1:].split("@", 1)[0].lower()
+    return command if command in known else OTHER_COMMAND
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Регистрируется через dp.update.outer_middleware."""
+
+    def __init__(self, commands: Iterable[str] = ()):
+        super().__init__()
+        self.commands = frozenset(c.lstrip("/").lower() for c in commands)
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, dict], Awaitable[Any]],
+        event: Any,
+        data: dict
+    ) -> Any:
+        labels = UpdateLabels(update_type(event), command_name(event, self.commands))
+        token = _current.set(labels)
+        in_flight = UPDATES_IN_FLIGHT.labels(labels.update_type)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            UPDATE_ERRORS.labels(labels.update_type, labels.command, labels.state, type(e).__name__).inc()
+            raise
+        finally:
+            UPDATE_SECONDS.labels(labels.update_type, labels.command, labels.state) \
+                .observe(time.perf_counter() - started)
+            in_flight.dec()
+            _current.reset(token)
+
+
+async def dialog_state_middleware(
+        handler: Callable[[Any, dict], Awaitable[Any]],
+        event: Any,
+        data: dict
+) -> Any:
+    """
+    Помечает апдейт состоянием диалога (контекст кладёт aiogram-dialog):
+    метки UpdateMetricsMiddleware и счётчик SQL из bot.base.query_stats.
+    """
+    context = data.get(CONTEXT_KEY)
+    if context is not None:
+        state = context.state.state
+        labels, stats = current_labels(), current_stats()
+        if labels is not None:
+            labels.state = state
+        if stats is not None:
+            stats.state = state
+    return await handler(event, data)
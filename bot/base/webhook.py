@@ -0,0 +1,101 @@
+# bot/base/webhook.py
+from __future__ import annotations
+
+import logging
+import multiprocessing
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+if TYPE_CHECKING:
+    from bot.base.config_reader import TelegramConfig
+
+
+def get_webhook_url(config: TelegramConfig) -> str:
+    """Публичный адрес, который регистрируется в Telegram через setWebhook."""
+    if not config.webhook_base_url:
+        raise ValueError("WEBHOOK_BASE_URL must be set for webhook mode")
+    return config.webhook_base_url.rstrip("/") + "/" + config.webhook_path.lstrip("/")
+
+
+def get_webhook_secret(config: TelegramConfig) -> Optional[str]:
+    return config.webhook_secret.get_secret_value() if config.webhook_secret else None
+
+
+def build_webhook_app(
+    dp: Dispatcher,
+    bot: Bot,
+    path: str,
+    secret_token: Optional[str] = None,
+    handle_in_background: bool = True,
+) -> web.Application:
+    """
+    aiohttp-приложение, принимающее апдейты от Telegram на `path`.
+    При handle_in_background=True Telegram получает ответ сразу, а апдейт
+    обрабатывается в фоне — медленный хэндлер не задерживает следующие апдейты.
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret_token,
+        handle_in_background=handle_in_background,
+    ).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def serve_webhook(dp: Dispatcher, bot: Bot, config: TelegramConfig) -> None:
+    """
+    Запускает один воркер. При нескольких воркерах все слушают один порт
+    (SO_REUSEPORT), и ядро распределяет входящие соединения между ними.
+    """
+    app = build_webhook_app(dp, bot, config.webhook_path, get_webhook_secret(config))
+    web.run_app(
+        app,
+        host=config.webhook_host,
+        port=config.webhook_port,
+        reuse_port=config.webhook_workers > 1,
+        print=None,
+    )
+
+
+WORKER_NAME_PREFIX = "webhook-worker-"
+
+
+def worker_index() -> int:
+    """Номер текущего воркера из run_webhook_workers; 0 — основной процесс."""
+    name = multiprocessing.current_process().name
+    return int(name[len(WORKER_NAME_PREFIX):]) if name.startswith(WORKER_NAME_PREFIX) else 0
+
+
+def run_webhook_workers(worker: Callable[[], None], workers: int) -> None:
+    """
+    Запускает `workers` процессов с функцией `worker` и ждёт их завершения.
+    При одном воркере он выполняется в текущем процессе.
+    """
+    if workers <= 1:
+        worker()
+        return
+
+    processes: List[multiprocessing.Process] = [
+        multiprocessing.Process(target=worker, name=f"{WORKER_NAME_PREFIX}{i}", daemon=False)
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logging.info("Started %d webhook workers", workers)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
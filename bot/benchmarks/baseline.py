@@ -0,0 +1,155 @@
+# bot/benchmarks/baseline.py
+"""
+Базовая линия бенчмарков bot.benchmarks.bench_requests.
+
+Читает результат pytest-benchmark (--benchmark-json) и сравнивает медианы с базовой
+линией — JSON-файлом вида
+
+    {"benchmarks": {"test_get_user_model": {"median_ms": 1.26, "threshold": 0.25}, ...},
+     "scale": 1.0,
+     "machine": {"node": ..., "system": ..., "python": ..., "cpu": ..., "cpu_count": ..., "dialect": ...},
+     "history": [{"datetime": ..., "commit": ..., "branch": ..., "scale": ..., "machine": ..., "median_ms": {...}}, ...]}
+
+check завершается с кодом 1, если медиана выросла больше чем на threshold (доля,
+по умолчанию DEFAULT_THRESHOLD; правится в файле для отдельных бенчмарков).
+update принимает текущие медианы за новую базовую линию, пороги сохраняются.
+Обе команды с --record (update — всегда) дописывают прогон в history, так что
+файл хранит и опорные значения, и динамику по коммитам. Прогоны с другим
+TRG_BENCH_SCALE не сравниваются. Медианы имеют смысл только на той машине и базе,
+где сняты (machine): check на другой машине предупреждает об этом, а своя базовая
+линия снимается командой update. Файла нет или в нём нет медиан — check завершается
+с кодом 1 и подсказкой запустить update.
+
+Запуск: python -m bot.benchmarks.baseline {check,update} bench.json [--baseline FILE] [--record]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_THRESHOLD = 0.25
+
+
+def load_json(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def medians(run: Dict[str, Any]) -> Dict[str, float]:
+    """Медианы прогона pytest-benchmark в миллисекундах."""
+    return {b["name"]: round(b["stats"]["median"] * 1000, 4) for b in run["benchmarks"]}
+
+
+def run_scale(run: Dict[str, Any]) -> Optional[float]:
+    scales = {b.get("extra_info", {}).get("scale") for b in run["benchmarks"]}
+    return scales.pop() if len(scales) == 1 else None
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, float]) -> List[Tuple[str, str, Optional[float], float]]:
+    """
+    Строки отчёта (имя, статус, базовая медиана, текущая медиана); статус — "ok",
+    "regression", "faster" (быстрее больше чем на порог) или "new".
+    """
+    rows = []
+    reference = baseline.get("benchmarks", {})
+    for name in sorted(current):
+        entry = reference.get(name)
+        if entry is None:
+            rows.append((name, "new", None, current[name]))
+            continue
+        base, threshold = entry["median_ms"], entry.get("threshold", DEFAULT_THRESHOLD)
+        if current[name] > base * (1 + threshold):
+            status = "regression"
+        elif current[name] < base * (1 - threshold):
+            status = "faster"
+        else:
+            status = "ok"
+        rows.append((name, status, base, current[name]))
+    return rows
+
+
+def run_machine(run: Dict[str, Any]) -> Dict[str, Any]:
+    """Машина и окружение прогона по machine_info pytest-benchmark."""
+    info = run.get("machine_info") or {}
+    cpu = info.get("cpu") or {}
+    dialects = {b.get("extra_info", {}).get("dialect") for b in run["benchmarks"]}
+    return {
+        "node": info.get("node"),
+        "system": f"{info.get('system')} {info.get('release')} {info.get('machine')}",
+        "python": f"{info.get('python_implementation')} {info.get('python_version')}",
+        "cpu": cpu.get("brand_raw"),
+        "cpu_count": cpu.get("count"),
+        "dialect": dialects.pop() if len(dialects) == 1 else None,
+    }
+
+
+def history_entry(run: Dict[str, Any]) -> Dict[str, Any]:
+    commit = run.get("commit_info") or {}
+    return {
+        "datetime": run.get("datetime"),
+        "commit": commit.get("id"),
+        "branch": commit.get("branch"),
+        "dirty": commit.get("dirty"),
+        "scale": run_scale(run),
+        "machine": run_machine(run),
+        "median_ms": medians(run),
+    }
+
+
+def update(baseline: Dict[str, Any], run: Dict[str, Any]) -> Dict[str, Any]:
+    reference = baseline.get("benchmarks", {})
+    baseline["benchmarks"] = {
+        name: {"median_ms": median, "threshold": reference.get(name, {}).get("threshold", DEFAULT_THRESHOLD)}
+        for name, median in sorted(medians(run).items())
+    }
+    baseline["scale"] = run_scale(run)
+    baseline["machine"] = run_machine(run)
+    return baseline
+
+
+def main(command: str, result_path: str, baseline_path: str, record: bool) -> int:
+    run = load_json(result_path)
+    baseline = load_json(baseline_path) if os.path.exists(baseline_path) else {}
+
+    if command == "update":
+        update(baseline, run)
+        record = True
+    elif not baseline.get("benchmarks"):
+        print(f"no baseline in {baseline_path}: save one first with "
+              f"'python -m bot.benchmarks.baseline update {result_path} --baseline {baseline_path}'")
+        return 1
+    elif baseline.get("scale") != run_scale(run):
+        print(f"scale {run_scale(run)} differs from the baseline scale {baseline.get('scale')}")
+        return 1
+    elif baseline.get("machine") != run_machine(run):
+        print(f"warning: baseline was recorded on {baseline.get('machine')}, this run is on {run_machine(run)}; "
+              f"timings may differ for reasons other than the code")
+
+    code = 0
+    if command == "check":
+        for name, status, base, median in compare(baseline, medians(run)):
+            base_text = f"{base:9.3f}" if base is not None else " " * 9
+            change = f"{(median / base - 1) * 100:+7.1f}%" if base else " " * 8
+            print(f"{name:32} {base_text} -> {median:9.3f} ms {change}  {status}")
+            code = 1 if status == "regression" else code
+
+    if record:
+        baseline.setdefault("history", []).append(history_entry(run))
+    if command == "update" or record:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+    return code
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["check", "update"])
+    parser.add_argument("result", help="файл --benchmark-json")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--record", action="store_true", help="дописать прогон в history")
+    args = parser.parse_args()
+    raise SystemExit(main(args.command, args.result, args.baseline, args.record))
@@ -0,0 +1,328 @@
+# bot/benchmarks/bench_requests.py
+"""
+pytest-benchmark: запросы bot.db.requests на базе реального размера.
+
+Засевает базу (по умолчанию 100 000 пользователей, из них 20 000 мастеров, и 200 000
+игр с составами и заявками) и замеряет чтение профилей, регистрацию, правки, список
+открытых игр, подбор игр и игры игрока. Каждый вызов — в новой AsyncSession, как в обработчике
+апдейта; кэш профилей перед вызовом сбрасывается, чтобы мерить запрос, а не кэш.
+
+Окружение:
+    TRG_BENCH_DSN    — база (по умолчанию SQLite во временном каталоге). Если в ней
+                       уже есть засеянные пользователи, засев пропускается — так
+                       повторные прогоны на PostgreSQL не ждут его каждый раз;
+    TRG_BENCH_SCALE  — множитель объёма данных (0.1 — быстрый прогон);
+    TRG_BENCH_ROUNDS — замеров на бенчмарк (по умолчанию 50).
+
+Файл не подпадает под шаблон test_*.py и в обычный прогон тестов не попадает.
+Результаты сравниваются с базовой линией через bot.benchmarks.baseline.
+
+Запуск: python -m pytest bot/benchmarks/bench_requests.py --benchmark-json=bench.json
+"""
+from __future__ import annotations
+
+import asyncio
+import datetime
+import itertools
+import os
+import random
+import tempfile
+from typing import Any, Awaitable, Callable, Dict, Iterator, List
+
+import pytest
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from bot.base.db_middleware import normalize_async_dsn
+from bot.db.base import Base, User, Player, Master, Session, session_players, session_requests
+from bot.db.game_filters import GameFilters
+from bot.db.models import UserModel, PlayerModel, MasterModel, SessionModel
+from bot.db.requests import user_cache, get_user_model, get_player_model, get_master_model, \
+    get_open_games_page, get_player_games_overview, recommend_games, register_user, register_player, \
+    register_master, register_game, register_users_bulk, register_games_bulk, edit_user, edit_player, \
+    edit_master, edit_game
+
+SCALE = float(os.environ.get("TRG_BENCH_SCALE", "1"))
+ROUNDS = int(os.environ.get("TRG_BENCH_ROUNDS", "50"))
+WARMUP_ROUNDS = 3
+USERS = int(100_000 * SCALE)
+MASTERS = int(20_000 * SCALE)
+SESSIONS = int(200_000 * SCALE)
+TG_ID_BASE = 5_000_000_000
+SAMPLE = 1_000
+
+SYSTEMS = ["D&D 5e", "Pathfinder 2e", "Call of Cthulhu", "Vampire: The Masquerade", "Cyberpunk RED",
+           "Shadowrun", "Warhammer Fantasy", "Blades in the Dark", "Savage Worlds", "GURPS"]
+CITIES = ["Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", "Казань", "Нижний Новгород",
+          "Челябинск", "Самара", "Омск", "Ростов-на-Дону"]
+WORDS = ["Тайна", "Поход", "Кампания", "Ваншот", "Хроники", "Тень", "Порог", "Легенда"]
+
+
+def _user_row(i: int, rnd: random.Random) -> Dict[str, Any]:
+    """
+    Первые MASTERS пользователей — мастера (каждый второй из них ещё и игрок),
+    остальные — игроки.
+    """
+    is_master = i < MASTERS
+    is_player = not is_master or i % 2 == 0
+    row = {
+        "telegram_id": TG_ID_BASE + i, "name": f"User {i}", "age": rnd.randint(16, 60),
+        "city": rnd.choice(CITIES), "time_zone": rnd.randint(-2, 12),
+        "role": "Игрок, Мастер" if is_master and is_player else ("Мастер" if is_master else "Игрок"),
+        "game_format": rnd.choice(["Онлайн", "Оффлайн", "Онлайн, Оффлайн"]),
+        "preferred_systems": ", ".join(rnd.sample(SYSTEMS, rnd.randint(1, 3))),
+        "about_info": "benchmark",
+    }
+    if is_player:
+        row.update(experience_level=rnd.randint(0, 2), availability="вечера")
+    if is_master:
+        row.update(master_style="сюжетный", rating=rnd.randint(0, 10))
+    return row
+
+
+async def seed(maker: async_sessionmaker) -> None:
+    rnd = random.Random(0)
+    async with maker() as s:
+        await register_users_bulk((_user_row(i, rnd) for i in range(USERS)), s, batch_size=5_000)
+        master_ids = (await s.execute(select(Master.id).order_by(Master.id))).scalars().all()
+        player_ids = (await s.execute(select(Player.id).order_by(Player.id))).scalars().all()
+
+        # Игры — через тот же импорт, что и в боте: город и мастер игры, связи систем
+        when = datetime.datetime(2030, 1, 1)
+        games = []
+        for _ in range(SESSIONS):
+            fmt = rnd.randint(0, 1)
+            games.append({
+                "title": f"{rnd.choice(WORDS)} #{rnd.randint(1, 10 ** 6)}", "description": "benchmark",
+                "game_system": rnd.choice(SYSTEMS),
+                "date_time": (when + datetime.timedelta(hours=rnd.randint(0, 10 ** 4))).isoformat(),
+                "format": fmt, "status": rnd.random() < 0.9, "max_players": rnd.randint(3, 6), "looking_for": 0,
+                "city": rnd.choice(CITIES) if fmt == 1 else None, "is_paid": rnd.random() < 0.3,
+                "min_age": rnd.choice([None, None, 16, 18]), "max_age": rnd.choice([None, None, 30, 50]),
+                "creator_id": rnd.choice(master_ids),
+            })
+        session_ids = (await register_games_bulk(games, s, batch_size=10_000)).ids
+        members, requests = set(), set()
+        for sid in session_ids:
+            for pid in rnd.sample(player_ids, rnd.randint(0, 3)):
+                members.add((sid, pid))
+            if rnd.random() < 0.3:
+                requests.add((sid, rnd.choice(player_ids)))
+        for table, pairs, extra in ((session_players, sorted(members), {}),
+                                    (session_requests, sorted(requests - members), {"is_pending": True})):
+            for start in range(0, len(pairs), 10_000):
+                await s.execute(insert(table), [{"session_id": sid, "player_id": pid, **extra}
+                                                for sid, pid in pairs[start:start + 10_000]])
+        await s.commit()
+
+
+class Db:
+    """База и цикл событий бенчмарков: pytest-benchmark вызывает синхронные функции."""
+
+    def __init__(self, runner: asyncio.Runner, maker: async_sessionmaker):
+        self.runner = runner
+        self.maker = maker
+
+    def run(self, coro: Awaitable[Any]) -> Any:
+        return self.runner.run(coro)
+
+    def call(self, fn: Callable[[AsyncSession, Any], Awaitable[Any]], arg: Any) -> Any:
+        async def in_session():
+            async with self.maker() as session:
+                return await fn(session, arg)
+        return self.run(in_session())
+
+    def scalars(self, stmt) -> List[Any]:
+        async def query():
+            async with self.maker() as session:
+                return (await session.execute(stmt)).scalars().all()
+        return self.run(query())
+
+
+@pytest.fixture(scope="module")
+def db() -> Iterator[Db]:
+    with tempfile.TemporaryDirectory() as tmp, asyncio.Runner() as runner:
+        dsn = os.environ.get("TRG_BENCH_DSN") or f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}"
+        engine = create_async_engine(normalize_async_dsn(dsn))
+        maker = async_sessionmaker(engine, expire_on_commit=False)
+
+        async def prepare():
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            async with maker() as s:
+                seeded = await s.scalar(select(func.count()).select_from(User)
+                                        .where(User.telegram_id.between(TG_ID_BASE, TG_ID_BASE + USERS - 1)))
+            if seeded < USERS:
+                await seed(maker)
+
+        runner.run(prepare())
+        yield Db(runner, maker)
+        runner.run(engine.dispose())
+
+
+def bench(benchmark, db: Db, fn: Callable[[AsyncSession, Any], Awaitable[Any]], args: Iterator[Any]) -> None:
+    """Каждый замер — новый аргумент из args и холодный кэш профилей."""
+    benchmark.extra_info["scale"] = SCALE
+    benchmark.extra_info["dialect"] = db.maker.kw["bind"].dialect.name
+
+    def setup():
+        user_cache.clear()
+        return (next(args),), {}
+
+    benchmark.pedantic(lambda arg: db.call(fn, arg), setup=setup, rounds=ROUNDS, warmup_rounds=WARMUP_ROUNDS)
+
+
+def _sample(db: Db, stmt) -> Iterator[Any]:
+    values = db.scalars(stmt.order_by(func.random()).limit(SAMPLE))
+    assert values, "benchmark database is empty"
+    return itertools.cycle(values)
+
+
+def _fresh(db: Db, stmt) -> Iterator[Any]:
+    """Аргументы для регистрации: каждый используется один раз."""
+    values = db.scalars(stmt.limit(ROUNDS + WARMUP_ROUNDS))
+    if len(values) < ROUNDS + WARMUP_ROUNDS:
+        pytest.skip("not enough unregistered users left in the benchmark database")
+    return iter(values)
+
+
+def _player_tg_ids(db: Db) -> Iterator[int]:
+    return _sample(db, select(User.telegram_id).join(Player, Player.id == User.id))
+
+
+def _master_tg_ids(db: Db) -> Iterator[int]:
+    return _sample(db, select(User.telegram_id).join(Master, Master.id == User.id))
+
+
+def _new_user(tg_id: int, **kwargs: Any) -> User:
+    return User(telegram_id=tg_id, name="New", age=25, city="Казань", time_zone=3, role=1, game_format=1,
+                preferred_systems="D&D 5e, GURPS", about_info="benchmark", **kwargs)
+
+
+# --- чтение профилей ---
+
+@pytest.mark.benchmark(group="profiles")
+def test_get_user_model(benchmark, db):
+    bench(benchmark, db, lambda s, tg_id: get_user_model(s, tg_id), _player_tg_ids(db))
+
+
+@pytest.mark.benchmark(group="profiles")
+def test_get_player_model(benchmark, db):
+    bench(benchmark, db, lambda s, tg_id: get_player_model(s, tg_id), _player_tg_ids(db))
+
+
+@pytest.mark.benchmark(group="profiles")
+def test_get_master_model(benchmark, db):
+    bench(benchmark, db, lambda s, tg_id: get_master_model(s, tg_id), _master_tg_ids(db))
+
+
+# --- регистрация ---
+
+@pytest.mark.benchmark(group="register")
+def test_register_user(benchmark, db):
+    start = db.scalars(select(func.max(User.telegram_id)))[0] + 1
+
+    bench(benchmark, db, lambda s, tg_id: register_user(UserModel(_new_user(tg_id)), s), itertools.count(start))
+
+
+@pytest.mark.benchmark(group="register")
+def test_register_player(benchmark, db):
+    tg_ids = _fresh(db, select(User.telegram_id).outerjoin(Player, Player.id == User.id).where(Player.id.is_(None)))
+
+    def player(tg_id: int) -> PlayerModel:
+        return PlayerModel(Player(experience_level=1, availability="выходные", user=_new_user(tg_id)))
+
+    bench(benchmark, db, lambda s, tg_id: register_player(player(tg_id), s), tg_ids)
+
+
+@pytest.mark.benchmark(group="register")
+def test_register_master(benchmark, db):
+    tg_ids = _fresh(db, select(User.telegram_id).outerjoin(Master, Master.id == User.id).where(Master.id.is_(None)))
+
+    def master(tg_id: int) -> MasterModel:
+        return MasterModel(Master(master_style="хоррор", rating=0, user=_new_user(tg_id)))
+
+    bench(benchmark, db, lambda s, tg_id: register_master(master(tg_id), s), tg_ids)
+
+
+@pytest.mark.benchmark(group="register")
+def test_register_game(benchmark, db):
+    creators = _sample(db, select(Master.id))
+
+    def game(creator_id: int) -> SessionModel:
+        return SessionModel(Session(title="Новая игра", description="benchmark", game_system="D&D 5e",
+                                    date_time=datetime.datetime(2030, 6, 1), format=0, status=True, max_players=5,
+                                    looking_for=0, is_paid=False, creator=_new_user(0, id=creator_id)))
+
+    bench(benchmark, db, lambda s, creator_id: register_game(game(creator_id), s), creators)
+
+
+# --- правки ---
+
+@pytest.mark.benchmark(group="edit")
+def test_edit_user(benchmark, db):
+    # Город входит в ключи подбора игроков — правка пересчитывает player_match_keys
+    bench(benchmark, db, lambda s, tg_id: edit_user(tg_id, {"city": random.choice(CITIES)}, s), _player_tg_ids(db))
+
+
+@pytest.mark.benchmark(group="edit")
+def test_edit_player(benchmark, db):
+    bench(benchmark, db, lambda s, tg_id: edit_player(tg_id, {"experience_level": random.randint(0, 2)}, s),
+          _player_tg_ids(db))
+
+
+@pytest.mark.benchmark(group="edit")
+def test_edit_master(benchmark, db):
+    bench(benchmark, db, lambda s, tg_id: edit_master(tg_id, {"rating": random.randint(0, 10)}, s),
+          _master_tg_ids(db))
+
+
+@pytest.mark.benchmark(group="edit")
+def test_edit_game(benchmark, db):
+    bench(benchmark, db, lambda s, game_id: edit_game(game_id, {"max_players": random.randint(3, 6)}, s),
+          _sample(db, select(Session.id)))
+
+
+# --- списки игр ---
+
+@pytest.mark.benchmark(group="games")
+def test_open_games_first_page(benchmark, db):
+    bench(benchmark, db, lambda s, _: get_open_games_page(s), itertools.repeat(None))
+
+
+@pytest.mark.benchmark(group="games")
+def test_open_games_deep_page(benchmark, db):
+    # Ключи (title, id) случайных открытых игр — страницы из середины списка
+    keys = db.run(_open_game_keys(db))
+    bench(benchmark, db, lambda s, after: get_open_games_page(s, after=after), itertools.cycle(keys))
+
+
+@pytest.mark.benchmark(group="games")
+def test_open_games_filtered(benchmark, db):
+    filters = itertools.cycle([GameFilters(format=1, city=city, is_paid=False) for city in CITIES])
+    bench(benchmark, db, lambda s, f: get_open_games_page(s, filters=f), filters)
+
+
+@pytest.mark.benchmark(group="games")
+def test_recommend_games(benchmark, db):
+    # Вызов геттера поиска целиком: набор открытых игр в кэше процесса, как между записями игр
+    bench(benchmark, db, lambda s, tg_id: recommend_games(s, tg_id), _player_tg_ids(db))
+
+
+@pytest.mark.benchmark(group="games")
+def test_recommend_games_filtered(benchmark, db):
+    args = zip(_player_tg_ids(db), itertools.cycle([GameFilters(format=1, city=city) for city in CITIES]))
+    bench(benchmark, db, lambda s, arg: recommend_games(s, arg[0], filters=arg[1]), args)
+
+
+@pytest.mark.benchmark(group="games")
+def test_player_games_overview(benchmark, db):
+    tg_ids = _sample(db, select(User.telegram_id).join(session_players, session_players.c.player_id == User.id))
+    bench(benchmark, db, lambda s, tg_id: get_player_games_overview(s, tg_id), tg_ids)
+
+
+async def _open_game_keys(db: Db) -> List[tuple]:
+    async with db.maker() as s:
+        rows = await s.execute(select(Session.title, Session.id).where(Session.status.is_(True))
+                               .order_by(func.random()).limit(SAMPLE))
+        return [tuple(row) for row in rows]
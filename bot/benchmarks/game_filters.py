@@ -0,0 +1,170 @@
+# bot/benchmarks/game_filters.py
+"""
+Время фильтрованного поиска открытых игр на большой базе.
+
+Заполняет SQLite-базу (по умолчанию 100 000 открытых игр и 2 000 мастеров)
+и для набора типичных сочетаний фильтров замеряет первую и следующую страницу
+get_open_games_page (медиана по повторам). С --no-indexes индексы фильтров
+удаляются, чтобы сравнить с полным просмотром; с --explain печатается план запроса.
+
+Запуск: python -m bot.benchmarks.game_filters [--sessions 100000] [--repeat 50] [--no-indexes] [--explain]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from bot.db.base import Base, User, Session, session_players, session_game_systems
+from bot.db.game_filters import GameFilters
+from bot.db.game_systems import link_systems
+from bot.db.requests import get_open_games_page
+
+SYSTEMS = ["D&D 5e", "Pathfinder 2e", "Call of Cthulhu", "Vampire: The Masquerade", "Cyberpunk RED",
+           "Shadowrun", "Warhammer Fantasy", "Blades in the Dark", "Savage Worlds", "GURPS"] + \
+          [f"Homebrew {i}" for i in range(20)]
+CITIES = ["Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", "Казань", "Нижний Новгород",
+          "Челябинск", "Самара", "Омск", "Ростов-на-Дону"] + [f"Город {i}" for i in range(10)]
+
+CASES: List[Tuple[str, GameFilters]] = [
+    ("no filters", GameFilters()),
+    ("system", GameFilters(systems=("Call of Cthulhu",))),
+    ("online + system", GameFilters(format=0, systems=("D&D 5e",))),
+    ("offline + city", GameFilters(format=1, city="Казань")),
+    ("offline + city + system", GameFilters(format=1, city="Омск", systems=("Shadowrun",))),
+    ("free + free seats", GameFilters(is_paid=False, free_seats=True)),
+    ("online + tz ±2 + age", GameFilters(format=0, time_zone=7, tz_window=2, age=17)),
+    ("3 systems + paid", GameFilters(systems=("GURPS", "Savage Worlds", "Homebrew 3"), is_paid=True)),
+    ("everything", GameFilters(format=1, city="Москва", systems=("D&D 5e",), is_paid=False,
+                               age=25, free_seats=True, time_zone=3, tz_window=2)),
+]
+
+
+async def seed(maker: async_sessionmaker, sessions: int, masters: int) -> None:
+    rnd = random.Random(0)
+    async with maker() as s:
+        master_cities = {i: rnd.choice(CITIES) for i in range(1, masters + 1)}
+        await s.execute(insert(User), [
+            {"id": i, "telegram_id": 10_000 + i, "name": f"Master {i}", "age": rnd.randint(18, 60),
+             "city": master_cities[i], "time_zone": rnd.randint(-2, 12), "role": 2, "game_format": 3,
+             "preferred_systems": ""}
+            for i in range(1, masters + 1)
+        ])
+        when = datetime.datetime(2030, 1, 1)
+        rows = []
+        for i in range(1, sessions + 1):
+            fmt = rnd.randint(0, 1)
+            min_age = rnd.choice([None, None, 16, 18])
+            creator_id = rnd.randint(1, masters)
+            rows.append({
+                "id": i, "title": f"{rnd.choice(['Тайна', 'Поход', 'Кампания', 'Ваншот'])} #{rnd.randint(1, 10 ** 6)}",
+                "game_system": rnd.choice(SYSTEMS), "date_time": when, "format": fmt, "status": True,
+                "max_players": rnd.randint(3, 6), "looking_for": 0,
+                # Онлайн-игры без своего города — в городе создателя, как после register_game
+                "city": rnd.choice(CITIES) if fmt == 1 else master_cities[creator_id], "is_paid": rnd.random() < 0.3,
+                "min_age": min_age, "max_age": rnd.choice([None, None, 30, 50]),
+                "creator_id": creator_id,
+            })
+            if len(rows) == 10_000:
+                await _insert_sessions(s, rows)
+                rows = []
+        if rows:
+            await _insert_sessions(s, rows)
+        # Игрокам нужны строки в players; для подсчёта мест хватает session_players без FK-проверок
+        await s.execute(insert(session_players), [
+            {"session_id": sid, "player_id": pid}
+            for sid in range(1, sessions + 1, 3) for pid in range(1, rnd.randint(2, 6))
+        ])
+        await s.commit()
+
+
+async def _insert_sessions(s: AsyncSession, rows: List[Dict]) -> None:
+    # INSERT через Core не вызывает события маппера: связи систем для фильтра — отдельно
+    await s.execute(insert(Session), rows)
+    systems = {row["id"]: row["game_system"] for row in rows}
+    await s.run_sync(lambda sync: link_systems(sync.connection(), session_game_systems, "session_id", systems))
+
+
+async def measure(session: AsyncSession, filters: GameFilters, repeat: int) -> Dict[str, float]:
+    first, nxt = [], []
+    cursor = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        _, cursor = await get_open_games_page(session, filters=filters)
+        first.append((time.perf_counter() - started) * 1000)
+        if cursor is not None:
+            started = time.perf_counter()
+            await get_open_games_page(session, after=cursor, filters=filters)
+            nxt.append((time.perf_counter() - started) * 1000)
+    return {"first": statistics.median(first), "next": statistics.median(nxt) if nxt else float("nan")}
+
+
+async def main(sessions: int, masters: int, repeat: int, no_indexes: bool, explain: bool) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            # В бенчмарке нет таблицы players с игроками: FK session_players не проверяются
+            await conn.execute(text("PRAGMA foreign_keys = OFF"))
+        maker = async_sessionmaker(engine, expire_on_commit=False)
+
+        started = time.perf_counter()
+        await seed(maker, sessions, masters)
+        print(f"seeded {sessions} sessions in {time.perf_counter() - started:.1f}s")
+
+        async with engine.begin() as conn:
+            if no_indexes:
+                for index in Session.__table__.indexes:
+                    if index.name != "ix_sessions_open_title_id":
+                        await conn.execute(text(f"DROP INDEX {index.name}"))
+            await conn.execute(text("ANALYZE"))
+
+        async with maker() as session:
+            for name, filters in CASES:
+                r = await measure(session, filters, repeat)
+                print(f"{name:26} first={r['first']:7.2f}ms next={r['next']:7.2f}ms")
+                if explain:
+                    await _explain(session, filters)
+        await engine.dispose()
+
+
+async def _explain(session: AsyncSession, filters: GameFilters) -> None:
+    from sqlalchemy.dialects import sqlite
+    from bot.db import requests
+
+    captured = []
+    execute = session.execute
+
+    async def capture(stmt, *args, **kwargs):
+        captured.append(stmt)
+        return await execute(stmt, *args, **kwargs)
+
+    session.execute = capture  # type: ignore[method-assign]
+    try:
+        await requests.get_open_games_page(session, filters=filters)
+    finally:
+        session.execute = execute  # type: ignore[method-assign]
+    compiled = captured[0].compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True})
+    plan = await session.execute(text(f"EXPLAIN QUERY PLAN {compiled}"))
+    for row in plan:
+        print(f"    {row[-1]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=100_000)
+    parser.add_argument("--masters", type=int, default=2_000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--no-indexes", action="store_true")
+    parser.add_argument("--explain", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(main(args.sessions, args.masters, args.repeat, args.no_indexes, args.explain))
@@ -0,0 +1,80 @@
+# bot/benchmarks/lazy_session.py
+"""
+Сравнение DbSessionMiddleware до и после ленивой сессии.
+
+Прогоняет 1000 апдейтов (по умолчанию 30% ходят в БД) через middleware
+и считает созданные сессии и выдачи соединений из пула.
+
+Запуск: python -m bot.benchmarks.lazy_session [--updates 1000] [--db-share 0.3]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import time
+from typing import Any, Callable, Dict
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from bot.base.db_middleware import DbSessionMiddleware
+
+
+class EagerDbSessionMiddleware(DbSessionMiddleware):
+    """Прежнее поведение: новая AsyncSession на каждый апдейт."""
+
+    async def __call__(self, handler, event, data):
+        async with self._session_maker() as session:
+            data["db_session"] = session
+            return await handler(event, data)
+
+
+async def _db_handler(event: Any, data: Dict[str, Any]) -> None:
+    await data["db_session"].execute(text("SELECT 1"))
+
+
+async def _plain_handler(event: Any, data: Dict[str, Any]) -> None:
+    return None
+
+
+async def run(middleware_cls: Callable[..., DbSessionMiddleware], updates: int, db_share: float) -> Dict[str, Any]:
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    counters = {"checkouts": 0, "sessions": 0}
+
+    @event.listens_for(engine.sync_engine, "checkout")
+    def _on_checkout(*_):
+        counters["checkouts"] += 1
+
+    maker = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    def counting_maker() -> AsyncSession:
+        counters["sessions"] += 1
+        return maker()
+
+    middleware = middleware_cls(counting_maker)
+    rnd = random.Random(0)
+    handlers = [_db_handler if rnd.random() < db_share else _plain_handler for _ in range(updates)]
+
+    started = time.perf_counter()
+    for handler in handlers:
+        await middleware(handler, None, {})
+    elapsed = time.perf_counter() - started
+    await engine.dispose()
+
+    return {**counters, "db_updates": handlers.count(_db_handler), "ms": elapsed * 1000}
+
+
+async def main(updates: int, db_share: float) -> None:
+    for name, cls in (("before (eager)", EagerDbSessionMiddleware), ("after (lazy)", DbSessionMiddleware)):
+        r = await run(cls, updates, db_share)
+        print(f"{name:15} updates={updates} db_updates={r['db_updates']} "
+              f"sessions={r['sessions']} checkouts={r['checkouts']} time={r['ms']:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--db-share", type=float, default=0.3)
+    args = parser.parse_args()
+    asyncio.run(main(args.updates, args.db_share))
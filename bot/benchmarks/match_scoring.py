@@ -0,0 +1,98 @@
+# bot/benchmarks/match_scoring.py
+"""
+Время ранжирования открытых игр для игрока.
+
+Строит GameCandidates из синтетических игр (по умолчанию 100 000) и замеряет
+scores + top_k (медиана по повторам) в сравнении с той же оценкой в цикле на Python.
+Загрузка из БД не входит в замер — только оценка.
+
+Запуск: python -m bot.benchmarks.match_scoring [--candidates 100000] [--k 8] [--repeat 30]
+"""
+from __future__ import annotations
+
+import argparse
+import math
+import random
+import statistics
+import time
+from typing import Dict, List, Tuple
+
+from bot.db.recommendations import GameCandidates, PlayerProfile, SCORE_WEIGHTS, SEATS_SATURATION, TZ_SPAN
+
+SYSTEMS = [f"system {i}" for i in range(40)]
+
+
+def make_rows(n: int) -> List[Dict]:
+    rnd = random.Random(0)
+    return [
+        {
+            "id": i,
+            "format": rnd.randint(0, 1),
+            "game_system": rnd.choice(SYSTEMS),
+            "time_zone": rnd.choice([None] + list(range(-2, 13))),
+            "min_age": rnd.choice([None, None, 16, 18]),
+            "max_age": rnd.choice([None, None, 30, 50]),
+            "max_players": rnd.choice([None, 3, 4, 5, 6]),
+            "current_players": rnd.randint(0, 5),
+        }
+        for i in range(1, n + 1)
+    ]
+
+
+def python_top_k(rows: List[Dict], player: PlayerProfile, k: int) -> List[Tuple[int, float]]:
+    """Та же оценка построчно — точка отсчёта."""
+    w = SCORE_WEIGHTS
+    preferred = set(player.systems)
+    scored = []
+    for r in rows:
+        seats = None if r["max_players"] is None else r["max_players"] - r["current_players"]
+        if seats is not None and seats <= 0:
+            continue
+        if r["min_age"] is not None and r["min_age"] > player.age:
+            continue
+        if r["max_age"] is not None and r["max_age"] < player.age:
+            continue
+        score = w["format"] * bool((1 << r["format"]) & player.game_format)
+        score += w["system"] * ((r["game_system"] or "").lower() in preferred)
+        if r["time_zone"] is None:
+            score += w["time_zone"] * 0.5
+        else:
+            score += w["time_zone"] * min(max(1 - abs(r["time_zone"] - player.time_zone) / TZ_SPAN, 0), 1)
+        score += w["seats"] * (1.0 if seats is None else min(max(seats / SEATS_SATURATION, 0), 1))
+        scored.append((-score, r["id"]))
+    scored.sort()
+    return [(i, -s) for s, i in scored[:k]]
+
+
+def median_ms(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+def main(candidates: int, k: int, repeat: int) -> None:
+    rows = make_rows(candidates)
+    started = time.perf_counter()
+    games = GameCandidates.from_rows(rows)
+    print(f"built {len(games)} candidates in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    player = PlayerProfile(game_format=0b01, systems=("system 3", "system 7"), time_zone=3, age=17)
+    vectorized = games.top_k(player, k)
+    baseline = python_top_k(rows, player, k)
+    assert [i for i, _ in vectorized] == [i for i, _ in baseline]
+    assert all(math.isclose(a, b) for (_, a), (_, b) in zip(vectorized, baseline))
+
+    print(f"numpy  top_{k}: {median_ms(lambda: games.top_k(player, k), repeat):8.2f}ms")
+    print(f"python top_{k}: {median_ms(lambda: python_top_k(rows, player, k), max(3, repeat // 10)):8.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--candidates", type=int, default=100_000)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=30)
+    args = parser.parse_args()
+    main(args.candidates, args.k, args.repeat)
@@ -0,0 +1,99 @@
+# bot/benchmarks/profile_memory.py
+"""
+Память, которую занимают закэшированные профили пользователей.
+
+Заполняет SQLite-базу (по умолчанию 10 000 пользователей с профилями игрока и мастера),
+загружает их с профилем загрузки "profile" и через tracemalloc сравнивает, сколько памяти
+остаётся занятым, если держать:
+  orm       — сами ORM-объекты User с подгруженными Player/Master (их держали
+              прежние обёртки UserModel; вместе с ними живут InstanceState объектов);
+  snapshot  — снимки UserModel в кэше user_cache после закрытия сессии.
+
+Запуск: python -m bot.benchmarks.profile_memory [--users 10000]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import os
+import tempfile
+import tracemalloc
+from typing import Any, Callable, Awaitable
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from bot.db.base import Base, User, Player, Master
+from bot.db.cache import TTLCache
+from bot.db.models import UserModel
+from bot.db.requests import _load_options
+
+
+async def seed(maker: async_sessionmaker, users: int) -> None:
+    async with maker() as session:
+        await session.execute(insert(User), [
+            {"id": i, "telegram_id": 10_000_000 + i, "name": f"User {i}", "age": 18 + i % 40,
+             "city": f"Город {i % 50}", "time_zone": i % 12, "role": 3, "game_format": 1 + i % 3,
+             "preferred_systems": "D&D 5e, GURPS", "about_info": "Люблю долгие кампании"}
+            for i in range(1, users + 1)
+        ])
+        await session.execute(insert(Player), [
+            {"id": i, "experience_level": i % 3, "availability": "weekends"} for i in range(1, users + 1)
+        ])
+        await session.execute(insert(Master), [
+            {"id": i, "master_style": "Classic", "rating": i % 10} for i in range(1, users + 1)
+        ])
+        await session.commit()
+
+
+async def retained(build: Callable[[], Awaitable[Any]]) -> tuple[int, Any]:
+    """Байты, оставшиеся занятыми после build() и сборки мусора (результат удерживается)."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = await build()
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return size, kept
+
+
+async def main(users: int) -> None:
+    path = os.path.join(tempfile.mkdtemp(), "profiles.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    maker = async_sessionmaker(engine, expire_on_commit=False)
+    await seed(maker, users)
+    stmt = select(User).options(*_load_options(User, "profile")).order_by(User.id)
+
+    async def orm_rows():
+        async with maker() as session:
+            return (await session.execute(stmt)).scalars().unique().all()
+
+    async def snapshots():
+        cache = TTLCache("benchmark", maxsize=users, ttl=3600)
+        async with maker() as session:
+            for user in (await session.execute(stmt)).scalars().unique():
+                cache.set((user.telegram_id, "profile"), UserModel(user))
+        return cache
+
+    orm_size, rows = await retained(orm_rows)
+    assert len(rows) == users
+    del rows
+    snapshot_size, cache = await retained(snapshots)
+    assert len(cache) == users
+
+    print(f"profiles: {users}")
+    print(f"orm      {orm_size / 2 ** 20:8.2f} MiB  {orm_size / users:8.0f} B/profile")
+    print(f"snapshot {snapshot_size / 2 ** 20:8.2f} MiB  {snapshot_size / users:8.0f} B/profile")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.users))
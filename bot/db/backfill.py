@@ -0,0 +1,53 @@
+# bot/db/backfill.py
+"""
+Обновление схемы и заполнение производных таблиц по уже сохранённым данным —
+запускается один раз после обновления кода (дальше таблицы поддерживаются событиями маппера).
+
+    schema             недостающие таблицы, колонки и индексы (bot.db.schema.upgrade_schema)
+    game-systems       справочник game_systems и связи user_game_systems / session_game_systems
+                       из User.preferred_systems и Session.game_system
+    player-match-keys  player_match_keys по профилям игроков
+
+Схема обновляется перед любой командой. Повторный запуск безопасен.
+
+Запуск: python -m bot.db.backfill {schema,game-systems,player-match-keys,all} [--dsn postgresql://...]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from bot.base.db_middleware import normalize_async_dsn
+from bot.db.game_systems import backfill_game_systems
+from bot.db.player_features import rebuild_player_match_keys
+from bot.db.schema import upgrade_schema
+
+
+async def main(what: str, dsn: str) -> None:
+    engine = create_async_engine(normalize_async_dsn(dsn))
+    async with engine.begin() as conn:
+        created = await conn.run_sync(upgrade_schema)
+    for kind, names in created.items():
+        print(f"schema: {kind}: {', '.join(names) or '-'}")
+
+    maker = async_sessionmaker(engine, expire_on_commit=False)
+    async with maker() as session:
+        if what in ("game-systems", "all"):
+            counts = await backfill_game_systems(session)
+            print(f"game systems: {counts['users']} users, {counts['sessions']} games")
+        if what in ("player-match-keys", "all"):
+            print(f"player match keys: {await rebuild_player_match_keys(session)} rows")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("what", choices=["schema", "game-systems", "player-match-keys", "all"])
+    parser.add_argument("--dsn", default=os.environ.get("POSTGRES_DSN", ""))
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("--dsn or POSTGRES_DSN is required")
+    asyncio.run(main(args.what, args.dsn))
@@ -1,6 +1,6 @@
 from sqlalchemy import (
     Column, Integer, BigInteger, String, Text, DateTime,
-    ForeignKey, Boolean, Table
+    ForeignKey, Boolean, Table, Index, DDL, event, inspect, literal_column, select
 )
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.sql import func
@@ -13,6 +13,65 @@ session_players = Table(
     Base.metadata,
     Column("session_id", Integer, ForeignKey("sessions.id"), primary_key=True),
     Column("player_id", Integer, ForeignKey("players.id"), primary_key=True),
+    Index("ix_session_players_player_id", "player_id"),
+)
+
+# Заявки игроков на участие в играх (bot.db.requests.apply_to_game).
+# is_pending = True — заявка на рассмотрении, False — заявка отклонена (reject_request).
+# Принятая заявка (accept_request) удаляется отсюда и переезжает в session_players.
+session_requests = Table(
+    "session_requests",
+    Base.metadata,
+    Column("session_id", Integer, ForeignKey("sessions.id"), primary_key=True),
+    Column("player_id", Integer, ForeignKey("players.id"), primary_key=True),
+    Column("is_pending", Boolean, nullable=False, default=True),
+    Index("ix_session_requests_player_id", "player_id"),
+)
+
+# Признаки игроков для подбора под игру: строка на каждую пару (система, формат) игрока.
+# system_key — нормализованное название системы; "" — строка "любая система" для подбора
+# игроков без совпадения по системе. Поддерживается bot.db.player_features при изменении
+# профиля, поэтому подбор не разбирает User.preferred_systems на лету.
+player_match_keys = Table(
+    "player_match_keys",
+    Base.metadata,
+    Column("player_id", Integer, ForeignKey("players.id", ondelete="CASCADE"), primary_key=True),
+    Column("system_key", String, primary_key=True),
+    Column("format", Integer, primary_key=True),
+    Column("time_zone", Integer, nullable=False),
+    Column("experience_level", Integer, nullable=False),
+    Column("age", Integer, nullable=False),
+    # Корзина (система, формат, пояс) читается по индексу в порядке опыта
+    Index("ix_player_match_keys_bucket", "system_key", "format", "time_zone", "experience_level", "player_id"),
+)
+
+# Справочник игровых систем. key — название в нижнем регистре без лишних пробелов,
+# name — название, как его ввели впервые (для показа).
+game_systems = Table(
+    "game_systems",
+    Base.metadata,
+    Column("id", Integer, primary_key=True),
+    Column("key", String, nullable=False, unique=True),
+    Column("name", String, nullable=False),
+)
+
+# Системы пользователя (из User.preferred_systems) и игры (из Session.game_system).
+# Связи пересчитываются в bot.db.game_systems при изменении этих строк;
+# индекс (system_id, ...) — выборка "кто играет в систему X" и подсчёт популярности.
+user_game_systems = Table(
+    "user_game_systems",
+    Base.metadata,
+    Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+    Column("system_id", Integer, ForeignKey("game_systems.id", ondelete="CASCADE"), primary_key=True),
+    Index("ix_user_game_systems_system_id", "system_id", "user_id"),
+)
+
+session_game_systems = Table(
+    "session_game_systems",
+    Base.metadata,
+    Column("session_id", Integer, ForeignKey("sessions.id", ondelete="CASCADE"), primary_key=True),
+    Column("system_id", Integer, ForeignKey("game_systems.id", ondelete="CASCADE"), primary_key=True),
+    Index("ix_session_game_systems_system_id", "system_id", "session_id"),
 )
 
 
@@ -58,6 +117,29 @@ class Master(Base):
     sessions = relationship("Session", back_populates="master")
 
 
+def search_document(title, game_system, description):
+    """
+    tsvector игры для полнотекстового поиска (PostgreSQL, русская конфигурация).
+    Веса: A — название, B — система, C — описание.
+    Одно и то же выражение используется в индексе и в запросе, иначе индекс не подхватится.
+    """
+    def part(column, weight):
+        vector = func.to_tsvector(literal_column("'russian'"), func.coalesce(column, literal_column("''")))
+        return func.setweight(vector, literal_column(f"'{weight}'"))
+
+    return part(title, "A").op("||")(part(game_system, "B")).op("||")(part(description, "C"))
+
+
+def normalize_city(name):
+    """Ключ города для фильтра: регистр и лишние пробелы не важны (как system_key у систем)."""
+    return " ".join(name.split()).lower() if name else name
+
+
+def _city_key_default(context):
+    # Вычисляется и для INSERT через Core (массовая регистрация), и для ORM
+    return normalize_city(context.get_current_parameters().get("city"))
+
+
 class Session(Base):
     __tablename__ = "sessions"
 
@@ -70,9 +152,58 @@ class Session(Base):
     status = Column(Boolean, default=True)
     max_players = Column(Integer)
     looking_for = Column(Integer)
+    # Город игры; у игр без своего города — город создателя (_fill_session_city ниже).
+    # city_key — нормализованный город, по нему работает фильтр поиска
+    city = Column(String(100), nullable=False)
+    city_key = Column(String(100), nullable=False, default=_city_key_default)
+    is_paid = Column(Boolean, nullable=False, default=False)
+    min_age = Column(Integer)
+    max_age = Column(Integer)
     creator_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     master_id = Column(Integer, ForeignKey("masters.id"), nullable=True)
 
     creator = relationship("User", back_populates="sessions")
     master = relationship("Master", back_populates="sessions")
     players = relationship("Player", secondary=session_players, back_populates="sessions")
+
+    __table_args__ = (
+        # Ключ сортировки поиска открытых игр (keyset-пагинация по (title, id))
+        Index("ix_sessions_open_title_id", "title", "id",
+              postgresql_where=status.is_(True), sqlite_where=status.is_(True)),
+        # Частые сочетания фильтров поиска: равенства впереди, ключ сортировки (title, id) в конце,
+        # чтобы страница читалась из индекса без сортировки
+        # (фильтр по системам идёт через session_game_systems и его индекс по system_id)
+        Index("ix_sessions_open_format_city_key", "format", "city_key", "title", "id",
+              postgresql_where=status.is_(True), sqlite_where=status.is_(True)),
+        Index("ix_sessions_open_paid", "is_paid", "title", "id",
+              postgresql_where=status.is_(True), sqlite_where=status.is_(True)),
+        # Текстовый поиск: GIN по tsvector и триграммам pg_trgm, только в PostgreSQL
+        Index("ix_sessions_search_document", search_document(title, game_system, description),
+              postgresql_using="gin").ddl_if(dialect="postgresql"),
+        Index("ix_sessions_title_trgm", "title", postgresql_using="gin",
+              postgresql_ops={"title": "gin_trgm_ops"}).ddl_if(dialect="postgresql"),
+        Index("ix_sessions_game_system_trgm", "game_system", postgresql_using="gin",
+              postgresql_ops={"game_system": "gin_trgm_ops"}).ddl_if(dialect="postgresql"),
+    )
+
+
+@event.listens_for(Session, "before_insert")
+def _fill_session_city(mapper, connection, target: Session) -> None:
+    if not target.city:
+        creator = target.__dict__.get("creator")
+        target.city = creator.city if creator is not None else connection.execute(
+            select(User.city).where(User.id == target.creator_id)
+        ).scalar_one()
+
+
+@event.listens_for(Session, "before_update")
+def _update_session_city_key(mapper, connection, target: Session) -> None:
+    if inspect(target).attrs.city.history.has_changes():
+        if not target.city:
+            _fill_session_city(mapper, connection, target)
+        target.city_key = normalize_city(target.city)
+
+
+# Операторные классы gin_trgm_ops появляются с расширением pg_trgm
+PG_TRGM_EXTENSION = DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql")
+event.listen(Base.metadata, "before_create", PG_TRGM_EXTENSION)
@@ -0,0 +1,197 @@
+# bot/db/bulk.py
+"""
+Разбор строк для массовой регистрации (register_users_bulk / register_games_bulk).
+
+Строки приходят из CSV (все значения — строки) или JSONL (числа уже числа), поэтому
+значения приводятся к типам колонок здесь. Роли, форматы и уровень опыта принимаются
+и номерами/масками, и названиями ("Игрок, Мастер", "Онлайн", "Опыт2").
+Ошибка в строке — ValueError с понятным текстом; она попадает в отчёт, а не прерывает импорт.
+"""
+from __future__ import annotations
+
+import csv
+import datetime
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from bot.db.models import all_formats, all_roles, all_experience_levels
+
+PLAYER_FIELDS = ("experience_level", "availability")
+MASTER_FIELDS = ("master_style", "rating")
+
+_TRUE = {"1", "true", "yes", "да", "y", "t"}
+_FALSE = {"0", "false", "no", "нет", "n", "f"}
+
+
+@dataclass
+class BulkResult:
+    """Итог массовой регистрации: номер строки (с 0) -> id созданной записи или причина отказа."""
+    created: Dict[int, int] = field(default_factory=dict)
+    conflicts: Dict[int, str] = field(default_factory=dict)
+
+    @property
+    def ids(self) -> List[int]:
+        return [self.created[i] for i in sorted(self.created)]
+
+
+def _blank(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _required(row: Dict[str, Any], name: str) -> Any:
+    value = row.get(name)
+    if _blank(value):
+        raise ValueError(f"{name} is required")
+    return value.strip() if isinstance(value, str) else value
+
+
+def _optional_str(row: Dict[str, Any], name: str) -> Optional[str]:
+    value = row.get(name)
+    return None if _blank(value) else str(value).strip()
+
+
+def _int(row: Dict[str, Any], name: str, required: bool = True) -> Optional[int]:
+    value = row.get(name)
+    if _blank(value):
+        if required:
+            raise ValueError(f"{name} is required")
+        return None
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer, got {value!r}") from None
+
+
+def _bool(row: Dict[str, Any], name: str, default: bool) -> bool:
+    value = row.get(name)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if not text:
+        return default
+    if text in _TRUE:
+        return True
+    if text in _FALSE:
+        return False
+    raise ValueError(f"{name} must be a boolean, got {value!r}")
+
+
+def _index(row: Dict[str, Any], name: str, options: Sequence[str], required: bool = True) -> Optional[int]:
+    """Номер варианта: число или название из options."""
+    value = row.get(name)
+    if _blank(value):
+        if required:
+            raise ValueError(f"{name} is required")
+        return None
+    if isinstance(value, str) and value.strip() in options:
+        return options.index(value.strip())
+    index = _int(row, name)
+    if not 0 <= index < len(options):
+        raise ValueError(f"{name} must be one of {', '.join(options)}, got {value!r}")
+    return index
+
+
+def _mask(row: Dict[str, Any], name: str, options: Sequence[str]) -> int:
+    """Битовая маска: число или названия через запятую."""
+    value = _required(row, name)
+    if isinstance(value, str) and not value.lstrip("-").isdigit():
+        mask = 0
+        for part in value.split(","):
+            part = part.strip()
+            if part not in options:
+                raise ValueError(f"{name}: unknown value {part!r}")
+            mask |= 1 << options.index(part)
+        return mask
+    mask = _int(row, name)
+    if not 0 < mask < (1 << len(options)):
+        raise ValueError(f"{name} mask out of range: {value!r}")
+    return mask
+
+
+def _datetime(row: Dict[str, Any], name: str) -> datetime.datetime:
+    value = _required(row, name)
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO date-time, got {value!r}") from None
+
+
+def user_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Значения колонок users; ключи профилей игрока и мастера разбирают player_row / master_row."""
+    return {
+        "telegram_id": _int(row, "telegram_id"),
+        "name": _required(row, "name"),
+        "age": _int(row, "age"),
+        "city": _required(row, "city"),
+        "time_zone": _int(row, "time_zone"),
+        "role": _mask(row, "role", all_roles),
+        "game_format": _mask(row, "game_format", all_formats),
+        "preferred_systems": _optional_str(row, "preferred_systems") or "",
+        "about_info": _optional_str(row, "about_info"),
+    }
+
+
+def player_row(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Профиль игрока, если в строке есть его поля."""
+    if all(_blank(row.get(name)) for name in PLAYER_FIELDS):
+        return None
+    return {
+        "experience_level": _index(row, "experience_level", all_experience_levels, required=False) or 0,
+        "availability": _optional_str(row, "availability"),
+    }
+
+
+def master_row(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Профиль мастера, если в строке есть его поля."""
+    if all(_blank(row.get(name)) for name in MASTER_FIELDS):
+        return None
+    return {"master_style": _optional_str(row, "master_style"), "rating": _int(row, "rating", required=False)}
+
+
+def game_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Значения колонок sessions. Создатель — creator_id или creator_telegram_id
+    (во втором случае creator_id подставляет register_games_bulk).
+    """
+    data = {
+        "title": _required(row, "title"),
+        "description": _optional_str(row, "description"),
+        "game_system": _optional_str(row, "game_system"),
+        "date_time": _datetime(row, "date_time"),
+        "format": _index(row, "format", all_formats),
+        "status": _bool(row, "status", default=True),
+        "max_players": _int(row, "max_players", required=False),
+        "looking_for": _index(row, "looking_for", all_roles),
+        "city": _optional_str(row, "city"),
+        "is_paid": _bool(row, "is_paid", default=False),
+        "min_age": _int(row, "min_age", required=False),
+        "max_age": _int(row, "max_age", required=False),
+        "creator_id": _int(row, "creator_id", required=False),
+    }
+    if data["creator_id"] is None:
+        data["creator_telegram_id"] = _int(row, "creator_telegram_id")
+    game_id = _int(row, "id", required=False)
+    if game_id is not None:
+        data["id"] = game_id
+    return data
+
+
+def read_rows(path: str, fmt: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """Строки из CSV (с заголовком) или JSONL; формат — по расширению, если не указан."""
+    fmt = fmt or ("jsonl" if path.endswith((".jsonl", ".ndjson", ".json")) else "csv")
+    with open(path, encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            yield from csv.DictReader(f)
+        elif fmt == "jsonl":
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError(f"Unknown format: {fmt}")
@@ -0,0 +1,63 @@
+# bot/db/bulk_import.py
+"""
+Импорт пользователей или игр из CSV (с заголовком) или JSONL.
+
+Колонки пользователей: telegram_id, name, age, city, time_zone, role, game_format,
+preferred_systems, about_info; для профиля игрока — experience_level, availability;
+для профиля мастера — master_style, rating. Роли и форматы — маски или названия
+("Игрок, Мастер"), уровень опыта — номер или название.
+
+Колонки игр: id (необязательно), title, description, game_system, date_time (ISO),
+format, status, max_players, looking_for, city, is_paid, min_age, max_age,
+creator_id или creator_telegram_id.
+
+Отклонённые строки печатаются в stderr с номером (с 1, без заголовка CSV); повторный
+запуск безопасен — уже зарегистрированные пользователи и игры с тем же id пропускаются.
+Код выхода ненулевой только при ошибке импорта, а с --strict — и при отклонённых строках.
+
+Запуск: python -m bot.db.bulk_import {users,games} FILE [--format csv|jsonl] [--dsn postgresql://...] [--strict]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from bot.base.db_middleware import normalize_async_dsn
+from bot.db.bulk import read_rows
+from bot.db.requests import BULK_BATCH_SIZE, register_users_bulk, register_games_bulk
+
+
+async def main(kind: str, path: str, fmt: str, dsn: str, batch_size: int, strict: bool = False) -> int:
+    engine = create_async_engine(normalize_async_dsn(dsn))
+    maker = async_sessionmaker(engine, expire_on_commit=False)
+    register = register_users_bulk if kind == "users" else register_games_bulk
+
+    started = time.perf_counter()
+    async with maker() as session:
+        result = await register(read_rows(path, fmt), session, batch_size=batch_size)
+    await engine.dispose()
+
+    for i in sorted(result.conflicts):
+        print(f"row {i + 1}: {result.conflicts[i]}", file=sys.stderr)
+    print(f"{kind}: {len(result.created)} created, {len(result.conflicts)} rejected "
+          f"in {time.perf_counter() - started:.1f}s")
+    return 1 if strict and result.conflicts else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("kind", choices=["users", "games"])
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default=None)
+    parser.add_argument("--dsn", default=os.environ.get("POSTGRES_DSN", ""))
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    parser.add_argument("--strict", action="store_true", help="код выхода 1, если есть отклонённые строки")
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("--dsn or POSTGRES_DSN is required")
+    raise SystemExit(asyncio.run(main(args.kind, args.path, args.format, args.dsn, args.batch_size, args.strict)))
@@ -0,0 +1,125 @@
+# bot/db/cache.py
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class CacheStats:
+    """
+    Куда TTLCache сообщает о попаданиях, промахах и вытеснениях. По умолчанию — никуда:
+    слой db не зависит от bot.base, счётчики Prometheus подключает
+    bot.base.metrics.observe_caches() при запуске бота.
+    """
+
+    def hit(self, cache: str) -> None:
+        pass
+
+    def miss(self, cache: str) -> None:
+        pass
+
+    def evicted(self, cache: str, reason: str) -> None:
+        pass
+
+    def size(self, cache: str, size: int) -> None:
+        pass
+
+
+_stats = CacheStats()
+
+
+def set_cache_stats(stats: CacheStats) -> None:
+    global _stats
+    _stats = stats
+
+
+class TTLCache(Generic[V]):
+    """
+    Ограниченный LRU-кэш в памяти процесса со сроком жизни записей.
+    При переполнении вытесняется запись, которую дольше всех не читали;
+    просроченная запись удаляется при обращении к ней.
+
+    Чтение из БД и запись результата в кэш не атомарны: пока читатель ждёт строку,
+    запись могут инвалидировать (pop/clear), и старый снимок вернулся бы в кэш на весь ttl.
+    Поэтому читатель берёт token() до запроса и передаёт его в set(): если ключ
+    инвалидировали после token(), значение не кэшируется.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data: OrderedDict[Hashable, Tuple[float, V]] = OrderedDict()
+        # Номер последней инвалидации по ключу; старые номера забываются сверх maxsize,
+        # и тогда токены не новее _forgotten считаются устаревшими для любого ключа
+        self._epoch = 0
+        self._invalidated: OrderedDict[Hashable, int] = OrderedDict()
+        self._forgotten = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > self._clock()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        entry = self._data.get(key)
+        if entry is not None and entry[0] <= self._clock():
+            self._drop(key, "expired")
+            entry = None
+        if entry is None:
+            self.misses += 1
+            _stats.miss(self.name)
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        _stats.hit(self.name)
+        return entry[1]
+
+    def token(self) -> int:
+        return self._epoch
+
+    def set(self, key: Hashable, value: V, token: Optional[int] = None) -> None:
+        if token is not None and (token < self._forgotten or token < self._invalidated.get(key, 0)):
+            return
+        self._data[key] = (self._clock() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._drop(next(iter(self._data)), "size")
+        _stats.size(self.name, len(self._data))
+
+    def pop(self, key: Hashable) -> None:
+        self._epoch += 1
+        self._invalidated[key] = self._epoch
+        self._invalidated.move_to_end(key)
+        while len(self._invalidated) > self.maxsize:
+            _, self._forgotten = self._invalidated.popitem(last=False)
+        if key in self._data:
+            self._drop(key, "invalidated")
+
+    def clear(self) -> None:
+        self._epoch += 1
+        self._forgotten = self._epoch
+        self._invalidated.clear()
+        self._data.clear()
+        self.hits = self.misses = 0
+        _stats.size(self.name, 0)
+
+    def _drop(self, key: Hashable, reason: str) -> None:
+        del self._data[key]
+        _stats.evicted(self.name, reason)
+        _stats.size(self.name, len(self._data))
+
+    def stats(self) -> dict[str, Any]:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0}
@@ -3,27 +3,46 @@
 
 from __future__ import annotations
 
+import functools
 import logging
-from typing import Any, Dict, List, Optional
-from sqlalchemy import text
+from typing import Any, Dict, List, Optional, Sequence
 
 from aiogram_dialog import DialogManager
 from sqlalchemy.ext.asyncio import AsyncSession
 
 # Adjust these imports to your package layout if needed
-from bot.db.models import UserModel, SessionModel, PlayerModel, MasterModel  # type: ignore
+from bot.db.models import UserModel, SessionModel, MasterModel, all_formats  # type: ignore
+from bot.db.game_filters import GameFilters
+from bot.db.lazy_session import LazySession
+from bot.db.popular_systems import popular_systems_cache
 from bot.db.requests import (
+    OPEN_GAMES_PAGE_SIZE,
     get_user_model,
-    get_game_model,
+    get_master_model,
+    get_player_games_overview,
+    get_user_systems,
+    find_players_for_game,
+    get_game_requests,
+    accept_request,
+    reject_request,
+    get_open_games_page,
+    search_open_games,
+    recommend_games,
 )  # type: ignore
 
+REQUEST_STATUS_TITLES = {
+    "accepted": "Заявка принята",
+    "pending": "Заявка находится на рассмотрении",
+    "rejected": "Заявка отклонена",
+}
+
 
 def _extract_session(dialog_manager: DialogManager, **kwargs) -> AsyncSession:
     sess: Optional[AsyncSession] = kwargs.get("session")
     if sess is None:
         md = getattr(dialog_manager, "middleware_data", {}) or {}
         for key in ("session", "db", "db_session"):
-            if key in md and isinstance(md[key], AsyncSession):
+            if key in md and isinstance(md[key], (AsyncSession, LazySession)):
                 sess = md[key]  # type: ignore[assignment]
                 break
     if sess is None:
@@ -40,6 +59,28 @@ def _current_tg_id(dialog_manager: DialogManager) -> int:
         raise RuntimeError("Cannot resolve Telegram user id from dialog_manager.event") from e
 
 
+def _player_game_brief(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "status": REQUEST_STATUS_TITLES[row["request_status"]],
+        "title": row["title"] or "",
+        "system": row["game_system"] or "",
+    }
+
+
+def _open_game_brief(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "title": row["title"] or "Без названия",
+        "system": row["game_system"] or "—",
+        "format": all_formats[row["format"]] if row["format"] is not None else "—",
+        "city": row["city"] or "—",
+        "master_name": row["master_name"] or "—",
+        "current_players": row["current_players"],
+        "max_players": row["max_players"] if row["max_players"] is not None else "—",
+    }
+
+
 async def get_user_general(dialog_manager: DialogManager, **kwargs) -> Dict[str, Any]:
     session = _extract_session(dialog_manager, **kwargs)
     tg_id = _current_tg_id(dialog_manager)
@@ -69,24 +110,15 @@ async def get_user_player(dialog_manager: DialogManager, **kwargs) -> Dict[str,
         return {"experience": "", "payment": "", "systems": [], "games": [], "archive": [], "rating": 0, "reviews": {}}
 
     p = user.player_profile
-
-    # preferred_systems у UserModel — строка; превратим в список
-    try:
-        systems = [s.strip() for s in (user.preferred_systems or "").split(",") if s.strip()]
-    except Exception:
-        systems = []
-
-    games_brief: List[Dict[str, str]] = [{"status": s.status or "", "title": s.title or ""} for s in p.games]
-    archive_brief: List[Dict[str, str]] = [{"status": s.status or "", "title": s.title or ""} for s in p.archive]
-
+    # Игры и архив игрока отдают get_player_games / get_player_archive
     return {
-        "experience": p.experience or "",
-        "payment": p.payment or "",
-        "systems": systems,
-        "games": games_brief,
-        "archive": archive_brief,
-        "rating": int(p.rating) if p.rating is not None else 0,
-        "reviews": p.reviews or {},
+        "experience": p.experience_level or "",
+        "payment": p.availability or "",
+        "systems": await get_user_systems(session, tg_id),
+        "games": [],
+        "archive": [],
+        "rating": 0,
+        "reviews": {},
     }
 
 
@@ -123,149 +155,139 @@ async def get_player_games(dialog_manager: DialogManager, **kwargs) -> Dict[str,
     session = _extract_session(dialog_manager, **kwargs)
     tg_id = _current_tg_id(dialog_manager)
 
-    user: Optional[UserModel] = await get_user_model(session, tg_id)
-    if not user or not user.player_profile:
-        return {"games": []}
-
-    result: List[Dict[str, str]] = []
-    for s in user.player_profile.games:
-        # при желании можно дообновить запись из БД
-        try:
-            db_game = await get_game_model(session, s.id)
-        except Exception:
-            db_game = None
-        session_model = db_game or s
-
-        in_players = any(getattr(p, "telegram_id", None) == tg_id for p in session_model.players)
-        try:
-            in_requests = any(getattr(r, "telegram_id", None) == tg_id for r in session_model.requests)  # если есть relation
-        except Exception:
-            in_requests = False
-
-        if in_players:
-            status = "Заявка принята"
-        elif in_requests:
-            status = "Заявка находится на рассмотрении"
-        else:
-            status = "Заявка отклонена"
+    rows = await get_player_games_overview(session, tg_id)
+    return {"games": [_player_game_brief(r) for r in rows]}
 
-        result.append({"status": status, "title": session_model.title or ""})
 
-    return {"games": result}
+def _master_game_brief(game: SessionModel) -> Dict[str, Any]:
+    return {
+        "id": game.id,
+        "status": "Открыта" if game.status else "Завершена",
+        "title": game.title or "",
+        "system": game.game_system or "",
+        "format": game.format,
+        "city": game.city or "",
+        "description": game.description or "",
+    }
 
 
-async def get_master_games(dialog_manager: DialogManager, **kwargs) -> Dict[str, Any]:
+async def _master_games(dialog_manager: DialogManager, archived: bool, **kwargs) -> Dict[str, Any]:
     session = _extract_session(dialog_manager, **kwargs)
     tg_id = _current_tg_id(dialog_manager)
 
-    user: Optional[UserModel] = await get_user_model(session, tg_id)
-    if not user or not user.master_profile:
+    master: Optional[MasterModel] = await get_master_model(session, tg_id, profile="profile+games")
+    if not master:
         return {"games": []}
+    return {"games": [_master_game_brief(s) for s in master.sessions if bool(s.status) != archived]}
+
 
-    return {"games": [{"status": s.status or "", "title": s.title or ""} for s in user.master_profile.games]}
+async def get_master_games(dialog_manager: DialogManager, **kwargs) -> Dict[str, Any]:
+    return await _master_games(dialog_manager, archived=False, **kwargs)
 
 
 async def get_player_archive(dialog_manager: DialogManager, **kwargs) -> Dict[str, Any]:
     session = _extract_session(dialog_manager, **kwargs)
     tg_id = _current_tg_id(dialog_manager)
 
-    user: Optional[UserModel] = await get_user_model(session, tg_id)
-    if not user or not user.player_profile:
-        return {"games": []}
+    rows = await get_player_games_overview(session, tg_id, archived=True)
+    return {"games": [_player_game_brief(r) for r in rows]}
 
-    result: List[Dict[str, str]] = []
-    for s in user.player_profile.archive:
-        in_players = any(getattr(p, "telegram_id", None) == tg_id for p in s.players)
-        try:
-            in_requests = any(getattr(r, "telegram_id", None) == tg_id for r in s.requests)
-        except Exception:
-            in_requests = False
 
-        if in_players:
-            status = "Заявка принята"
-        elif in_requests:
-            status = "Заявка находится на рассмотрении"
-        else:
-            status = "Заявка отклонена"
+async def get_master_archive(dialog_manager: DialogManager, **kwargs) -> Dict[str, Any]:
+    return await _master_games(dialog_manager, archived=True, **kwargs)
+
 
-        result.append({"status": status, "title": s.title or ""})
+async def get_players_for_game(
+    dialog_manager: DialogManager,
+    game_id: int,
+    *,
+    session: Optional[AsyncSession] = None,
+    limit: int = 10,
+) -> Dict[str, Any]:
+    """Players that fit the master's game best (see find_players_for_game)."""
+    sess: AsyncSession = session or _extract_session(dialog_manager)
+    rows = await find_players_for_game(sess, game_id, limit=limit)
+    return {"players": rows}
 
-    return {"games": result}
 
+async def get_requests_for_game(
+    dialog_manager: DialogManager,
+    game_id: int,
+    *,
+    session: Optional[AsyncSession] = None,
+) -> Dict[str, Any]:
+    """Join requests still waiting for the master's decision."""
+    sess: AsyncSession = session or _extract_session(dialog_manager)
+    return {"requests": await get_game_requests(sess, game_id)}
 
-async def get_master_archive(dialog_manager: DialogManager, **kwargs) -> Dict[str, Any]:
-    session = _extract_session(dialog_manager, **kwargs)
-    tg_id = _current_tg_id(dialog_manager)
 
-    user: Optional[UserModel] = await get_user_model(session, tg_id)
-    if not user or not user.master_profile:
-        return {"games": []}
+async def decide_request(
+    dialog_manager: DialogManager,
+    game_id: int,
+    player_id: int,
+    accept: bool,
+    *,
+    session: Optional[AsyncSession] = None,
+) -> str:
+    """
+    Accepts or rejects a pending request.
+    Returns "accepted", "rejected", "full" (no free seat, the request stays pending)
+    or "missing" (it was already decided).
+    """
+    sess: AsyncSession = session or _extract_session(dialog_manager)
+    if accept:
+        return await accept_request(sess, game_id, player_id)
+    return "rejected" if await reject_request(sess, game_id, player_id) else "missing"
 
-    return {"games": [{"status": s.status or "", "title": s.title or ""} for s in user.master_profile.archive]}
 
 async def get_open_games(
     dialog_manager: DialogManager,
     *,
     session: Optional[AsyncSession] = None,
-    limit: int = 100,
-) -> Sequence[Dict[str, Any]]:
+    after: Optional[Sequence[Any]] = None,
+    limit: int = OPEN_GAMES_PAGE_SIZE,
+    filters: Optional[GameFilters] = None,
+    query: Optional[str] = None,
+) -> Dict[str, Any]:
     """
-    Load open games from DB for the search dialog.
-
-    Returns a list of dicts like:
-    {
-        "id": 123,
-        "title": "Some title",
-        "system": "D&D 5e",
-        "format": "online",
-        "place": "Roll20/Discord",
-        "cost": "Free",
-        "description": "...",
-        "master_name": "Alice",
-        "players": [],   # fill if you want; empty list is fine
-    }
+    One page of open games for the search dialog, sorted by title,
+    or by relevance when a text `query` is given.
+
+    `after` is the cursor returned for the previous page (None for the first one).
+    `filters` narrows the search; they are applied in the same SQL query.
+    Returns {"games": [...], "next_cursor": [title, id] or None}; the cursor is a list
+    so it can be stored in dialog_data as is.
     """
     sess: AsyncSession = session or _extract_session(dialog_manager)
 
-    # Grab basic game info + master's display name if available
-    q = text(
-        """
-        SELECT
-            g.id,
-            g.title,
-            COALESCE(g.system, '')      AS system,
-            COALESCE(g.format, '')      AS format,
-            COALESCE(g.place, '')       AS place,
-            COALESCE(g.cost, '')        AS cost,
-            COALESCE(g.description, '') AS description,
-            COALESCE(u.name, '')        AS master_name
-        FROM games AS g
-        LEFT JOIN users AS u ON u.id = g.master_user_id
-        WHERE g.is_open = TRUE
-        ORDER BY g.created_at DESC
-        LIMIT :limit
-        """
+    load_page = get_open_games_page
+    if query and query.strip():
+        load_page = functools.partial(search_open_games, query=query)
+    rows, next_cursor = await load_page(
+        sess, after=tuple(after) if after is not None else None, limit=limit, filters=filters
     )
-    res = await sess.execute(q, {"limit": limit})
-    rows = res.mappings().all()
-
-    # You can enrich with players list here if needed.
-    games: List[Dict[str, Any]] = []
-    for r in rows:
-        games.append(
-            {
-                "id": r["id"],
-                "title": r["title"] or "Без названия",
-                "system": r["system"] or "—",
-                "format": r["format"] or "—",
-                "place": r["place"] or "—",
-                "cost": r["cost"] or "—",
-                "description": r["description"] or "",
-                "master_name": r["master_name"] or "—",
-                "players": [],
-            }
-        )
-    return games
+    return {
+        "games": [_open_game_brief(r) for r in rows],
+        "next_cursor": list(next_cursor) if next_cursor else None,
+    }
+
+
+async def get_recommended_games(
+    dialog_manager: DialogManager,
+    *,
+    session: Optional[AsyncSession] = None,
+    limit: int = OPEN_GAMES_PAGE_SIZE,
+    filters: Optional[GameFilters] = None,
+) -> Dict[str, Any]:
+    """Open games that fit the current user's profile best, best first."""
+    sess: AsyncSession = session or _extract_session(dialog_manager)
+    rows = await recommend_games(sess, _current_tg_id(dialog_manager), k=limit, filters=filters)
+    return {"games": [_open_game_brief(r) for r in rows]}
 
 # Backward-compat alias (so older imports still work)
-open_games = get_open_games
\ No newline at end of file
+open_games = get_open_games
+
+
+def get_popular_systems(dialog_manager: Optional[DialogManager] = None, **kwargs) -> List[Dict[str, Any]]:
+    """Популярные системы [{"id", "name"}] для кнопок форм — из памяти, без запроса к БД."""
+    return popular_systems_cache.items()
@@ -0,0 +1,99 @@
+# bot/db/game_filters.py
+from __future__ import annotations
+
+from dataclasses import asdict, dataclass, replace
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from sqlalchemy import ColumnElement, exists, func, or_, select
+
+from bot.db.base import User, Session, session_players, game_systems, session_game_systems, normalize_city
+from bot.db.game_systems import system_key
+from bot.db.models import all_formats
+
+
+@dataclass(frozen=True)
+class GameFilters:
+    """
+    Фильтры поиска открытых игр. None / пустое значение — фильтр не задан.
+
+    systems    — подходящие игровые системы (любая из них, без учёта регистра и лишних пробелов);
+    format     — индекс в all_formats;
+    city       — город проведения игры (без учёта регистра и лишних пробелов);
+    time_zone  — часовой пояс игрока, игры мастеров в пределах ±tz_window часов;
+    is_paid    — True только платные, False только бесплатные;
+    age        — возраст игрока, игры с подходящими min_age/max_age;
+    free_seats — только игры, где есть свободные места.
+    """
+    systems: Tuple[str, ...] = ()
+    format: Optional[int] = None
+    city: Optional[str] = None
+    time_zone: Optional[int] = None
+    tz_window: int = 0
+    is_paid: Optional[bool] = None
+    age: Optional[int] = None
+    free_seats: bool = False
+
+    def __post_init__(self):
+        if self.format is not None and not 0 <= self.format < len(all_formats):
+            raise ValueError(f"Invalid format: {self.format}")
+        if self.tz_window < 0:
+            raise ValueError("tz_window must be non-negative")
+        # Пустые строки из ввода пользователя фильтром не считаются
+        systems = tuple(s.strip() for s in self.systems if s and s.strip())
+        object.__setattr__(self, "systems", systems)
+        object.__setattr__(self, "city", (self.city or "").strip() or None)
+
+    @property
+    def is_empty(self) -> bool:
+        return self == GameFilters()
+
+    def conditions(self) -> List[ColumnElement[bool]]:
+        """Условия WHERE для запроса по Session, соединённому с создателем игры (User)."""
+        conditions: List[ColumnElement[bool]] = []
+        if self.systems:
+            # Системы игры — связи session_game_systems по ключам справочника game_systems
+            # (EXISTS по первичному ключу связи: страница читается в порядке (title, id) без сортировки)
+            keys = sorted({system_key(s) for s in self.systems})
+            system_ids = select(game_systems.c.id).where(game_systems.c.key.in_(keys))
+            conditions.append(exists().where(session_game_systems.c.session_id == Session.id,
+                                             session_game_systems.c.system_id.in_(system_ids)))
+        if self.format is not None:
+            conditions.append(Session.format == self.format)
+        if self.city is not None:
+            conditions.append(Session.city_key == normalize_city(self.city))
+        if self.time_zone is not None:
+            conditions.append(User.time_zone.between(self.time_zone - self.tz_window,
+                                                     self.time_zone + self.tz_window))
+        if self.is_paid is not None:
+            conditions.append(Session.is_paid.is_(self.is_paid))
+        if self.age is not None:
+            conditions.append(or_(Session.min_age.is_(None), Session.min_age <= self.age))
+            conditions.append(or_(Session.max_age.is_(None), Session.max_age >= self.age))
+        if self.free_seats:
+            taken = (
+                select(func.count())
+                .where(session_players.c.session_id == Session.id)
+                .correlate(Session)
+                .scalar_subquery()
+            )
+            conditions.append(or_(Session.max_players.is_(None), taken < Session.max_players))
+        return conditions
+
+    def with_changes(self, **changes: Any) -> GameFilters:
+        return replace(self, **changes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Только заданные фильтры, в виде, пригодном для dialog_data."""
+        data = asdict(self)
+        data["systems"] = list(self.systems)
+        default = asdict(GameFilters())
+        default["systems"] = []
+        return {k: v for k, v in data.items() if v != default[k]}
+
+    @classmethod
+    def from_dict(cls, data: Optional[Mapping[str, Any]]) -> GameFilters:
+        if not data:
+            return cls()
+        data = dict(data)
+        data["systems"] = tuple(data.get("systems") or ())
+        return cls(**data)
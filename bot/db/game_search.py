@@ -0,0 +1,194 @@
+# bot/db/game_search.py
+from __future__ import annotations
+
+import re
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+# Разговорные названия систем -> как они пишутся в играх.
+# Применяется к запросу: "днд 5" ищет и "днд", и "dnd", и "D&D".
+SEARCH_SYNONYMS: Dict[str, Tuple[str, ...]] = {
+    "днд": ("dnd", "d&d"),
+    "dnd": ("d&d",),
+    "ктулху": ("cthulhu",),
+    "пасфайндер": ("pathfinder",),
+    "патфайндер": ("pathfinder",),
+    "вампиры": ("vampire",),
+    "вампир": ("vampire",),
+    "киберпанк": ("cyberpunk",),
+    "шедоуран": ("shadowrun",),
+    "шадоуран": ("shadowrun",),
+    "вархаммер": ("warhammer",),
+    "гурпс": ("gurps",),
+}
+
+# Веса полей как у setweight в PostgreSQL: A — название, B — система, C — описание
+FIELD_WEIGHTS: Dict[str, float] = {"title": 1.0, "game_system": 0.4, "description": 0.2}
+
+# Порог word_similarity, как pg_trgm.word_similarity_threshold по умолчанию
+WORD_SIMILARITY_THRESHOLD = 0.6
+
+_WORD = re.compile(r"[0-9a-zа-я]+")
+# Окончания, которые отбрасывает упрощённый стеммер (длинные — раньше коротких)
+_RU_ENDINGS = sorted(
+    ("ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ая", "яя", "ое", "ее", "ые", "ие",
+     "ия", "ии", "ий", "ию", "ье", "ья", "ью", "ой", "ей", "ом", "ем", "ам", "ям", "ах", "ях", "ов", "ев",
+     "ы", "и", "а", "я", "о", "е", "у", "ю"),
+    key=len, reverse=True,
+)
+
+
+def normalize(value: Optional[str]) -> str:
+    return (value or "").lower().replace("ё", "е")
+
+
+def words(value: Optional[str]) -> List[str]:
+    return _WORD.findall(normalize(value))
+
+
+def stem(word: str) -> str:
+    """Упрощённый стеммер для русских слов: отрезает типичное окончание у слов длиннее 4 букв."""
+    if len(word) > 4 and "а" <= word[-1] <= "я":
+        for ending in _RU_ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 3:
+                return word[: -len(ending)]
+    return word
+
+
+def parse_query(query: str) -> List[Tuple[Tuple[str, ...], ...]]:
+    """
+    Запрос -> группы вариантов, по группе на слово запроса.
+    Вариант — последовательность основ слов (фраза), например "d&d" -> ("d", "d").
+    Игра подходит, если для каждой группы в ней нашёлся хотя бы один вариант.
+    """
+    groups: List[Tuple[Tuple[str, ...], ...]] = []
+    for raw in normalize(query).split():
+        variants: List[Tuple[str, ...]] = []
+        for alternative in (raw,) + SEARCH_SYNONYMS.get(raw, ()):
+            phrase = tuple(stem(w) for w in words(alternative))
+            if phrase and phrase not in variants:
+                variants.append(phrase)
+        if variants:
+            groups.append(tuple(variants))
+    return groups
+
+
+def to_tsquery_text(groups: List[Tuple[Tuple[str, ...], ...]]) -> str:
+    """
+    Текст для to_tsquery: группы через &, варианты через |, слова фразы через <->,
+    каждое слово с :* (префиксный поиск — пользователь мог не допечатать слово).
+    Слова состоят только из букв и цифр, поэтому экранирование не нужно.
+    """
+    def phrase(p: Tuple[str, ...]) -> str:
+        text = " <-> ".join(f"{w}:*" for w in p)
+        return f"({text})" if len(p) > 1 else text
+
+    return " & ".join("(" + " | ".join(phrase(p) for p in group) + ")" for group in groups)
+
+
+def query_variants(query: str) -> List[str]:
+    """Запрос и его варианты с подставленными синонимами — для триграммного сравнения."""
+    raw = normalize(query).split()
+    variants = [" ".join(raw)]
+    for i, w in enumerate(raw):
+        for alternative in SEARCH_SYNONYMS.get(w, ()):
+            variant = " ".join(raw[:i] + [alternative] + raw[i + 1:])
+            if variant not in variants:
+                variants.append(variant)
+    return variants
+
+
+def trigrams(value: Optional[str]) -> Set[str]:
+    """Триграммы как в pg_trgm: каждое слово дополняется двумя пробелами слева и одним справа."""
+    result: Set[str] = set()
+    for w in words(value):
+        padded = f"  {w} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def word_similarity(query: str, value: Optional[str]) -> float:
+    """
+    Доля триграмм запроса, найденных в тексте — приближение pg_trgm.word_similarity
+    (сверху: pg_trgm требует, чтобы совпадения шли одним отрезком текста).
+    """
+    query_trigrams = trigrams(query)
+    if not query_trigrams:
+        return 0.0
+    return len(query_trigrams & trigrams(value)) / len(query_trigrams)
+
+
+class SearchHit(NamedTuple):
+    id: int
+    rank: float
+
+
+class GameSearchIndex:
+    """
+    Поисковый индекс игр в памяти — замена tsvector + pg_trgm, когда БД не PostgreSQL.
+    Ранжирование повторяет запрос для PostgreSQL: вес лучшего поля для каждого слова
+    запроса (как ts_rank с setweight) плюс лучшая word_similarity по названию и системе.
+    """
+
+    def __init__(self):
+        self._fields: Dict[int, Dict[str, List[str]]] = {}
+        self._raw: Dict[int, Tuple[str, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    def add(self, game_id: int, title: Optional[str], game_system: Optional[str],
+            description: Optional[str]) -> None:
+        self._fields[game_id] = {
+            "title": [stem(w) for w in words(title)],
+            "game_system": [stem(w) for w in words(game_system)],
+            "description": [stem(w) for w in words(description)],
+        }
+        self._raw[game_id] = (title or "", game_system or "")
+
+    def remove(self, game_id: int) -> None:
+        self._fields.pop(game_id, None)
+        self._raw.pop(game_id, None)
+
+    @staticmethod
+    def _phrase_in(phrase: Tuple[str, ...], tokens: List[str]) -> bool:
+        n = len(phrase)
+        return any(
+            all(tokens[i + j].startswith(phrase[j]) for j in range(n))
+            for i in range(len(tokens) - n + 1)
+        )
+
+    def _text_rank(self, groups: List[Tuple[Tuple[str, ...], ...]], fields: Dict[str, List[str]]) -> float:
+        total = 0.0
+        for group in groups:
+            best = max(
+                (weight for name, weight in FIELD_WEIGHTS.items()
+                 if any(self._phrase_in(p, fields[name]) for p in group)),
+                default=None,
+            )
+            if best is None:
+                return 0.0
+            total += best
+        return total / len(groups)
+
+    def search(self, query: str, ids: Optional[Iterable[int]] = None) -> List[SearchHit]:
+        """
+        Игры, подходящие под запрос, по убыванию релевантности (при равенстве — по id).
+        ids ограничивает поиск этими играми (например, прошедшими фильтры).
+        """
+        groups = parse_query(query)
+        variants = query_variants(query)
+        if not groups:
+            return []
+
+        hits: List[SearchHit] = []
+        for game_id in (self._fields if ids is None else ids):
+            fields = self._fields.get(game_id)
+            if fields is None:
+                continue
+            text_rank = self._text_rank(groups, fields)
+            title, game_system = self._raw[game_id]
+            similarity = max(max(word_similarity(v, title), word_similarity(v, game_system)) for v in variants)
+            if text_rank > 0 or similarity >= WORD_SIMILARITY_THRESHOLD:
+                hits.append(SearchHit(game_id, round(text_rank + similarity, 6)))
+        hits.sort(key=lambda h: (-h.rank, h.id))
+        return hits
@@ -0,0 +1,154 @@
+# bot/db/game_systems.py
+"""
+Справочник игровых систем game_systems и связи user_game_systems / session_game_systems.
+
+User.preferred_systems и Session.game_system остаются строками для показа, а связи
+пересчитываются в том же flush, в котором эти поля меняются (события маппера),
+поэтому запросы "кто играет в систему X" и популярность систем идут по индексам.
+backfill_game_systems заполняет справочник и связи по уже сохранённым строкам.
+"""
+from __future__ import annotations
+
+from typing import Dict, List, Optional
+
+from sqlalchemy import Connection, Table, delete, event, inspect, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bot.db.base import User, Session, game_systems, user_game_systems, session_game_systems
+
+
+def system_key(name: str) -> str:
+    """Ключ системы для сравнения (как split_systems): регистр и лишние пробелы не важны."""
+    return " ".join(name.split()).lower()
+
+
+def split_system_names(value: Optional[str]) -> Dict[str, str]:
+    """Строка систем через запятую -> {ключ: название как его ввели впервые}."""
+    names: Dict[str, str] = {}
+    for raw in (value or "").split(","):
+        name = " ".join(raw.split())
+        if name:
+            names.setdefault(system_key(name), name)
+    return names
+
+
+def _insert_ignore(connection: Connection, table: Table, rows: List[Dict]) -> None:
+    """INSERT, пропускающий уже существующие строки (гонка между воркерами не приводит к ошибке)."""
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(table).on_conflict_do_nothing()
+    else:
+        existing = {tuple(r) for r in connection.execute(select(*table.primary_key.columns)).all()}
+        pk = [c.name for c in table.primary_key.columns]
+        rows = [r for r in rows if tuple(r[c] for c in pk) not in existing]
+        stmt = insert(table)
+    if rows:
+        connection.execute(stmt, rows)
+
+
+def ensure_systems(connection: Connection, names: Dict[str, str]) -> Dict[str, int]:
+    """id систем по ключам; отсутствующие системы добавляются в справочник."""
+    if not names:
+        return {}
+    keys = list(names)
+    ids = dict(connection.execute(
+        select(game_systems.c.key, game_systems.c.id).where(game_systems.c.key.in_(keys))
+    ).all())
+    missing = [{"key": k, "name": names[k]} for k in keys if k not in ids]
+    if missing:
+        dialect = connection.dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            module = postgresql if dialect == "postgresql" else sqlite
+            connection.execute(module.insert(game_systems).on_conflict_do_nothing(index_elements=["key"]), missing)
+        else:
+            connection.execute(insert(game_systems), missing)
+        ids.update(connection.execute(
+            select(game_systems.c.key, game_systems.c.id).where(game_systems.c.key.in_([m["key"] for m in missing]))
+        ).all())
+    return ids
+
+
+def link_systems(connection: Connection, table: Table, owner_column: str,
+                 values: Dict[int, Optional[str]]) -> None:
+    """Пересобирает связи владельцев {id: строка систем} одним набором запросов."""
+    if not values:
+        return
+    parsed = {owner_id: split_system_names(value) for owner_id, value in values.items()}
+    names: Dict[str, str] = {}
+    for owner_names in parsed.values():
+        for key, name in owner_names.items():
+            names.setdefault(key, name)
+
+    connection.execute(delete(table).where(table.c[owner_column].in_(list(values))))
+    ids = ensure_systems(connection, names)
+    rows = [{owner_column: owner_id, "system_id": ids[key]}
+            for owner_id, owner_names in parsed.items() for key in owner_names]
+    if rows:
+        _insert_ignore(connection, table, rows)
+
+
+def sync_user_systems(connection: Connection, user_id: int, preferred_systems: Optional[str]) -> None:
+    link_systems(connection, user_game_systems, "user_id", {user_id: preferred_systems})
+
+
+def sync_session_systems(connection: Connection, session_id: int, game_system: Optional[str]) -> None:
+    link_systems(connection, session_game_systems, "session_id", {session_id: game_system})
+
+
+@event.listens_for(User, "after_insert")
+def _on_user_inserted(mapper, connection: Connection, target: User) -> None:
+    sync_user_systems(connection, target.id, target.preferred_systems)
+
+
+@event.listens_for(User, "after_update")
+def _on_user_updated(mapper, connection: Connection, target: User) -> None:
+    if inspect(target).attrs.preferred_systems.history.has_changes():
+        sync_user_systems(connection, target.id, target.preferred_systems)
+
+
+@event.listens_for(Session, "after_insert")
+def _on_session_inserted(mapper, connection: Connection, target: Session) -> None:
+    sync_session_systems(connection, target.id, target.game_system)
+
+
+@event.listens_for(Session, "after_update")
+def _on_session_updated(mapper, connection: Connection, target: Session) -> None:
+    if inspect(target).attrs.game_system.history.has_changes():
+        sync_session_systems(connection, target.id, target.game_system)
+
+
+@event.listens_for(User, "after_delete")
+def _on_user_deleted(mapper, connection: Connection, target: User) -> None:
+    connection.execute(delete(user_game_systems).where(user_game_systems.c.user_id == target.id))
+
+
+@event.listens_for(Session, "after_delete")
+def _on_session_deleted(mapper, connection: Connection, target: Session) -> None:
+    connection.execute(delete(session_game_systems).where(session_game_systems.c.session_id == target.id))
+
+
+async def backfill_game_systems(session: AsyncSession, batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Заполняет справочник и связи по User.preferred_systems и Session.game_system.
+    Повторный запуск безопасен: связи каждого владельца пересобираются заново.
+    Возвращает число обработанных пользователей и игр.
+    """
+    counts = {"users": 0, "sessions": 0}
+
+    async def run(stmt, table: Table, owner_column: str) -> int:
+        done = 0
+        result = await session.stream(stmt)
+        async for chunk in result.partitions(batch_size):
+            values = {owner_id: value for owner_id, value in chunk}
+            await session.run_sync(lambda s: link_systems(s.connection(), table, owner_column, values))
+            done += len(values)
+        return done
+
+    counts["users"] = await run(select(User.id, User.preferred_systems), user_game_systems, "user_id")
+    counts["sessions"] = await run(select(Session.id, Session.game_system), session_game_systems, "session_id")
+    await session.commit()
+    return counts
+
@@ -0,0 +1,155 @@
+# bot/db/invalidation.py
+"""
+Сброс кэшей в памяти процесса между воркерами через PostgreSQL LISTEN/NOTIFY.
+
+Запись пользователя, профиля игрока/мастера или игры через ORM добавляет в ту же
+транзакцию pg_notify(CHANNEL, "<сущность>:<ключ>") — уведомление уходит только после
+commit. Каждый воркер держит InvalidationListener: отдельное соединение asyncpg,
+которое получает уведомления и вызывает обработчики, подписанные через subscribe.
+После (пере)подключения вызываются обработчики subscribe_reset: уведомления,
+пришедшие, пока соединения не было, потеряны, и кэши сбрасываются целиком.
+
+Сущности и ключи:
+    user  telegram_id пользователя (изменились users, players или masters)
+    game  id игры
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+import asyncpg
+from sqlalchemy import Connection, event, func, select
+
+from bot.db.base import User, Player, Master, Session
+
+CHANNEL = "trg_cache_invalidation"
+RECONNECT_DELAY = 5.0
+
+logger = logging.getLogger(__name__)
+
+_handlers: Dict[str, List[Callable[[str], None]]] = defaultdict(list)
+_reset_handlers: List[Callable[[], None]] = []
+
+
+def subscribe(entity: str, handler: Callable[[str], None]) -> None:
+    """handler(ключ) вызывается на каждое уведомление об изменении сущности."""
+    _handlers[entity].append(handler)
+
+
+def subscribe_reset(handler: Callable[[], None]) -> None:
+    """handler() вызывается, когда уведомления могли быть пропущены."""
+    _reset_handlers.append(handler)
+
+
+def dispatch(payload: str) -> None:
+    entity, _, key = payload.partition(":")
+    for handler in _handlers.get(entity, ()):
+        try:
+            handler(key)
+        except Exception:
+            logger.exception("Cache invalidation handler failed for %r", payload)
+
+
+def reset_all() -> None:
+    for handler in _reset_handlers:
+        try:
+            handler()
+        except Exception:
+            logger.exception("Cache reset handler failed")
+
+
+# --- отправка: события маппера ---
+
+def notifies(connection: Connection) -> bool:
+    return connection.dialect.name == "postgresql"
+
+
+def publish(connection: Connection, entity: str, key) -> None:
+    """Ставит уведомление в текущую транзакцию; без PostgreSQL ничего не делает."""
+    if notifies(connection):
+        connection.execute(select(func.pg_notify(CHANNEL, f"{entity}:{key}")))
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _on_user_changed(mapper, connection: Connection, target: User) -> None:
+    publish(connection, "user", target.telegram_id)
+
+
+@event.listens_for(Player, "after_insert")
+@event.listens_for(Player, "after_update")
+@event.listens_for(Player, "after_delete")
+@event.listens_for(Master, "after_insert")
+@event.listens_for(Master, "after_update")
+@event.listens_for(Master, "after_delete")
+def _on_profile_changed(mapper, connection: Connection, target) -> None:
+    if not notifies(connection):
+        return
+    tg_id = connection.execute(select(User.telegram_id).where(User.id == target.id)).scalar()
+    if tg_id is not None:
+        publish(connection, "user", tg_id)
+
+
+@event.listens_for(Session, "after_insert")
+@event.listens_for(Session, "after_update")
+@event.listens_for(Session, "after_delete")
+def _on_game_changed(mapper, connection: Connection, target: Session) -> None:
+    publish(connection, "game", target.id)
+
+
+# --- приём: отдельное соединение asyncpg в каждом воркере ---
+
+def asyncpg_dsn(dsn: str) -> str:
+    """postgresql+asyncpg://... -> postgresql://... (asyncpg не понимает драйвер в схеме)."""
+    scheme, sep, rest = dsn.partition("://")
+    return f"{scheme.split('+', 1)[0]}{sep}{rest}"
+
+
+class InvalidationListener:
+    def __init__(self, dsn: str, channel: str = CHANNEL, reconnect_delay: float = RECONNECT_DELAY):
+        self.dsn = asyncpg_dsn(dsn)
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._task: Optional[asyncio.Task] = None
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        dispatch(payload)
+
+    async def _listen_once(self) -> None:
+        connection = await asyncpg.connect(self.dsn)
+        try:
+            closed = asyncio.get_running_loop().create_future()
+            connection.add_termination_listener(lambda _: closed.done() or closed.set_result(None))
+            await connection.add_listener(self.channel, self._on_notify)
+            reset_all()
+            await closed
+        finally:
+            if not connection.is_closed():
+                await connection.close()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._listen_once()
+                logger.warning("Cache invalidation listener disconnected, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Cache invalidation listener failed, reconnecting")
+            await asyncio.sleep(self.reconnect_delay)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
@@ -0,0 +1,57 @@
+# bot/db/lazy_session.py
+from __future__ import annotations
+
+from typing import Any, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+# Методы, которые отправляют SQL. Остальное (get_bind, bind, add, info, ...) сессию
+# создаёт, но использованной её не делает
+_DB_METHODS = frozenset({
+    "execute", "scalar", "scalars", "stream", "stream_scalars",
+    "get", "get_one", "merge", "refresh", "flush",
+})
+
+
+class LazySession:
+    """
+    Прокси над AsyncSession: сессия создаётся при первом обращении к ней
+    (execute, get, add, commit, ...).
+
+    Выигрыш узкий: AsyncSession и сама берёт соединение из пула только на первом
+    запросе, так что число обращений к пулу не меняется. Экономится создание объекта
+    AsyncSession (и его identity map) для апдейтов, которые не ходят в БД, — /start,
+    /cancel, ответы на колбэки. Прокси не проходит isinstance(..., AsyncSession):
+    там, где это проверяется, LazySession указывается явно.
+
+    touched отмечает только обращения, которые ходят в БД (_DB_METHODS и commit
+    с несохранёнными изменениями), а не любое чтение атрибута.
+    """
+
+    __slots__ = ("_session_maker", "_session", "_used")
+
+    def __init__(self, session_maker: async_sessionmaker[AsyncSession]):
+        self._session_maker = session_maker
+        self._session: Optional[AsyncSession] = None
+        self._used = False
+
+    @property
+    def touched(self) -> bool:
+        """Обращался ли кто-нибудь к БД в рамках апдейта."""
+        return self._used
+
+    @property
+    def session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._session_maker()
+        return self._session
+
+    def __getattr__(self, name: str) -> Any:
+        session = self.session
+        if name in _DB_METHODS or (name == "commit" and (session.new or session.dirty or session.deleted)):
+            self._used = True
+        return getattr(session, name)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
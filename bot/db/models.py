@@ -1,9 +1,10 @@
-from typing import List, Optional, Union
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, TypeVar
 
-from sqlalchemy import select
+from sqlalchemy import select, inspect
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from bot.db.base import User, Player, Master, Session
+from bot.db.base import Base, User, Player, Master, Session
 
 all_roles = ['Игрок', 'Мастер']
 all_formats = ['Онлайн', 'Оффлайн']
@@ -22,55 +23,171 @@ def concat(options: list):
     return option
 
 
+def loaded(obj, attr: str, default=None):
+    """
+    Возвращает связь ORM-объекта, только если она уже загружена.
+    Под AsyncSession обращение к незагруженной связи вызывает ленивую загрузку
+    (MissingGreenlet), поэтому незагруженные связи считаются пустыми.
+    """
+    state = inspect(obj, raiseerr=False)
+    if state is not None and attr in state.unloaded:
+        return default
+    return getattr(obj, attr)
+
+
+def _mask_names(options: List[str]) -> Tuple[str, ...]:
+    """Строка для каждой битовой маски над options: таблица[маска] == concat(выбранных)."""
+    return tuple(
+        concat([o for i, o in enumerate(options) if mask & (1 << i)])
+        for mask in range(1 << len(options))
+    )
+
+
+# Расшифровка масок User.role / User.game_format без цикла на каждое обращение.
+# Биты за пределами списков игнорируются; не целые маски дают TypeError на &.
+ROLE_NAMES = _mask_names(all_roles)
+FORMAT_NAMES = _mask_names(all_formats)
+_ROLE_BITS = len(ROLE_NAMES) - 1
+_FORMAT_BITS = len(FORMAT_NAMES) - 1
+
+
 def get_role(user: User):
-    roles = []
-    for i in range(len(all_roles)):
-        if user.role & 2 ** i:
-            roles.append(all_roles[i])
-    return concat(roles)
+    return ROLE_NAMES[user.role & _ROLE_BITS]
 
 
 def get_game_format(user: User):
-    formats = []
-    for i in range(len(all_formats)):
-        if user.game_format & 2 ** i:
-            formats.append(all_formats[i])
-    return concat(formats)
-
-
-class UserModel:
-    def __init__(self, user: User):
-        self.id = user.id
-        self.telegram_id = user.telegram_id
-        self.name = user.name
-        self.age = user.age
-        self.city = user.city
-        self.time_zone = user.time_zone
-        self.role = get_role(user)
-        self.game_format = get_game_format(user)
-        self.preferred_systems = user.preferred_systems
-        self.about_info = user.about_info
-        self.created_at = user.created_at
-        self._player_profile = user.player_profile
-        self._master_profile = user.master_profile
-        self._sessions = user.sessions
-
-    @property
-    def player_profile(self) -> Optional['PlayerModel']:
-        return PlayerModel(self._player_profile) if self._player_profile else None
-
-    @property
-    def master_profile(self) -> Optional['MasterModel']:
-        return MasterModel(self._master_profile) if self._master_profile else None
+    return FORMAT_NAMES[user.game_format & _FORMAT_BITS]
+
+
+S = TypeVar("S", bound="Snapshot")
+# id(ORM-объекта) -> его снимок; (id(объекта), связь) -> родитель для обратной связи
+_Memo = Dict[Any, "Snapshot"]
+
+
+class Snapshot(ABC):
+    """
+    Неизменяемый снимок строки БД. Поля копируются из ORM-объекта один раз при создании,
+    загруженные связи сразу превращаются во вложенные снимки, а сам ORM-объект
+    (и через него identity map сессии) не сохраняется — снимок безопасно держать
+    в кэше и читать после закрытия сессии. Незагруженные связи считаются пустыми.
+
+    Циклические связи (user.player_profile.user) строятся через memo: каждый ORM-объект
+    превращается в снимок один раз, и обратная ссылка указывает на тот же снимок.
+    Подкласс обязан определить _fill — иначе он не создаётся (TypeError).
+    """
+
+    __slots__ = ()
+    # Имена полей-значений и полей-связей; to_dict выводит их в этом порядке
+    _fields: Tuple[str, ...] = ()
+    _relations: Tuple[str, ...] = ()
+
+    def __init__(self, obj: Any, _memo: Optional[_Memo] = None):
+        memo = {} if _memo is None else _memo
+        memo[id(obj)] = self
+        self._fill(obj, memo)
+
+    @abstractmethod
+    def _fill(self, obj: Any, memo: _Memo) -> None:
+        """Заполняет поля снимка из ORM-объекта через _set."""
+
+    def _set(self, name: str, value: Any) -> None:
+        object.__setattr__(self, name, value)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self._fields + self._relations}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        for name, value in state.items():
+            self._set(name, value)
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} id={getattr(self, 'id', None)!r}>"
+
+    def to_dict(self, _seen: Optional[Set[int]] = None) -> Dict[str, Any]:
+        """
+        Поля и загруженные связи в виде dict (для dialog_data). Связь, ведущая обратно
+        к уже выведенному снимку (player_profile.user для пользователя), пропускается.
+        """
+        seen = {id(self)} if _seen is None else _seen | {id(self)}
+        data = {name: getattr(self, name) for name in self._fields}
+        for name in self._relations:
+            value = getattr(self, name)
+            if isinstance(value, list):
+                data[name] = [v.to_dict(seen) for v in value if id(v) not in seen]
+            elif value is None or id(value) not in seen:
+                data[name] = value.to_dict(seen) if value is not None else None
+        return data
+
+
+def _snapshot(cls: Type[S], obj: Any, memo: _Memo,
+              backref: Optional[str] = None, parent: Optional[Snapshot] = None) -> Optional[S]:
+    """
+    Снимок связанного ORM-объекта, один на объект (через memo). Обратная связь (player.user,
+    game.creator) не подгружается вместе с прямой: backref и parent кладут родителя в memo
+    до заполнения потомка, и тот берёт его оттуда (см. _related).
+    """
+    if obj is None:
+        return None
+    if not isinstance(obj, Base):
+        raise TypeError(f"{cls.__name__} expects an ORM object, got {type(obj).__name__}")
+    found = memo.get(id(obj))
+    if found is not None:
+        return found  # type: ignore[return-value]
+    if backref is not None:
+        memo[(id(obj), backref)] = parent
+    return cls(obj, memo)
+
+
+def _snapshots(cls: Type[S], objs: Any, memo: _Memo,
+               backref: Optional[str] = None, parent: Optional[Snapshot] = None) -> List[S]:
+    return [_snapshot(cls, o, memo, backref, parent) for o in objs or ()]  # type: ignore[misc]
+
+
+def _related(cls: Type[S], obj: Any, attr: str, memo: _Memo) -> Optional[S]:
+    """Связь obj.attr снимком; незагруженная обратная связь — родитель, который строит этот снимок."""
+    target = loaded(obj, attr)
+    if target is None:
+        return memo.get((id(obj), attr))  # type: ignore[return-value]
+    return _snapshot(cls, target, memo)
+
+
+class UserModel(Snapshot):
+    __slots__ = ("id", "telegram_id", "name", "age", "city", "time_zone", "role", "game_format",
+                 "preferred_systems", "about_info", "created_at", "player_profile", "master_profile", "sessions")
+    _fields = __slots__[:11]
+    _relations = ("player_profile", "master_profile", "sessions")
+
+    player_profile: Optional['PlayerModel']
+    master_profile: Optional['MasterModel']
+    sessions: List['SessionModel']
+
+    def _fill(self, user: User, memo: _Memo) -> None:
+        self._set("id", user.id)
+        self._set("telegram_id", user.telegram_id)
+        self._set("name", user.name)
+        self._set("age", user.age)
+        self._set("city", user.city)
+        self._set("time_zone", user.time_zone)
+        self._set("role", get_role(user))
+        self._set("game_format", get_game_format(user))
+        self._set("preferred_systems", user.preferred_systems)
+        self._set("about_info", user.about_info)
+        self._set("created_at", user.created_at)
+        # Игры — первыми: те же игры в master_profile.sessions должны получить creator из memo
+        self._set("sessions", _snapshots(SessionModel, loaded(user, "sessions", []), memo, "creator", self))
+        self._set("player_profile", _snapshot(PlayerModel, loaded(user, "player_profile"), memo, "user", self))
+        self._set("master_profile", _snapshot(MasterModel, loaded(user, "master_profile"), memo, "user", self))
 
     async def get_user(self, session: AsyncSession) -> User:
         user = await session.execute(select(User).where(User.telegram_id == self.telegram_id))
         return user.scalars().first()
 
-    @property
-    def sessions(self) -> List['SessionModel']:
-        return [SessionModel(s) for s in self._sessions]
-
     def __str__(self):
         return (f"<b>Ваш профиль</b>:\n"
                 f"Имя: <b>{self.name}</b>\n"
@@ -83,76 +200,72 @@ class UserModel:
                 f"О себе: <b>{self.about_info or 'Не указано'}</b>\n")
 
 
-class PlayerModel:
-    def __init__(self, player: Player):
-        self.id = player.id
-        self.experience_level = all_experience_levels[player.experience_level]
-        self.availability = player.availability
+class PlayerModel(Snapshot):
+    __slots__ = ("id", "experience_level", "availability", "user", "sessions")
+    _fields = ("id", "experience_level", "availability")
+    _relations = ("user", "sessions")
 
-        self._user = player.user
-        self._sessions = player.sessions
+    user: Optional[UserModel]
+    sessions: List['SessionModel']
 
-    @property
-    def user(self) -> UserModel:
-        return UserModel(self._user)
-
-    @property
-    def sessions(self) -> List['SessionModel']:
-        return [SessionModel(s) for s in self._sessions]
+    def _fill(self, player: Player, memo: _Memo) -> None:
+        self._set("id", player.id)
+        self._set("experience_level", all_experience_levels[player.experience_level])
+        self._set("availability", player.availability)
+        self._set("user", _related(UserModel, player, "user", memo))
+        self._set("sessions", _snapshots(SessionModel, loaded(player, "sessions", []), memo))
 
     async def get_player(self, session):
-        player = await session.execute(select(Player).where(User.telegram_id == self.user.telegram_id))
+        player = await session.execute(select(Player).where(Player.id == self.id))
         return player.scalars().first()
 
 
-class MasterModel:
-    def __init__(self, master: Master):
-        self.id = master.id
-        self.master_style = master.master_style
-        self.rating = master.rating
+class MasterModel(Snapshot):
+    __slots__ = ("id", "master_style", "rating", "user", "sessions")
+    _fields = ("id", "master_style", "rating")
+    _relations = ("user", "sessions")
+
+    user: Optional[UserModel]
+    sessions: List['SessionModel']
 
-        # Связи
-        self._user = master.user
-        self._sessions = master.sessions
+    def _fill(self, master: Master, memo: _Memo) -> None:
+        self._set("id", master.id)
+        self._set("master_style", master.master_style)
+        self._set("rating", master.rating)
+        self._set("user", _related(UserModel, master, "user", memo))
+        self._set("sessions", _snapshots(SessionModel, loaded(master, "sessions", []), memo))
 
     async def get_master(self, session):
-        master = await session.execute(select(Master).where(User.telegram_id == self.user.telegram_id))
+        master = await session.execute(select(Master).where(Master.id == self.id))
         return master.scalars().first()
 
-    @property
-    def user(self) -> UserModel:
-        return UserModel(self._user)
-
-    @property
-    def sessions(self) -> List['SessionModel']:
-        return [SessionModel(s) for s in self._sessions]
-
 
-class SessionModel:
-    def __init__(self, session: Session):
-        # Основные поля
-        self.id = session.id
-        self.title = session.title
-        self.description = session.description
-        self.game_system = session.game_system
-        self.date_time = session.date_time
-        self.format = all_formats[session.format]
-        self.status = session.status
-        self.max_players = session.max_players
-        self.looking_for = all_roles[session.looking_for]
-
-        # Связи
-        self._creator = session.creator
-        self._players = session.players
-
-    @property
-    def creator(self) -> UserModel:
-        return UserModel(self._creator)
+class SessionModel(Snapshot):
+    __slots__ = ("id", "title", "description", "game_system", "date_time", "format", "status", "max_players",
+                 "looking_for", "city", "is_paid", "min_age", "max_age", "creator", "players")
+    _fields = __slots__[:13]
+    _relations = ("creator", "players")
+
+    creator: Optional[UserModel]
+    players: List[PlayerModel]
+
+    def _fill(self, session: Session, memo: _Memo) -> None:
+        self._set("id", session.id)
+        self._set("title", session.title)
+        self._set("description", session.description)
+        self._set("game_system", session.game_system)
+        self._set("date_time", session.date_time)
+        self._set("format", all_formats[session.format])
+        self._set("status", session.status)
+        self._set("max_players", session.max_players)
+        self._set("looking_for", all_roles[session.looking_for])
+        self._set("city", session.city)
+        self._set("is_paid", session.is_paid)
+        self._set("min_age", session.min_age)
+        self._set("max_age", session.max_age)
+        self._set("creator", _related(UserModel, session, "creator", memo))
+        self._set("players", _snapshots(PlayerModel, loaded(session, "players", []), memo))
 
     async def get_game(self, session: AsyncSession) -> Session:
         game = await session.execute(select(Session).where(Session.id == self.id))
         return game.scalars().first()
-
-    @property
-    def players(self) -> List[Union[PlayerModel, UserModel]]:
-        return [PlayerModel(p) for p in self._players]
@@ -0,0 +1,98 @@
+# bot/db/player_features.py
+"""
+Таблица признаков игроков player_match_keys для подбора игроков под игру.
+
+Строки пересчитываются в том же flush, в котором меняется профиль (события маппера
+Player и User), так что любая запись через ORM оставляет таблицу актуальной.
+rebuild_player_match_keys заполняет таблицу с нуля — для уже существующих игроков.
+"""
+from __future__ import annotations
+
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import Connection, delete, event, insert, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bot.db.base import User, Player, player_match_keys
+from bot.db.models import all_formats
+from bot.db.recommendations import split_systems
+
+# Поля пользователя, от которых зависят строки player_match_keys
+USER_MATCH_FIELDS = ("game_format", "preferred_systems", "time_zone", "age")
+
+
+def player_match_rows(
+        player_id: int,
+        game_format: int,
+        preferred_systems: Optional[str],
+        time_zone: int,
+        experience_level: Optional[int],
+        age: int
+) -> List[Dict[str, Any]]:
+    """Строки игрока: каждая его система (и "" — любая) на каждый его формат."""
+    features = {"player_id": player_id, "time_zone": time_zone,
+                "experience_level": experience_level or 0, "age": age}
+    systems = ("",) + tuple(dict.fromkeys(split_systems(preferred_systems)))
+    return [
+        {**features, "system_key": system, "format": fmt}
+        for system in systems
+        for fmt in range(len(all_formats)) if game_format & (1 << fmt)
+    ]
+
+
+def _features_select():
+    return (
+        select(User.id, User.game_format, User.preferred_systems, User.time_zone, User.age,
+               Player.experience_level)
+        .join(Player, Player.id == User.id)
+    )
+
+
+def _rows_for(users) -> List[Dict[str, Any]]:
+    return [
+        r for u in users
+        for r in player_match_rows(u.id, u.game_format, u.preferred_systems, u.time_zone,
+                                   u.experience_level, u.age)
+    ]
+
+
+def refresh_player_match_keys(connection: Connection, *player_ids: int) -> None:
+    """Пересчёт строк игроков; у кого профиля игрока нет — строки удаляются."""
+    if not player_ids:
+        return
+    connection.execute(delete(player_match_keys).where(player_match_keys.c.player_id.in_(player_ids)))
+    rows = _rows_for(connection.execute(_features_select().where(User.id.in_(player_ids))).all())
+    if rows:
+        connection.execute(insert(player_match_keys), rows)
+
+
+@event.listens_for(Player, "after_insert")
+@event.listens_for(Player, "after_update")
+def _on_player_saved(mapper, connection: Connection, target: Player) -> None:
+    refresh_player_match_keys(connection, target.id)
+
+
+@event.listens_for(Player, "after_delete")
+def _on_player_deleted(mapper, connection: Connection, target: Player) -> None:
+    connection.execute(delete(player_match_keys).where(player_match_keys.c.player_id == target.id))
+
+
+@event.listens_for(User, "after_update")
+def _on_user_saved(mapper, connection: Connection, target: User) -> None:
+    attrs = inspect(target).attrs
+    if any(attrs[name].history.has_changes() for name in USER_MATCH_FIELDS):
+        refresh_player_match_keys(connection, target.id)
+
+
+async def rebuild_player_match_keys(session: AsyncSession, batch_size: int = 1000) -> int:
+    """Заполняет player_match_keys заново по всем игрокам. Возвращает число строк."""
+    await session.execute(delete(player_match_keys))
+    result = await session.stream(_features_select())
+    total = 0
+    async for chunk in result.partitions(batch_size):
+        rows = _rows_for(chunk)
+        if rows:
+            await session.execute(insert(player_match_keys), rows)
+        total += len(rows)
+    await session.commit()
+    return total
@@ -0,0 +1,111 @@
+# bot/db/popular_systems.py
+"""
+Список популярных систем для кнопок в формах (игрок, мастер, создание игры).
+
+Список хранится в памяти процесса и обновляется фоновой задачей раз в ttl секунд;
+геттеры окон читают его синхронно и в БД не ходят. Если данные устарели
+(фоновая задача не запущена или обновление не удалось), отдаётся старый список,
+а обновление запускается в фоне.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from bot.db.requests import get_top_systems
+
+POPULAR_SYSTEMS_LIMIT = 10
+POPULAR_SYSTEMS_TTL = 300.0
+# Пауза перед повтором после неудачного обновления
+POPULAR_SYSTEMS_RETRY = 30.0
+
+logger = logging.getLogger(__name__)
+
+
+class PopularSystemsCache:
+    def __init__(
+            self,
+            session_maker: Optional[async_sessionmaker[AsyncSession]] = None,
+            *,
+            limit: int = POPULAR_SYSTEMS_LIMIT,
+            ttl: float = POPULAR_SYSTEMS_TTL,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.session_maker = session_maker
+        self.limit = limit
+        self.ttl = ttl
+        self._clock = clock
+        self._items: List[Dict[str, Any]] = []
+        self._loaded_at: Optional[float] = None
+        self._refreshing: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    @property
+    def stale(self) -> bool:
+        return self._loaded_at is None or self._clock() - self._loaded_at >= self.ttl
+
+    def items(self) -> List[Dict[str, Any]]:
+        """Текущий список [{"id", "name"}] без обращения к БД."""
+        if self.stale:
+            self._schedule_refresh()
+        return [dict(item) for item in self._items]
+
+    async def refresh(self) -> List[Dict[str, Any]]:
+        if self.session_maker is None:
+            raise RuntimeError("PopularSystemsCache: session_maker is not set")
+        async with self.session_maker() as session:
+            rows = await get_top_systems(session, self.limit)
+        self._items = [{"id": r["id"], "name": r["name"]} for r in rows]
+        self._loaded_at = self._clock()
+        return self.items()
+
+    def _schedule_refresh(self) -> None:
+        if self.session_maker is None or (self._refreshing and not self._refreshing.done()):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._refreshing = loop.create_task(self._safe_refresh())
+
+    async def _safe_refresh(self) -> bool:
+        try:
+            await self.refresh()
+            return True
+        except Exception:
+            logger.exception("Failed to refresh popular systems")
+            return False
+
+    async def _run(self) -> None:
+        while True:
+            ok = await self._safe_refresh()
+            await asyncio.sleep(self.ttl if ok else min(self.ttl, POPULAR_SYSTEMS_RETRY))
+
+    def start(self, session_maker: Optional[async_sessionmaker[AsyncSession]] = None) -> None:
+        """Запускает фоновое обновление (вызывается при старте диспетчера)."""
+        if session_maker is not None:
+            self.session_maker = session_maker
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        for task in (self._loop_task, self._refreshing):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._loop_task = self._refreshing = None
+
+    def clear(self) -> None:
+        self._items = []
+        self._loaded_at = None
+
+
+# Общий для процесса экземпляр: запускается в build_dispatcher, читается геттерами форм
+popular_systems_cache = PopularSystemsCache()
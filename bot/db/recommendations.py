@@ -0,0 +1,272 @@
+# bot/db/recommendations.py
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, \
+    Sequence, Tuple
+
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from bot.db.base import normalize_city
+from bot.db.game_systems import split_system_names, system_key
+
+if TYPE_CHECKING:
+    from bot.db.game_filters import GameFilters
+
+# Вклад признаков в итоговую оценку игры
+SCORE_WEIGHTS: Dict[str, float] = {
+    "format": 3.0,     # формат игры входит в форматы игрока
+    "system": 2.0,     # система игры есть среди предпочитаемых
+    "time_zone": 1.0,  # близость часового пояса мастера
+    "seats": 0.5,      # сколько мест осталось (чем больше, тем проще попасть)
+}
+# Разница часовых поясов, при которой вклад time_zone падает до нуля
+TZ_SPAN = 12
+# Столько свободных мест дают полный вклад seats
+SEATS_SATURATION = 3
+# Сколько секунд набор открытых игр в памяти считается свежим без уведомлений об изменениях
+CANDIDATES_TTL = 60.0
+
+logger = logging.getLogger(__name__)
+
+
+def split_systems(value: Optional[str]) -> Tuple[str, ...]:
+    """Строка систем через запятую (как User.preferred_systems) -> ключи систем (system_key)."""
+    return tuple(split_system_names(value))
+
+
+class PlayerProfile(NamedTuple):
+    game_format: int                  # битовая маска, как User.game_format
+    systems: Tuple[str, ...] = ()     # нормализованные названия систем
+    time_zone: Optional[int] = None
+    age: Optional[int] = None
+
+
+class GameCandidates:
+    """
+    Признаки открытых игр в виде массивов NumPy: оценка всех игр для игрока — один
+    векторный проход без цикла по играм. Набор строится один раз и годится для разных игроков.
+
+    Жёсткие условия (игра не предлагается): возраст игрока вне min_age/max_age, нет свободных мест.
+    Фильтры поиска применяются к тем же массивам (filter_mask) — без запроса к БД.
+    """
+
+    def __init__(
+            self,
+            ids: Sequence[int],
+            formats: Sequence[int],
+            systems: Sequence[Optional[str]],
+            time_zones: Sequence[Optional[int]],
+            min_ages: Sequence[Optional[int]],
+            max_ages: Sequence[Optional[int]],
+            max_players: Sequence[Optional[int]],
+            current_players: Sequence[int],
+            creator_ids: Optional[Sequence[int]] = None,
+            city_keys: Optional[Sequence[Optional[str]]] = None,
+            is_paid: Optional[Sequence[bool]] = None,
+    ):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        n = len(self.ids)
+        self.creator_ids = np.asarray(creator_ids if creator_ids is not None else [0] * n, dtype=np.int64)
+        self.formats = np.asarray(formats, dtype=np.int64)
+        self.format_bits = np.left_shift(1, self.formats)
+        # Системы кодируются номерами из словаря: сравнение с предпочтениями — np.isin по целым.
+        # Ключ — system_key строки систем игры; system_keys[код] — её отдельные системы
+        # (как в связях session_game_systems), с ними сравниваются системы игрока
+        self.system_vocab: Dict[str, int] = {}
+        self.system_codes = np.fromiter(
+            (self.system_vocab.setdefault(system_key(s or ""), len(self.system_vocab)) for s in systems),
+            dtype=np.int64, count=n,
+        )
+        self.system_keys: List[FrozenSet[str]] = [frozenset(split_system_names(k)) for k in self.system_vocab]
+        self.city_vocab: Dict[Optional[str], int] = {}
+        self.city_codes = np.fromiter(
+            (self.city_vocab.setdefault(c, len(self.city_vocab)) for c in (city_keys or [None] * n)),
+            dtype=np.int64, count=n,
+        )
+        self.is_paid = np.asarray(is_paid if is_paid is not None else [False] * n, dtype=bool)
+        self.time_zones = self._floats(time_zones)
+        self.min_ages = self._floats(min_ages)
+        self.max_ages = self._floats(max_ages)
+        self.seats_left = self._floats(max_players) - np.asarray(current_players, dtype=np.float64)
+
+    @staticmethod
+    def _floats(values: Iterable[Optional[int]]) -> np.ndarray:
+        """None -> NaN: отсутствие ограничения."""
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Dict]) -> GameCandidates:
+        rows = list(rows)
+        return cls(
+            ids=[r["id"] for r in rows],
+            formats=[r["format"] for r in rows],
+            systems=[r["game_system"] for r in rows],
+            time_zones=[r["time_zone"] for r in rows],
+            min_ages=[r["min_age"] for r in rows],
+            max_ages=[r["max_age"] for r in rows],
+            max_players=[r["max_players"] for r in rows],
+            current_players=[r["current_players"] for r in rows],
+            creator_ids=[r.get("creator_id", 0) for r in rows],
+            city_keys=[r.get("city_key") for r in rows],
+            is_paid=[bool(r.get("is_paid")) for r in rows],
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _system_codes(self, keys: Iterable[str]) -> List[int]:
+        """Коды строк систем, в которых есть хотя бы одна из систем keys."""
+        keys = frozenset(keys)
+        return [code for code, game_keys in enumerate(self.system_keys) if not game_keys.isdisjoint(keys)]
+
+    def filter_mask(self, filters: GameFilters) -> np.ndarray:
+        """Игры, подходящие под фильтры поиска: то же, что GameFilters.conditions() в SQL."""
+        mask = np.ones(len(self), dtype=bool)
+        if filters.systems:
+            mask &= np.isin(self.system_codes, self._system_codes(system_key(s) for s in filters.systems))
+        if filters.format is not None:
+            mask &= self.formats == filters.format
+        if filters.city is not None:
+            mask &= self.city_codes == self.city_vocab.get(normalize_city(filters.city), -1)
+        if filters.time_zone is not None:
+            # NaN (пояс неизвестен) не проходит, как NULL в BETWEEN
+            mask &= np.abs(self.time_zones - filters.time_zone) <= filters.tz_window
+        if filters.is_paid is not None:
+            mask &= self.is_paid == filters.is_paid
+        if filters.age is not None:
+            mask &= np.isnan(self.min_ages) | (self.min_ages <= filters.age)
+            mask &= np.isnan(self.max_ages) | (self.max_ages >= filters.age)
+        if filters.free_seats:
+            mask &= np.isnan(self.seats_left) | (self.seats_left > 0)
+        return mask
+
+    def scores(self, player: PlayerProfile) -> np.ndarray:
+        """Оценка каждой игры; -inf у игр, которые игроку не подходят."""
+        w = SCORE_WEIGHTS
+        score = w["format"] * ((self.format_bits & player.game_format) != 0)
+
+        preferred = self._system_codes(player.systems)
+        if preferred:
+            score = score + w["system"] * np.isin(self.system_codes, preferred)
+
+        if player.time_zone is not None:
+            tz_fit = np.clip(1 - np.abs(self.time_zones - player.time_zone) / TZ_SPAN, 0, 1)
+            # Пояс мастера неизвестен — половина вклада
+            score = score + w["time_zone"] * np.nan_to_num(tz_fit, nan=0.5)
+
+        seats_fit = np.clip(self.seats_left / SEATS_SATURATION, 0, 1)
+        score = score + w["seats"] * np.nan_to_num(seats_fit, nan=1.0)
+
+        eligible = np.isnan(self.seats_left) | (self.seats_left > 0)
+        if player.age is not None:
+            eligible &= np.isnan(self.min_ages) | (self.min_ages <= player.age)
+            eligible &= np.isnan(self.max_ages) | (self.max_ages >= player.age)
+        return np.where(eligible, score, -np.inf)
+
+    def top_k(self, player: PlayerProfile, k: int, allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        k лучших игр как [(id, оценка)], по убыванию оценки, при равенстве — по id.
+        allowed — маска игр, из которых выбирать (фильтры поиска, чужие игры).
+        argpartition выбирает k лучших за O(n), сортируются только они.
+        """
+        scores = self.scores(player)
+        if allowed is not None:
+            scores = np.where(allowed, scores, -np.inf)
+        eligible = np.flatnonzero(np.isfinite(scores))
+        k = min(k, len(eligible))
+        if k <= 0:
+            return []
+        candidates = eligible
+        if k < len(eligible):
+            # Все с оценкой не ниже k-й, чтобы равные оценки на границе разрешались по id
+            kth = np.partition(scores[eligible], len(eligible) - k)[len(eligible) - k]
+            candidates = eligible[scores[eligible] >= kth]
+        order = np.lexsort((self.ids[candidates], -scores[candidates]))[:k]
+        best = candidates[order]
+        return [(int(i), float(s)) for i, s in zip(self.ids[best], scores[best])]
+
+
+class GameCandidatesCache:
+    """
+    GameCandidates всех открытых игр в памяти процесса: геттер поиска ранжирует игры
+    без чтения всех открытых игр на каждую отрисовку.
+
+    Набор перестраивается после invalidate (запись игры в этом процессе или уведомление
+    другого воркера) и по истечении ttl. Пока новый набор строится в фоне, отдаётся
+    прежний — как в PopularSystemsCache; синхронно набор читается только первый раз
+    и когда фоновое обновление не запущено (нет session_maker). Поколение отличает
+    набор, прочитанный до invalidate, от свежего: такой набор не считается актуальным.
+    """
+
+    def __init__(
+            self,
+            loader: Callable[[AsyncSession], Awaitable[GameCandidates]],
+            *,
+            ttl: float = CANDIDATES_TTL,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.loader = loader
+        self.ttl = ttl
+        self.session_maker: Optional[async_sessionmaker[AsyncSession]] = None
+        self._clock = clock
+        self._value: Optional[GameCandidates] = None
+        self._loaded_at: Optional[float] = None
+        self._generation = 0
+        self._refreshing: Optional[asyncio.Task] = None
+
+    @property
+    def stale(self) -> bool:
+        return self._loaded_at is None or self._clock() - self._loaded_at >= self.ttl
+
+    async def get(self, session: AsyncSession) -> GameCandidates:
+        if self._value is None or (self.stale and self.session_maker is None):
+            await self._load(session)
+        elif self.stale:
+            self._schedule_refresh()
+        return self._value
+
+    def invalidate(self, *_: Any) -> None:
+        """Набор устарел; сигнатура подходит для invalidation.subscribe."""
+        self._generation += 1
+        self._loaded_at = None
+
+    def clear(self) -> None:
+        self.invalidate()
+        self._value = None
+
+    async def _load(self, session: AsyncSession) -> None:
+        generation = self._generation
+        value = await self.loader(session)
+        self._value = value
+        if generation == self._generation:
+            self._loaded_at = self._clock()
+
+    def _schedule_refresh(self) -> None:
+        if self._refreshing is not None and not self._refreshing.done():
+            return
+        self._refreshing = asyncio.get_running_loop().create_task(self._safe_refresh())
+
+    async def _safe_refresh(self) -> None:
+        try:
+            async with self.session_maker() as session:
+                await self._load(session)
+        except Exception:
+            logger.exception("Failed to refresh game candidates")
+
+    def start(self, session_maker: async_sessionmaker[AsyncSession]) -> None:
+        """Включает обновление в фоне (вызывается при старте диспетчера)."""
+        self.session_maker = session_maker
+
+    async def stop(self) -> None:
+        task, self._refreshing = self._refreshing, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.session_maker = None
@@ -1,23 +1,67 @@
-from typing import Optional, Type, Any, Dict
+from typing import Optional, Type, Any, Callable, Dict, Iterable, List, Tuple
 from aiogram import Router
-from sqlalchemy import Select
+from sqlalchemy import Connection, Numeric, Select, and_, case, cast, delete, exists, func, insert, literal, \
+    literal_column, or_, true, tuple_, union, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy.orm import joinedload, selectinload
 
-from bot.db.base import User, Player, Master, Session
+from bot.db.base import User, Player, Master, Session, session_players, session_requests, player_match_keys, \
+    search_document, game_systems, user_game_systems, session_game_systems, normalize_city
+from bot.db.bulk import BulkResult, user_row, player_row, master_row, game_row
+from bot.db.cache import TTLCache
+from bot.db.game_filters import GameFilters
+from bot.db.game_search import GameSearchIndex, parse_query, query_variants, to_tsquery_text
+from bot.db.recommendations import GameCandidates, GameCandidatesCache, PlayerProfile, split_systems
+from bot.db import player_features  # noqa: F401  (регистрирует обновление player_match_keys)
+from bot.db import invalidation
+from bot.db.game_systems import system_key, link_systems, sync_user_systems, sync_session_systems
 from bot.db.models import UserModel, SessionModel, PlayerModel, MasterModel, all_formats, all_roles, \
     all_experience_levels
 
 router = Router()
 
+# Профили загрузки связей: имя профиля -> {модель: опции загрузки}.
+# Связи "один к одному" и "многие к одному" подтягиваются joinedload в том же запросе,
+# коллекции — selectinload (один дополнительный запрос на связь, а не на строку).
+# Всё, что не указано в профиле, не загружается, и модели-обёртки считают это пустым.
+LOAD_PROFILES: Dict[str, Dict[Type[Any], Tuple[Any, ...]]] = {
+    "bare": {},
+    "profile": {
+        User: (joinedload(User.player_profile), joinedload(User.master_profile)),
+        Player: (joinedload(Player.user),),
+        Master: (joinedload(Master.user),),
+        Session: (joinedload(Session.creator),),
+    },
+    "profile+games": {
+        User: (
+            joinedload(User.player_profile).selectinload(Player.sessions),
+            joinedload(User.master_profile),
+            selectinload(User.sessions),
+        ),
+        Player: (joinedload(Player.user), selectinload(Player.sessions)),
+        Master: (joinedload(Master.user), selectinload(Master.sessions)),
+        Session: (joinedload(Session.creator), selectinload(Session.players)),
+    },
+}
+
+
+def _load_options(model: Type[Any], profile: str) -> Tuple[Any, ...]:
+    if profile not in LOAD_PROFILES:
+        raise ValueError(f"Unknown load profile: {profile}")
+    return LOAD_PROFILES[profile].get(model, ())
+
 
 async def _get_entity(
         session: AsyncSession,
         model: Type[Any],
         filters: Dict[str, Any],
-        join_model: Optional[Type[Any]] = None
+        join_model: Optional[Type[Any]] = None,
+        profile: str = "bare"
 ) -> Optional[Any]:
-    stmt: Select = select(model)
+    stmt: Select = select(model).options(*_load_options(model, profile))
 
     if join_model:
         stmt = stmt.join(join_model)
@@ -32,67 +76,643 @@ async def _get_entity(
     return result.scalars().first()
 
 
+# INSERT с ON CONFLICT DO NOTHING по диалектам; для остальных — точки сохранения (см. ниже)
+_ON_CONFLICT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+async def _insert_skipping_conflicts(
+        session: AsyncSession,
+        table: Any,
+        index_elements: List[str],
+        build: Callable[[Any], Any],
+        params: Optional[List[Dict[str, Any]]] = None
+) -> List[Any]:
+    """
+    INSERT ... ON CONFLICT (index_elements) DO NOTHING; build достраивает INSERT
+    (values / from_select и returning), params — строки для executemany.
+    Возвращает строки RETURNING вставленных записей; table — таблица или модель.
+    На диалектах без ON CONFLICT каждая строка вставляется в своей точке сохранения,
+    и IntegrityError откатывает только её — медленнее, но без ошибки посреди запроса.
+    """
+    insert_for_dialect = _ON_CONFLICT_INSERTS.get(session.get_bind().dialect.name)
+    if insert_for_dialect is not None:
+        stmt = build(insert_for_dialect(table).on_conflict_do_nothing(index_elements=index_elements))
+        return list((await session.execute(stmt, params)).all())
+
+    stmt = build(insert(table))
+    rows = []
+    for one in params if params is not None else [None]:
+        try:
+            async with session.begin_nested():
+                rows.extend((await session.execute(stmt, one)).all())
+        except IntegrityError:
+            pass
+    return rows
+
+
 async def _register_entity(
         session: AsyncSession,
         model: Type[Any],
         data: Dict[str, Any],
-        check_filters: Optional[Dict[str, Any]] = None
+        conflict_keys: Optional[List[str]] = None,
+        on_insert: Optional[Callable[[Connection, Any], None]] = None,
+        user_tg_id: Optional[int] = None
 ) -> Any:
-    if check_filters:
-        existing = await _get_entity(session, model, check_filters)
-        if existing:
-            entity_name = model.__name__.lower()
-            raise ValueError(f"{entity_name.capitalize()} already exists")
-
-    entity = model(**data)
-    session.add(entity)
+    """
+    Создаёт запись. С conflict_keys — один INSERT ... ON CONFLICT DO NOTHING RETURNING:
+    проверка существования и вставка атомарны, и два одновременных /register
+    дают одну запись и ValueError вместо IntegrityError.
+    С user_tg_id колонка id берётся из строки пользователя с этим telegram_id
+    (INSERT ... SELECT FROM users): id не читается отдельным запросом до вставки.
+    События маппера при таком INSERT не срабатывают — их работу делает on_insert.
+    """
+    if conflict_keys is None:
+        entity = model(**data)
+        session.add(entity)
+        await session.commit()
+        await session.refresh(entity)
+        return entity
+
+    if user_tg_id is None:
+        def build(stmt):
+            return stmt.values(**data).returning(model)
+    else:
+        source = select(User.id, *(literal(value) for value in data.values())) \
+            .where(User.telegram_id == user_tg_id)
+
+        def build(stmt):
+            return stmt.from_select(["id", *data], source).returning(model)
+
+    rows = await _insert_skipping_conflicts(session, model, conflict_keys, build)
+    if not rows:
+        # Редкий путь: отличаем отсутствие пользователя от уже созданной записи
+        if user_tg_id is not None and (await session.execute(select(_user_id(user_tg_id)))).scalar() is None:
+            raise ValueError("User not found")
+        raise ValueError(f"{model.__name__} already exists")
+    entity = rows[0][0]
+    if on_insert is not None:
+        await session.run_sync(lambda s: on_insert(s.connection(), entity))
     await session.commit()
-    await session.refresh(entity)
     return entity
 
 
 async def _edit_entity(
         session: AsyncSession,
         model: Type[Any],
-        entity_id: int,
+        criteria: Any,
         changes: Dict[str, Any],
-        allowed_fields: set
+        allowed_fields: set,
+        on_update: Optional[Callable[[Connection, Any], None]] = None
 ) -> Optional[Any]:
+    """
+    Меняет поля записи одним UPDATE ... WHERE criteria RETURNING: без SELECT до
+    и refresh после. Записи нет — None.
+    События маппера при таком UPDATE не срабатывают — их работу делает on_update.
+    """
     if not set(changes.keys()).issubset(allowed_fields):
         raise ValueError(f"Invalid fields for {model.__name__} update")
 
-    entity = await session.get(model, entity_id)
-    if not entity:
-        return None
-
-    for key, value in changes.items():
-        setattr(entity, key, value)
+    if not changes:
+        return (await session.execute(select(model).where(criteria))).scalars().first()
 
+    stmt = update(model).where(criteria).values(**changes).returning(model)
+    entity = (await session.execute(stmt)).scalars().first()
+    if entity is None:
+        return None
+    if on_update is not None:
+        await session.run_sync(lambda s: on_update(s.connection(), entity))
     await session.commit()
-    await session.refresh(entity)
     return entity
 
 
-async def get_user_model(session: AsyncSession, tg_id: int) -> Optional[UserModel]:
-    user = await _get_entity(session, User, {"telegram_id": tg_id})
-    return UserModel(user) if user else None
+def _user_id(tg_id: int):
+    return select(User.id).where(User.telegram_id == tg_id).scalar_subquery()
+
+
+# Кэш UserModel по (telegram_id, профиль загрузки). Геттеры окон читают профиль на каждую
+# отрисовку; register_* и edit_user/player/master сбрасывают записи пользователя после commit.
+# "profile+games" не кэшируется: игры меняются и чужими действиями (заявки, правки игр).
+USER_CACHE_SIZE = 10_000
+USER_CACHE_TTL = 60.0
+USER_CACHE_PROFILES = ("bare", "profile")
+user_cache: TTLCache[UserModel] = TTLCache("user", maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def invalidate_user(tg_id: int) -> None:
+    for profile in USER_CACHE_PROFILES:
+        user_cache.pop((tg_id, profile))
+
 
+# Записи других воркеров приходят уведомлениями (см. bot.db.invalidation)
+invalidation.subscribe("user", lambda key: invalidate_user(int(key)))
+invalidation.subscribe_reset(user_cache.clear)
 
-async def get_player_model(session: AsyncSession, tg_id: int) -> Optional[PlayerModel]:
-    player = await _get_entity(session, Player, {"telegram_id": tg_id}, join_model=User)
+
+async def get_user_model(session: AsyncSession, tg_id: int, profile: str = "profile") -> Optional[UserModel]:
+    cacheable = profile in USER_CACHE_PROFILES
+    if cacheable:
+        cached = user_cache.get((tg_id, profile))
+        if cached is not None:
+            return cached
+        token = user_cache.token()
+
+    user = await _get_entity(session, User, {"telegram_id": tg_id}, profile=profile)
+    if not user:
+        return None
+    model = UserModel(user)
+    if cacheable:
+        # Пока ждали строку, её могли инвалидировать — тогда снимок не кэшируем
+        user_cache.set((tg_id, profile), model, token=token)
+    return model
+
+
+async def get_player_model(session: AsyncSession, tg_id: int, profile: str = "profile") -> Optional[PlayerModel]:
+    player = await _get_entity(session, Player, {"telegram_id": tg_id}, join_model=User, profile=profile)
     return PlayerModel(player) if player else None
 
 
-async def get_master_model(session: AsyncSession, tg_id: int) -> Optional[MasterModel]:
-    master = await _get_entity(session, Master, {"telegram_id": tg_id}, join_model=User)
+async def get_master_model(session: AsyncSession, tg_id: int, profile: str = "profile") -> Optional[MasterModel]:
+    master = await _get_entity(session, Master, {"telegram_id": tg_id}, join_model=User, profile=profile)
     return MasterModel(master) if master else None
 
 
-async def get_game_model(session: AsyncSession, game_id: int) -> Optional[SessionModel]:
-    game = await _get_entity(session, Session, {"id": game_id})
+async def get_game_model(session: AsyncSession, game_id: int, profile: str = "profile+games") -> Optional[SessionModel]:
+    game = await _get_entity(session, Session, {"id": game_id}, profile=profile)
     return SessionModel(game) if game else None
 
 
+async def get_player_games_overview(
+        session: AsyncSession,
+        tg_id: int,
+        archived: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    Все игры, в которые игрок подавал заявку, со статусом заявки — одним запросом.
+    Статус: "accepted" (игрок в session_players), "pending" (заявка на рассмотрении)
+    или "rejected". archived=True возвращает закрытые игры, иначе — открытые.
+    """
+    player_id = select(User.id).where(User.telegram_id == tg_id).scalar_subquery()
+    applied = union(
+        select(session_players.c.session_id).where(session_players.c.player_id == player_id),
+        select(session_requests.c.session_id).where(session_requests.c.player_id == player_id),
+    ).subquery()
+
+    request_status = case(
+        (session_players.c.player_id.is_not(None), "accepted"),
+        (session_requests.c.is_pending.is_(True), "pending"),
+        else_="rejected",
+    ).label("request_status")
+
+    stmt = (
+        select(Session.id, Session.title, Session.game_system, Session.date_time, request_status)
+        .join(applied, applied.c.session_id == Session.id)
+        .outerjoin(session_players, and_(session_players.c.session_id == Session.id,
+                                         session_players.c.player_id == player_id))
+        .outerjoin(session_requests, and_(session_requests.c.session_id == Session.id,
+                                          session_requests.c.player_id == player_id))
+        .where(Session.status.is_(not archived))
+        .order_by(Session.date_time, Session.id)
+    )
+    result = await session.execute(stmt)
+    return [dict(row) for row in result.mappings().all()]
+
+
+# --- заявки на участие ---
+# Заявка живёт в session_requests, пока мастер её не рассмотрел (is_pending = True).
+# Принятая заявка переезжает в session_players, отклонённая остаётся с is_pending = False —
+# по ней get_player_games_overview показывает статус "rejected".
+
+async def apply_to_game(session: AsyncSession, tg_id: int, game_id: int) -> bool:
+    """
+    Заявка игрока на открытую игру одним INSERT ... SELECT ... ON CONFLICT DO NOTHING.
+    False — заявку подать нельзя: нет анкеты игрока, игра закрыта или своя, игрок уже
+    в игре или уже подавал заявку (в том числе отклонённую).
+    """
+    player_id = _user_id(tg_id)
+    already_playing = exists().where(session_players.c.session_id == Session.id,
+                                     session_players.c.player_id == Player.id)
+    source = (
+        select(Session.id, Player.id, true())
+        .join(Player, Player.id == player_id)
+        .where(Session.id == game_id, Session.status.is_(True), Session.creator_id != Player.id, ~already_playing)
+    )
+    inserted = await _insert_skipping_conflicts(
+        session, session_requests, ["session_id", "player_id"],
+        lambda stmt: stmt.from_select(["session_id", "player_id", "is_pending"], source)
+        .returning(session_requests.c.session_id)
+    )
+    await session.commit()
+    return bool(inserted)
+
+
+async def get_game_requests(session: AsyncSession, game_id: int) -> List[Dict[str, Any]]:
+    """Заявки на рассмотрении: игрок (player_id, telegram_id, имя, опыт, город)."""
+    stmt = (
+        select(Player.id.label("player_id"), User.telegram_id, User.name, User.city, Player.experience_level)
+        .join(session_requests, session_requests.c.player_id == Player.id)
+        .join(User, User.id == Player.id)
+        .where(session_requests.c.session_id == game_id, session_requests.c.is_pending.is_(True))
+        .order_by(Player.id)
+    )
+    result = await session.execute(stmt)
+    return [
+        {**row, "experience_level": all_experience_levels[row["experience_level"] or 0]}
+        for row in result.mappings().all()
+    ]
+
+
+async def accept_request(session: AsyncSession, game_id: int, player_id: int) -> str:
+    """
+    Принимает заявку на рассмотрении: строка переезжает в session_players.
+    Результат: "accepted"; "full" — свободных мест нет (заявка остаётся на рассмотрении);
+    "missing" — такой заявки нет.
+    """
+    pending = exists().where(session_requests.c.session_id == Session.id,
+                             session_requests.c.player_id == player_id,
+                             session_requests.c.is_pending.is_(True))
+    # Строка игры блокируется, чтобы два принятия в одну игру не заняли одно место
+    # (SQLite пишет последовательно и FOR UPDATE не выводит)
+    await session.execute(select(Session.id).where(Session.id == game_id).with_for_update())
+    # Проверка места и вставка — одним INSERT ... SELECT
+    source = (
+        select(Session.id, literal(player_id))
+        .where(Session.id == game_id, pending,
+               or_(Session.max_players.is_(None), _current_players() < Session.max_players))
+    )
+    seated = await session.execute(
+        insert(session_players).from_select(["session_id", "player_id"], source)
+        .returning(session_players.c.session_id)
+    )
+    if seated.first() is None:
+        still_pending = await session.scalar(select(pending).select_from(Session).where(Session.id == game_id))
+        await session.rollback()
+        return "full" if still_pending else "missing"
+    await session.execute(
+        delete(session_requests).where(session_requests.c.session_id == game_id,
+                                       session_requests.c.player_id == player_id)
+    )
+    # Свободных мест стало меньше — признаки игр для подбора пересчитываются
+    await session.run_sync(lambda s: invalidation.publish(s.connection(), "game", game_id))
+    await session.commit()
+    game_candidates_cache.invalidate()
+    return "accepted"
+
+
+async def reject_request(session: AsyncSession, game_id: int, player_id: int) -> bool:
+    """Отклоняет заявку на рассмотрении. False — такой заявки нет."""
+    result = await session.execute(
+        update(session_requests)
+        .where(session_requests.c.session_id == game_id, session_requests.c.player_id == player_id,
+               session_requests.c.is_pending.is_(True))
+        .values(is_pending=False)
+    )
+    await session.commit()
+    return result.rowcount > 0
+
+
+OPEN_GAMES_PAGE_SIZE = 8
+
+
+def _current_players():
+    """Число игроков в игре — коррелированный подзапрос к session_players."""
+    return (
+        select(func.count())
+        .where(session_players.c.session_id == Session.id)
+        .correlate(Session)
+        .scalar_subquery()
+    )
+
+
+def _open_games_select(filters: Optional[GameFilters] = None) -> Select:
+    """Открытые игры с городом, именем мастера и числом игроков — общая часть запросов поиска."""
+    current_players = _current_players().label("current_players")
+    stmt = (
+        select(Session.id, Session.title, Session.game_system, Session.format, Session.date_time,
+               Session.max_players, Session.city,
+               User.name.label("master_name"), current_players)
+        .join(User, User.id == Session.creator_id)
+        .where(Session.status.is_(True))
+    )
+    if filters is not None:
+        stmt = stmt.where(*filters.conditions())
+    return stmt
+
+
+def _split_page(rows: List[Dict[str, Any]], limit: int, key: Tuple[str, ...]) -> Tuple[List[Dict[str, Any]], Any]:
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, tuple(rows[-1][k] for k in key)
+
+
+async def get_open_games_page(
+        session: AsyncSession,
+        after: Optional[Tuple[str, int]] = None,
+        limit: int = OPEN_GAMES_PAGE_SIZE,
+        filters: Optional[GameFilters] = None
+) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, int]]]:
+    """
+    Страница открытых игр, отсортированных по (title, id), с keyset-пагинацией.
+    after — ключ (title, id) последней игры предыдущей страницы, None — первая страница.
+    filters — фильтры поиска, они добавляются в тот же запрос.
+    Возвращает (игры, ключ для следующей страницы или None, если страница последняя).
+    Читается limit + 1 строка: лишняя показывает, что есть следующая страница.
+    """
+    stmt = _open_games_select(filters).order_by(Session.title, Session.id).limit(limit + 1)
+    if after is not None:
+        stmt = stmt.where(tuple_(Session.title, Session.id) > tuple_(*after))
+
+    result = await session.execute(stmt)
+    return _split_page([dict(row) for row in result.mappings().all()], limit, ("title", "id"))
+
+
+async def search_open_games(
+        session: AsyncSession,
+        query: str,
+        after: Optional[Tuple[float, int]] = None,
+        limit: int = OPEN_GAMES_PAGE_SIZE,
+        filters: Optional[GameFilters] = None
+) -> Tuple[List[Dict[str, Any]], Optional[Tuple[float, int]]]:
+    """
+    Текстовый поиск по названию, системе и описанию открытых игр с ранжированием.
+    Игры идут по убыванию rank (при равенстве — по id); after — ключ (rank, id)
+    последней игры предыдущей страницы. Возвращает то же, что get_open_games_page,
+    у каждой игры есть поле rank.
+
+    В PostgreSQL — tsvector (русская конфигурация) и pg_trgm по индексам из bot.db.base,
+    в остальных БД — GameSearchIndex в памяти по открытым играм, прошедшим фильтры.
+    """
+    groups = parse_query(query)
+    if not groups:
+        return [], None
+
+    if session.bind.dialect.name == "postgresql":
+        rows = await _search_open_games_pg(session, query, groups, after, limit, filters)
+    else:
+        rows = await _search_open_games_fallback(session, query, after, limit, filters)
+    return _split_page(rows, limit, ("rank", "id"))
+
+
+async def _search_open_games_pg(
+        session: AsyncSession,
+        query: str,
+        groups: List[Tuple[Tuple[str, ...], ...]],
+        after: Optional[Tuple[float, int]],
+        limit: int,
+        filters: Optional[GameFilters]
+) -> List[Dict[str, Any]]:
+    document = search_document(Session.title, Session.game_system, Session.description)
+    tsquery = func.to_tsquery(literal_column("'russian'"), to_tsquery_text(groups))
+    similar = []
+    similarity = []
+    for variant in query_variants(query):
+        for column in (Session.title, Session.game_system):
+            similar.append(literal(variant).op("<%")(column))
+            similarity.append(func.word_similarity(variant, func.coalesce(column, "")))
+    rank = func.round(
+        cast(func.ts_rank(document, tsquery) + func.greatest(*similarity), Numeric), 6
+    ).label("rank")
+
+    stmt = (
+        _open_games_select(filters)
+        .add_columns(rank)
+        .where(or_(document.bool_op("@@")(tsquery), *similar))
+        .order_by(rank.desc(), Session.id)
+        .limit(limit + 1)
+    )
+    if after is not None:
+        stmt = stmt.where(or_(rank < after[0], and_(rank == after[0], Session.id > after[1])))
+    result = await session.execute(stmt)
+    return [{**row, "rank": float(row["rank"])} for row in result.mappings().all()]
+
+
+async def _search_open_games_fallback(
+        session: AsyncSession,
+        query: str,
+        after: Optional[Tuple[float, int]],
+        limit: int,
+        filters: Optional[GameFilters]
+) -> List[Dict[str, Any]]:
+    candidates = select(Session.id, Session.title, Session.game_system, Session.description) \
+        .join(User, User.id == Session.creator_id).where(Session.status.is_(True))
+    if filters is not None:
+        candidates = candidates.where(*filters.conditions())
+    index = GameSearchIndex()
+    for row in (await session.execute(candidates)).all():
+        index.add(row.id, row.title, row.game_system, row.description)
+
+    hits = index.search(query)
+    if after is not None:
+        hits = [h for h in hits if (-h.rank, h.id) > (-after[0], after[1])]
+    hits = hits[:limit + 1]
+    if not hits:
+        return []
+
+    result = await session.execute(_open_games_select().where(Session.id.in_([h.id for h in hits])))
+    rows = {row["id"]: dict(row) for row in result.mappings().all()}
+    return [{**rows[h.id], "rank": h.rank} for h in hits]
+
+
+async def get_game_candidates(
+        session: AsyncSession,
+        filters: Optional[GameFilters] = None,
+        exclude_creator_id: Optional[int] = None
+) -> GameCandidates:
+    """Признаки всех открытых игр (с учётом фильтров) для ранжирования — одним запросом."""
+    current_players = _current_players().label("current_players")
+    stmt = (
+        select(Session.id, Session.creator_id, Session.format, Session.game_system, Session.city_key,
+               Session.is_paid, User.time_zone, Session.min_age, Session.max_age, Session.max_players,
+               current_players)
+        .join(User, User.id == Session.creator_id)
+        .where(Session.status.is_(True))
+    )
+    if filters is not None:
+        stmt = stmt.where(*filters.conditions())
+    if exclude_creator_id is not None:
+        stmt = stmt.where(Session.creator_id != exclude_creator_id)
+    result = await session.execute(stmt)
+    return GameCandidates.from_rows(result.mappings().all())
+
+
+# Признаки всех открытых игр для recommend_games. Игры этого процесса сбрасывают набор
+# сразу (register_game, edit_game, register_games_bulk, accept_request), других воркеров —
+# уведомлением "game"; новые игры импорта из других процессов видны через CANDIDATES_TTL
+game_candidates_cache = GameCandidatesCache(get_game_candidates)
+invalidation.subscribe("game", game_candidates_cache.invalidate)
+invalidation.subscribe_reset(game_candidates_cache.invalidate)
+
+
+async def recommend_games(
+        session: AsyncSession,
+        tg_id: int,
+        k: int = OPEN_GAMES_PAGE_SIZE,
+        filters: Optional[GameFilters] = None
+) -> List[Dict[str, Any]]:
+    """
+    k открытых игр, лучше всего подходящих игроку по его профилю (см. GameCandidates.scores),
+    в порядке убывания оценки. Игры самого игрока не предлагаются.
+    Строки — как у get_open_games_page, с полем score.
+    """
+    result = await session.execute(
+        select(User.id, User.game_format, User.preferred_systems, User.time_zone, User.age)
+        .where(User.telegram_id == tg_id)
+    )
+    user = result.first()
+    if user is None:
+        return []
+    player = PlayerProfile(user.game_format, split_systems(user.preferred_systems), user.time_zone, user.age)
+
+    candidates = await game_candidates_cache.get(session)
+    allowed = candidates.creator_ids != user.id
+    if filters is not None:
+        allowed &= candidates.filter_mask(filters)
+    best = candidates.top_k(player, k, allowed)
+    if not best:
+        return []
+
+    # Набор мог устареть: игры, закрытые с тех пор, отсеивает запрос строк
+    result = await session.execute(_open_games_select().where(Session.id.in_([i for i, _ in best])))
+    rows = {row["id"]: dict(row) for row in result.mappings().all()}
+    return [{**rows[i], "score": score} for i, score in best if i in rows]
+
+
+# Максимальная разница часовых поясов игрока и мастера при подборе игроков
+MATCH_TZ_DISTANCE = 3
+
+
+async def find_players_for_game(
+        session: AsyncSession,
+        game_id: int,
+        limit: int = 10
+) -> List[Dict[str, Any]]:
+    """
+    Игроки, которые лучше всего подходят для игры. Формат игры обязателен; дальше порядок:
+    сначала игроки с системой игры среди предпочитаемых, затем остальные; внутри — по близости
+    часового пояса к мастеру (не дальше MATCH_TZ_DISTANCE), затем по опыту.
+
+    Каждая корзина (система, формат, пояс) читается по ix_player_match_keys_bucket не больше
+    чем на limit строк, поэтому работа не зависит от числа зарегистрированных игроков.
+    Создатель игры и уже принятые игроки не предлагаются.
+    """
+    result = await session.execute(
+        select(Session.id, Session.format, Session.game_system, Session.creator_id,
+               Session.min_age, Session.max_age, User.time_zone)
+        .join(User, User.id == Session.creator_id)
+        .where(Session.id == game_id)
+    )
+    game = result.first()
+    if game is None:
+        return []
+
+    system_key = (split_systems(game.game_system) or ("",))[0]
+    keys = player_match_keys.c
+    joined = (
+        select(session_players.c.player_id)
+        .where(session_players.c.session_id == game.id, session_players.c.player_id == keys.player_id)
+    )
+    other = player_match_keys.alias("other")
+    matches_system = (
+        select(other.c.player_id)
+        .where(other.c.player_id == keys.player_id, other.c.system_key == system_key,
+               other.c.format == game.format)
+    )
+
+    buckets = []
+    tiers = [(0, system_key)] + ([(1, "")] if system_key else [])
+    for tier, key in tiers:
+        for distance in range(MATCH_TZ_DISTANCE + 1):
+            bucket = (
+                select(keys.player_id, keys.time_zone, keys.experience_level,
+                       literal(tier).label("tier"), literal(distance).label("distance"))
+                .where(keys.system_key == key, keys.format == game.format,
+                       keys.time_zone.in_({game.time_zone - distance, game.time_zone + distance}),
+                       keys.player_id != game.creator_id, ~joined.exists())
+                .order_by(keys.experience_level.desc(), keys.player_id.desc())
+                .limit(limit)
+            )
+            if game.min_age is not None:
+                bucket = bucket.where(keys.age >= game.min_age)
+            if game.max_age is not None:
+                bucket = bucket.where(keys.age <= game.max_age)
+            if tier == 1:
+                bucket = bucket.where(~matches_system.exists())
+            buckets.append(select(bucket.subquery()))
+
+    found = union_all(*buckets).subquery()
+    stmt = (
+        select(found, User.name, User.telegram_id, User.city)
+        .join(User, User.id == found.c.player_id)
+        .order_by(found.c.tier, found.c.distance, found.c.experience_level.desc(), found.c.player_id.desc())
+        .limit(limit)
+    )
+    result = await session.execute(stmt)
+    return [
+        {
+            "player_id": r["player_id"],
+            "telegram_id": r["telegram_id"],
+            "name": r["name"],
+            "city": r["city"],
+            "time_zone": r["time_zone"],
+            "experience_level": all_experience_levels[r["experience_level"]],
+            "system_match": r["tier"] == 0 and bool(system_key),
+            "tz_distance": r["distance"],
+        }
+        for r in result.mappings().all()
+    ]
+
+
+async def get_user_systems(session: AsyncSession, tg_id: int) -> List[str]:
+    """Предпочитаемые системы пользователя из справочника, по алфавиту."""
+    result = await session.execute(
+        select(game_systems.c.name)
+        .join(user_game_systems, user_game_systems.c.system_id == game_systems.c.id)
+        .join(User, User.id == user_game_systems.c.user_id)
+        .where(User.telegram_id == tg_id)
+        .order_by(game_systems.c.key)
+    )
+    return list(result.scalars().all())
+
+
+async def get_users_by_system(
+        session: AsyncSession,
+        system: str,
+        limit: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Пользователи, у которых система среди предпочитаемых (регистр и пробелы не важны)."""
+    stmt = (
+        select(User.id, User.telegram_id, User.name)
+        .join(user_game_systems, user_game_systems.c.user_id == User.id)
+        .join(game_systems, game_systems.c.id == user_game_systems.c.system_id)
+        .where(game_systems.c.key == system_key(system))
+        .order_by(User.id)
+        .limit(limit)
+    )
+    result = await session.execute(stmt)
+    return [dict(r) for r in result.mappings().all()]
+
+
+async def get_top_systems(session: AsyncSession, limit: int = 10) -> List[Dict[str, Any]]:
+    """
+    Самые популярные системы как [{"id", "name", "uses"}]: uses — сколько пользователей
+    их предпочитают плюс сколько игр по ним создано. Считается по связям, без разбора строк.
+    """
+    mentions = union_all(
+        select(user_game_systems.c.system_id),
+        select(session_game_systems.c.system_id),
+    ).subquery()
+    uses = func.count().label("uses")
+    stmt = (
+        select(game_systems.c.id, game_systems.c.name, uses)
+        .join(mentions, mentions.c.system_id == game_systems.c.id)
+        .group_by(game_systems.c.id, game_systems.c.name, game_systems.c.key)
+        .order_by(uses.desc(), game_systems.c.key)
+        .limit(limit)
+    )
+    result = await session.execute(stmt)
+    return [dict(r) for r in result.mappings().all()]
+
+
 async def register_user(user_model: UserModel, session: AsyncSession) -> UserModel:
     role_mask = sum(1 << all_roles.index(r) for r in user_model.role.split(', '))
     format_mask = sum(1 << all_formats.index(f) for f in user_model.game_format.split(', '))
@@ -113,38 +733,34 @@ async def register_user(user_model: UserModel, session: AsyncSession) -> UserMod
         session,
         User,
         user_data,
-        check_filters={"telegram_id": user_model.telegram_id}
+        conflict_keys=["telegram_id"],
+        on_insert=lambda c, u: sync_user_systems(c, u.id, u.preferred_systems)
     )
+    invalidate_user(user_model.telegram_id)
     return UserModel(user)
 
 
 async def register_player(player_model: PlayerModel, session: AsyncSession) -> PlayerModel:
-    user = await get_user_model(session, player_model.user.telegram_id)
-    if not user:
-        raise ValueError("User not found")
-
+    tg_id = player_model.user.telegram_id
     player_data = {
-        "id": user.id,
         "experience_level": all_experience_levels.index(player_model.experience_level),
         "availability": player_model.availability
     }
 
+    def on_insert(connection: Connection, player: Player) -> None:
+        player_features.refresh_player_match_keys(connection, player.id)
+        invalidation.publish(connection, "user", tg_id)
+
     player = await _register_entity(
-        session,
-        Player,
-        player_data,
-        check_filters={"id": user.id}
+        session, Player, player_data, conflict_keys=["id"], on_insert=on_insert, user_tg_id=tg_id
     )
+    invalidate_user(tg_id)
     return PlayerModel(player)
 
 
 async def register_master(master_model: MasterModel, session: AsyncSession) -> MasterModel:
-    user = await get_user_model(session, master_model.user.telegram_id)
-    if not user:
-        raise ValueError("User not found")
-
+    tg_id = master_model.user.telegram_id
     master_data = {
-        "id": user.id,
         "master_style": master_model.master_style,
         "rating": master_model.rating
     }
@@ -153,11 +769,25 @@ async def register_master(master_model: MasterModel, session: AsyncSession) -> M
         session,
         Master,
         master_data,
-        check_filters={"id": user.id}
+        conflict_keys=["id"],
+        on_insert=lambda c, m: invalidation.publish(c, "user", tg_id),
+        user_tg_id=tg_id
     )
+    invalidate_user(tg_id)
     return MasterModel(master)
 
 
+def _game_master_id(looking_for: str, creator_id: int):
+    """
+    master_id новой игры: игру, которая ищет игроков, ведёт её создатель — если у него
+    есть анкета мастера (иначе NULL: master_id ссылается на masters). Игра, которая
+    ищет мастера, создаётся без него.
+    """
+    if looking_for != all_roles[0]:
+        return None
+    return select(Master.id).where(Master.id == creator_id).scalar_subquery()
+
+
 async def register_game(game_model: SessionModel, session: AsyncSession) -> SessionModel:
     if game_model.format not in all_formats:
         raise ValueError(f"Invalid format: {game_model.format}")
@@ -173,82 +803,278 @@ async def register_game(game_model: SessionModel, session: AsyncSession) -> Sess
         "status": game_model.status,
         "max_players": game_model.max_players,
         "looking_for": all_roles.index(game_model.looking_for),
-        "creator_id": game_model.creator.id
+        "city": game_model.city or game_model.creator.city,
+        "is_paid": bool(game_model.is_paid),
+        "min_age": game_model.min_age,
+        "max_age": game_model.max_age,
+        "creator_id": game_model.creator.id,
+        "master_id": _game_master_id(game_model.looking_for, game_model.creator.id)
     }
 
     game = await _register_entity(session, Session, game_data)
+    game_candidates_cache.invalidate()
     return SessionModel(game)
 
 
+BULK_BATCH_SIZE = 1000
+
+
+def _parse_rows(rows: Iterable[Dict[str, Any]], parse, result: BulkResult) -> List[Tuple[int, Any]]:
+    parsed = []
+    for i, row in enumerate(rows):
+        try:
+            parsed.append((i, parse(row)))
+        except ValueError as e:
+            result.conflicts[i] = str(e)
+    return parsed
+
+
+async def register_users_bulk(
+        rows: Iterable[Dict[str, Any]],
+        session: AsyncSession,
+        batch_size: int = BULK_BATCH_SIZE
+) -> BulkResult:
+    """
+    Массовая регистрация пользователей (например, импорт из таблицы сообщества).
+    Строка может содержать поля профиля игрока (experience_level, availability)
+    и мастера (master_style, rating) — тогда профиль создаётся вместе с пользователем.
+
+    Пачка из batch_size строк — один INSERT ... ON CONFLICT (telegram_id) DO NOTHING
+    с RETURNING и commit. Уже зарегистрированные, повторяющиеся и некорректные строки
+    попадают в conflicts, остальные — в created (номер строки -> id пользователя).
+    События маппера при таком INSERT не срабатывают, поэтому связи систем
+    и player_match_keys заполняются здесь же, одним набором запросов на пачку.
+    """
+    result = BulkResult()
+    parsed = _parse_rows(rows, lambda r: (user_row(r), player_row(r), master_row(r)), result)
+
+    seen = set()
+    unique = []
+    for i, (user, player, master) in parsed:
+        if user["telegram_id"] in seen:
+            result.conflicts[i] = f"duplicate telegram_id {user['telegram_id']} in input"
+            continue
+        seen.add(user["telegram_id"])
+        unique.append((i, user, player, master))
+
+    users = User.__table__
+    for start in range(0, len(unique), batch_size):
+        batch = unique[start:start + batch_size]
+        inserted = await _insert_skipping_conflicts(
+            session, users, ["telegram_id"], lambda stmt: stmt.returning(users.c.id, users.c.telegram_id),
+            [user for _, user, _, _ in batch]
+        )
+        ids = dict((tg_id, user_id) for user_id, tg_id in inserted)
+
+        players, masters, systems = [], [], {}
+        for i, user, player, master in batch:
+            user_id = ids.get(user["telegram_id"])
+            if user_id is None:
+                result.conflicts[i] = f"telegram_id {user['telegram_id']} is already registered"
+                continue
+            result.created[i] = user_id
+            systems[user_id] = user["preferred_systems"]
+            if player is not None:
+                players.append({"id": user_id, **player})
+            if master is not None:
+                masters.append({"id": user_id, **master})
+        if players:
+            await session.execute(Player.__table__.insert(), players)
+        if masters:
+            await session.execute(Master.__table__.insert(), masters)
+
+        def sync(s):
+            connection = s.connection()
+            link_systems(connection, user_game_systems, "user_id", systems)
+            player_features.refresh_player_match_keys(connection, *(p["id"] for p in players))
+
+        await session.run_sync(sync)
+        await session.commit()
+    return result
+
+
+async def register_games_bulk(
+        rows: Iterable[Dict[str, Any]],
+        session: AsyncSession,
+        batch_size: int = BULK_BATCH_SIZE
+) -> BulkResult:
+    """
+    Массовое создание игр. Создатель задаётся creator_id или creator_telegram_id.
+    Строки с id вставляются через ON CONFLICT (id) DO NOTHING, поэтому повторный
+    импорт того же файла ничего не дублирует; строки без id всегда создают новую игру.
+    Незарегистрированный создатель и повтор id во входных данных — conflicts строки.
+    """
+    result = BulkResult()
+    parsed = _parse_rows(rows, game_row, result)
+
+    # Создатели проверяются заранее (по запросу на telegram_id и на id): строка с чужим
+    # creator_id иначе уронила бы FK-ошибкой всю пачку, а предыдущие пачки уже в базе
+    tg_ids = {game["creator_telegram_id"] for _, game in parsed if "creator_telegram_id" in game}
+    by_tg: Dict[int, int] = {}
+    cities: Dict[int, str] = {}
+    masters = set()
+    creators = select(User.telegram_id, User.id, User.city, Master.id).outerjoin(Master, Master.id == User.id)
+    if tg_ids:
+        found = await session.execute(creators.where(User.telegram_id.in_(tg_ids)))
+        for tg_id, user_id, city, master_id in found.all():
+            by_tg[tg_id] = user_id
+            cities[user_id] = city
+            if master_id is not None:
+                masters.add(master_id)
+    user_ids = {game["creator_id"] for _, game in parsed if game["creator_id"] is not None}
+    if user_ids:
+        found = await session.execute(creators.where(User.id.in_(user_ids)))
+        for _, user_id, city, master_id in found.all():
+            cities[user_id] = city
+            if master_id is not None:
+                masters.add(master_id)
+
+    seen = set()
+    ready = []
+    for i, game in parsed:
+        tg_id = game.pop("creator_telegram_id", None)
+        if tg_id is not None:
+            if tg_id not in by_tg:
+                result.conflicts[i] = f"creator telegram_id {tg_id} is not registered"
+                continue
+            game["creator_id"] = by_tg[tg_id]
+        elif game["creator_id"] not in cities:
+            result.conflicts[i] = f"creator id {game['creator_id']} is not registered"
+            continue
+        if "id" in game:
+            if game["id"] in seen:
+                result.conflicts[i] = f"duplicate game id {game['id']} in input"
+                continue
+            seen.add(game["id"])
+        # Игра без своего города проводится в городе создателя
+        if not game["city"]:
+            game["city"] = cities[game["creator_id"]]
+        # Как в register_game: игру, которая ищет игроков, ведёт создатель-мастер
+        game["master_id"] = game["creator_id"] \
+            if game["looking_for"] == 0 and game["creator_id"] in masters else None
+        ready.append((i, game))
+
+    table = Session.__table__
+    # Строки RETURNING в порядке параметров — так id сопоставляются со строками без ключа
+    without_id = table.insert().returning(table.c.id, sort_by_parameter_order=True)
+    for start in range(0, len(ready), batch_size):
+        batch = ready[start:start + batch_size]
+        systems = {}
+        keyed = [(i, g) for i, g in batch if "id" in g]
+        if keyed:
+            inserted = {game_id for (game_id,) in await _insert_skipping_conflicts(
+                session, table, ["id"], lambda stmt: stmt.returning(table.c.id), [g for _, g in keyed])}
+            for i, game in keyed:
+                if game["id"] in inserted:
+                    result.created[i] = game["id"]
+                    systems[game["id"]] = game["game_system"]
+                else:
+                    result.conflicts[i] = f"game id {game['id']} already exists"
+        fresh = [(i, g) for i, g in batch if "id" not in g]
+        if fresh:
+            inserted = await session.execute(without_id, [g for _, g in fresh])
+            for (i, game), (game_id,) in zip(fresh, inserted.all()):
+                result.created[i] = game_id
+                systems[game_id] = game["game_system"]
+
+        await session.run_sync(lambda s: link_systems(s.connection(), session_game_systems, "session_id", systems))
+        if keyed and session.get_bind().dialect.name == "postgresql":
+            # Явные id не двигают последовательность — иначе следующая игра без id получит занятый
+            await session.execute(select(func.setval(func.pg_get_serial_sequence("sessions", "id"),
+                                                     select(func.max(Session.id)).scalar_subquery())))
+        await session.commit()
+    game_candidates_cache.invalidate()
+    return result
+
+
 async def edit_user(tg_id: int, changes: dict, session: AsyncSession) -> Optional[UserModel]:
     allowed_fields = {
         "name", "age", "city", "time_zone",
         "preferred_systems", "about_info"
     }
 
-    user = await get_user_model(session, tg_id)
-    if not user:
-        return None
+    def on_update(connection: Connection, user: User) -> None:
+        if "preferred_systems" in changes:
+            sync_user_systems(connection, user.id, user.preferred_systems)
+        if any(name in changes for name in player_features.USER_MATCH_FIELDS):
+            player_features.refresh_player_match_keys(connection, user.id)
+        invalidation.publish(connection, "user", tg_id)
 
     updated_user = await _edit_entity(
         session,
         User,
-        user.id,
+        User.telegram_id == tg_id,
         changes,
-        allowed_fields
+        allowed_fields,
+        on_update
     )
+    invalidate_user(tg_id)
     return UserModel(updated_user) if updated_user else None
 
 
 async def edit_player(tg_id: int, changes: dict, session: AsyncSession) -> Optional[PlayerModel]:
     allowed_fields = {"experience_level", "availability"}
 
-    player = await get_player_model(session, tg_id)
-    if not player:
-        return None
+    def on_update(connection: Connection, player: Player) -> None:
+        player_features.refresh_player_match_keys(connection, player.id)
+        invalidation.publish(connection, "user", tg_id)
 
     updated_player = await _edit_entity(
         session,
         Player,
-        player.id,
+        Player.id == _user_id(tg_id),
         changes,
-        allowed_fields
+        allowed_fields,
+        on_update
     )
+    invalidate_user(tg_id)
     return PlayerModel(updated_player) if updated_player else None
 
 
 async def edit_master(tg_id: int, changes: dict, session: AsyncSession) -> Optional[MasterModel]:
     allowed_fields = {"master_style", "rating"}
 
-    master = await get_master_model(session, tg_id)
-    if not master:
-        return None
-
     updated_master = await _edit_entity(
         session,
         Master,
-        master.id,
+        Master.id == _user_id(tg_id),
         changes,
-        allowed_fields
+        allowed_fields,
+        lambda c, m: invalidation.publish(c, "user", tg_id)
     )
+    invalidate_user(tg_id)
     return MasterModel(updated_master) if updated_master else None
 
 
 async def edit_game(game_id: int, changes: dict, session: AsyncSession) -> Optional[SessionModel]:
     allowed_fields = {
         "title", "description", "game_system",
-        "date_time", "status", "max_players"
+        "date_time", "status", "max_players",
+        "city", "is_paid", "min_age", "max_age"
     }
 
-    game = await get_game_model(session, game_id)
-    if not game:
-        return None
+    if "city" in changes:
+        # Город игры обязателен: пустой — снова город создателя
+        changes = dict(changes)
+        if not changes["city"]:
+            creator_city = select(User.city).join(Session, Session.creator_id == User.id).where(Session.id == game_id)
+            changes["city"] = (await session.execute(creator_city)).scalar()
+        changes["city_key"] = normalize_city(changes["city"])
+        allowed_fields = allowed_fields | {"city_key"}
+
+    def on_update(connection: Connection, game: Session) -> None:
+        if "game_system" in changes:
+            sync_session_systems(connection, game.id, game.game_system)
+        invalidation.publish(connection, "game", game.id)
 
     updated_game = await _edit_entity(
         session,
         Session,
-        game.id,
+        Session.id == game_id,
         changes,
-        allowed_fields
+        allowed_fields,
+        on_update
     )
+    if updated_game:
+        game_candidates_cache.invalidate()
     return SessionModel(updated_game) if updated_game else None
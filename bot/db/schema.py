@@ -0,0 +1,120 @@
+# bot/db/schema.py
+"""
+Обновление схемы уже развёрнутой базы до текущих моделей bot.db.base.
+
+create_all создаёт только отсутствующие таблицы и не меняет существующие, поэтому
+после обновления кода база, созданная старой версией, падает на первом запросе
+с новыми колонками (sessions.city, city_key, is_paid, min_age, max_age). upgrade_schema
+досоздаёт таблицы, колонки и индексы, которых не хватает; остальное не трогает,
+повторный запуск ничего не делает.
+
+NOT NULL колонка без default добавляется без ограничения, заполняется функцией из
+FILLS и только потом получает NOT NULL (в PostgreSQL; SQLite не меняет ограничения
+существующих колонок). Колонки удаляются и меняют тип только вручную.
+
+Запускается командой python -m bot.db.backfill schema (или all).
+"""
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import Column, Connection, Table, bindparam, inspect, literal, select, update
+
+from bot.db.base import Base, PG_TRGM_EXTENSION, User, Session, normalize_city
+
+
+def fill_session_city(connection: Connection) -> int:
+    """Город игры без своего — город создателя; city_key — ключ города. Возвращает число игр."""
+    creator_city = select(User.city).where(User.id == Session.creator_id).scalar_subquery()
+    filled = connection.execute(update(Session).where(Session.city.is_(None)).values(city=creator_city)).rowcount
+    rows = connection.execute(select(Session.id, Session.city).where(Session.city_key.is_(None))).all()
+    if rows:
+        table = Session.__table__
+        connection.execute(
+            update(table).where(table.c.id == bindparam("game_id")).values(city_key=bindparam("key")),
+            [{"game_id": game_id, "key": normalize_city(city)} for game_id, city in rows],
+        )
+    return max(filled, len(rows))
+
+
+FILLS: Dict[str, Callable[[Connection], int]] = {
+    "sessions.city": fill_session_city,
+    "sessions.city_key": fill_session_city,
+}
+
+
+def _column_default(column: Column) -> Any:
+    if column.default is not None and column.default.is_scalar:
+        return column.default.arg
+    return None
+
+
+def add_column_ddl(connection: Connection, table: Table, column: Column) -> str:
+    """
+    ALTER TABLE ... ADD COLUMN для колонки модели. Скалярный default модели становится
+    DEFAULT колонки: так NOT NULL колонка добавляется в таблицу, где уже есть строки.
+    NOT NULL колонка без default добавляется без ограничения — её заполняет FILLS.
+    """
+    dialect = connection.dialect
+    preparer = dialect.identifier_preparer
+    ddl = (f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} "
+           f"{column.type.compile(dialect=dialect)}")
+    default = _column_default(column)
+    if default is not None:
+        ddl += " DEFAULT " + str(literal(default).compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    if not column.nullable and default is not None:
+        ddl += " NOT NULL"
+    elif not column.nullable and f"{table.name}.{column.name}" not in FILLS:
+        raise RuntimeError(f"{table.name}.{column.name}: NOT NULL без default — нужна ручная миграция")
+    return ddl
+
+
+def upgrade_schema(connection: Connection) -> Dict[str, List[str]]:
+    """Досоздаёт недостающие таблицы, колонки и индексы. Возвращает, что было изменено."""
+    inspector = inspect(connection)
+    existing = set(inspector.get_table_names())
+    tables = [t for t in Base.metadata.sorted_tables if t.name not in existing]
+    if connection.dialect.name == "postgresql":
+        connection.execute(PG_TRGM_EXTENSION)
+    # Вместе с таблицами создаются и их индексы
+    Base.metadata.create_all(connection, tables=tables)
+
+    columns, filled, indexes = [], [], []
+    fills: Dict[Callable[[Connection], int], List[str]] = {}
+    for table in Base.metadata.sorted_tables:
+        if table in tables:
+            continue
+        present = {c["name"]: c for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            name = f"{table.name}.{column.name}"
+            if column.name not in present:
+                connection.exec_driver_sql(add_column_ddl(connection, table, column))
+                columns.append(name)
+            elif column.nullable or not present[column.name]["nullable"]:
+                continue
+            if name in FILLS:
+                fills.setdefault(FILLS[name], []).append(name)
+
+    for fill, names in fills.items():
+        if fill(connection):
+            filled.extend(names)
+        if connection.dialect.name == "postgresql":
+            preparer = connection.dialect.identifier_preparer
+            for name in names:
+                table_name, column_name = name.split(".")
+                connection.exec_driver_sql(f"ALTER TABLE {preparer.quote(table_name)} "
+                                           f"ALTER COLUMN {preparer.quote(column_name)} SET NOT NULL")
+
+    for table in Base.metadata.sorted_tables:
+        if table in tables:
+            continue
+        present = {i["name"] for i in inspect(connection).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in present:
+                continue
+            ddl_if = index._ddl_if
+            if ddl_if is not None and ddl_if.dialect not in (None, connection.dialect.name):
+                continue
+            index.create(connection)
+            indexes.append(index.name)
+    return {"tables": [t.name for t in tables], "columns": columns, "filled": filled, "indexes": indexes}
@@ -8,6 +8,7 @@ from aiogram_dialog import Dialog, DialogManager, Window
 from aiogram_dialog.widgets.kbd import (
     Button,
     Cancel,
+    ListGroup,
     Row,
     SwitchTo,
     Select,
@@ -43,6 +44,7 @@ try:
     _get_master_games = _gmg
 except Exception:
     pass
+from bot.db.current_requests import decide_request, get_players_for_game, get_requests_for_game
 
 
 # ---------------- helpers ----------------
@@ -56,6 +58,8 @@ async def _load_player_games(dm: DialogManager) -> List[Dict[str, Any]]:
         return []
     try:
         games = await _maybe_await(_get_player_games(dm))
+        if isinstance(games, dict):
+            games = games.get("games")
         return list(games or [])
     except Exception:
         return []
@@ -66,6 +70,8 @@ async def _load_master_games(dm: DialogManager) -> List[Dict[str, Any]]:
         return []
     try:
         games = await _maybe_await(_get_master_games(dm))
+        if isinstance(games, dict):
+            games = games.get("games")
         return list(games or [])
     except Exception:
         return []
@@ -86,6 +92,8 @@ def _game_title(g: Dict[str, Any]) -> str:
 def _game_details(g: Dict[str, Any]) -> str:
     parts: List[str] = []
     parts.append(f"<b>Название:</b> {g.get('name') or g.get('title') or '—'}")
+    if g.get("status"):
+        parts.append(f"<b>Статус:</b> {g['status']}")
     parts.append(f"<b>Система:</b> {g.get('system') or g.get('game_system') or '—'}")
     parts.append(f"<b>Город / формат:</b> {g.get('city') or '—'} / {g.get('format') or g.get('game_format') or '—'}")
     parts.append(f"<b>Уровень:</b> {g.get('level') or '—'}")
@@ -139,7 +147,33 @@ async def getter_view(dialog_manager: DialogManager, **kwargs) -> Dict[str, Any]
     lst = dd.get("player_games") if kind == "player" else dd.get("master_games")
     lst = lst or []
     g = lst[idx] if 0 <= idx < len(lst) else {}
-    return {"details": _game_details(g)}
+    return {"details": _game_details(g), "can_find_players": kind == "master" and g.get("id") is not None}
+
+
+async def getter_found_players(dialog_manager: DialogManager, **kwargs) -> Dict[str, Any]:
+    """Players that fit the selected master game, best first."""
+    game_id = _selected_master_game_id(dialog_manager.dialog_data)
+    if game_id is None:
+        return {"players": [], "has_items": False}
+    found = await get_players_for_game(dialog_manager, game_id)
+    return {"players": found["players"], "has_items": bool(found["players"])}
+
+
+def _selected_master_game_id(dd: Dict[str, Any]) -> Optional[int]:
+    kind, idx = dd.get("selected_game") or ("", -1)
+    games = dd.get("master_games") or []
+    if kind != "master" or not 0 <= idx < len(games):
+        return None
+    return games[idx]["id"]
+
+
+async def getter_requests(dialog_manager: DialogManager, **kwargs) -> Dict[str, Any]:
+    """Pending join requests for the selected master game."""
+    game_id = _selected_master_game_id(dialog_manager.dialog_data)
+    if game_id is None:
+        return {"requests": [], "has_items": False}
+    found = await get_requests_for_game(dialog_manager, game_id)
+    return {"requests": found["requests"], "has_items": bool(found["requests"])}
 
 
 # ---------------- click handlers ----------------
@@ -156,6 +190,32 @@ async def open_master_game(c: CallbackQuery, w: Select, dialog_manager: DialogMa
     await dialog_manager.switch_to(AllGames.viewing_game)
 
 
+DECISION_ANSWERS = {
+    "accepted": "Заявка принята",
+    "rejected": "Заявка отклонена",
+    "full": "Свободных мест нет",
+    "missing": "Заявка уже рассмотрена",
+}
+
+
+async def _decide_request(c: CallbackQuery, dialog_manager: DialogManager, item_id: str, accept: bool):
+    game_id = _selected_master_game_id(dialog_manager.dialog_data)
+    if game_id is None:
+        await c.answer("Игра не выбрана")
+        return
+    outcome = await decide_request(dialog_manager, game_id, int(item_id), accept)
+    await c.answer(DECISION_ANSWERS[outcome])
+
+
+async def accept_player_request(c: CallbackQuery, w: Button, dialog_manager: DialogManager):
+    # Inside ListGroup dialog_manager is a SubManager; item_id is the row's player_id
+    await _decide_request(c, dialog_manager, dialog_manager.item_id, accept=True)
+
+
+async def reject_player_request(c: CallbackQuery, w: Button, dialog_manager: DialogManager):
+    await _decide_request(c, dialog_manager, dialog_manager.item_id, accept=False)
+
+
 # ---------------- dialog ----------------
 
 all_games_dialog = Dialog(
@@ -216,8 +276,55 @@ all_games_dialog = Dialog(
     # 3) View one game
     Window(
         Jinja("{{ details }}"),
+        SwitchTo(Const("🔎 Подобрать игроков"), id="to_find_players", state=AllGames.finding_players,
+                 when="can_find_players"),
+        SwitchTo(Const("📨 Заявки"), id="to_requests", state=AllGames.reviewing_requests,
+                 when="can_find_players"),
         Row(Back(Const("Назад")), Cancel(Const("Закрыть"))),
         getter=getter_view,
         state=AllGames.viewing_game,
     ),
+
+    # 4) Players that fit a master game
+    Window(
+        Multi(
+            Const("Подходящие игроки:\n"),
+            Jinja(
+                "{% for p in players %}"
+                "\n{{ loop.index }}. <b>{{ p.name }}</b> — {{ p.experience_level }}, "
+                "{{ p.city or '—' }}, UTC{{ '%+d' % p.time_zone }}"
+                "{% if p.system_match %} · играет в эту систему{% endif %}"
+                "{% endfor %}"
+                "{% if not has_items %}<i>Никого не нашлось</i>{% endif %}"
+            ),
+        ),
+        Row(SwitchTo(Const("Назад"), id="back_to_game", state=AllGames.viewing_game), Cancel(Const("Закрыть"))),
+        getter=getter_found_players,
+        state=AllGames.finding_players,
+    ),
+
+    # 5) Join requests for a master game
+    Window(
+        Multi(
+            Const("Заявки на игру:\n"),
+            Jinja(
+                "{% for r in requests %}"
+                "\n{{ loop.index }}. <b>{{ r.name }}</b> — {{ r.experience_level }}, {{ r.city or '—' }}"
+                "{% endfor %}"
+                "{% if not has_items %}<i>Новых заявок нет</i>{% endif %}"
+            ),
+        ),
+        ListGroup(
+            Row(
+                Button(Format("✅ {item[name]}"), id="accept", on_click=accept_player_request),
+                Button(Const("❌"), id="reject", on_click=reject_player_request),
+            ),
+            id="requests",
+            item_id_getter=lambda item: item["player_id"],
+            items="requests",
+        ),
+        Row(SwitchTo(Const("Назад"), id="back_to_game_r", state=AllGames.viewing_game), Cancel(Const("Закрыть"))),
+        getter=getter_requests,
+        state=AllGames.reviewing_requests,
+    ),
 )
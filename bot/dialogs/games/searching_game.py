@@ -1,15 +1,23 @@
 # bot/dialogs/games/searching_game.py
 from __future__ import annotations
 
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional
 
-from aiogram.types import CallbackQuery, Message
+from aiogram import F
+from aiogram.types import CallbackQuery, ContentType, Message
 from aiogram_dialog import Dialog, Window, DialogManager
-from aiogram_dialog.widgets.kbd import Back, Cancel, Select, ScrollingGroup
+from aiogram_dialog.widgets.input import MessageInput
+from aiogram_dialog.widgets.kbd import Button, Cancel, Column, Row, Select, SwitchTo
 from aiogram_dialog.widgets.text import Const, Format
 
 from bot.states.games_states import SearchingGame
-from bot.db.current_requests import get_open_games
+from bot.db.current_requests import get_open_games, get_recommended_games
+from bot.db.game_filters import GameFilters
+from bot.db.models import all_formats
+from bot.db.requests import apply_to_game, get_user_model
+
+# Окно по часовому поясу для фильтра "мой часовой пояс", в часах
+TZ_WINDOW = 2
 
 
 def _get_session(dm: DialogManager):
@@ -23,56 +31,164 @@ def _get_session(dm: DialogManager):
 async def search_on_start(start_data: Dict[str, Any], manager: DialogManager):
     """
     aiogram_dialog on_start signature is (start_data, manager).
-    We just jump to the listing window; data will be lazy-loaded by getter.
+    Reset pagination and jump to the listing window; data will be lazy-loaded by getter.
     """
+    manager.dialog_data["search_cursors"] = [None]
     await manager.switch_to(SearchingGame.listing_results)
 
 
-async def _load_open_games(dm: DialogManager) -> List[Dict[str, Any]]:
+def _cursors(dm: DialogManager) -> List[Optional[List[Any]]]:
     """
-    Load open games from DB via the new current_requests API.
-    Returns a list of dicts with at least: id, title, system, city, cost, master_id, etc.
+    Stack of keyset cursors: cursors[i] is the `after` key of page i (None for the first page).
+    Only cursors are kept between updates, never the games themselves.
     """
-    session = _get_session(dm)
-
-    # get_open_games returns a dict like {"games": [...]} by current_requests.py
-    # If your signature supports filters, you can pass them in here.
-    raw = await get_open_games(dm, session=session)
-
-    games: List[Dict[str, Any]] = raw.get("games", []) if isinstance(raw, dict) else []
-    # Normalize/ensure keys exist to avoid KeyErrors when rendering
-    normalized: List[Dict[str, Any]] = []
-    for g in games:
-        normalized.append(
-            {
-                "id": str(g.get("id")),
-                "title": g.get("title") or "Без названия",
-                "system": g.get("system") or "—",
-                "city": g.get("city") or "—",
-                "cost": g.get("cost", 0),
-                "format": g.get("format") or "—",
-                "current_players": g.get("current_players"),
-                "max_players": g.get("max_players"),
-                "min_age": g.get("min_age"),
-                "max_age": g.get("max_age"),
-                "master_id": g.get("master_id"),
-                "status": g.get("status"),
-            }
-        )
-
-    # Sort by title for deterministic output
-    normalized.sort(key=lambda it: it["title"].lower())
-    return normalized
+    return dm.dialog_data.setdefault("search_cursors", [None])
 
 
 async def get_search_data(dialog_manager: DialogManager, **_):
     """
     Getter for the listing window. Must accept dialog_manager in aiogram_dialog v2.
+    Loads only the current page from DB.
     """
-    items = await _load_open_games(dialog_manager)
-    # Store for later (e.g., when clicking an item)
+    cursors = _cursors(dialog_manager)
+    filters = _filters(dialog_manager)
+    query = dialog_manager.dialog_data.get("search_query")
+    recommended = dialog_manager.dialog_data.get("search_recommended", False)
+    if recommended:
+        # Top-K by match score; one page, no cursors
+        page = await get_recommended_games(dialog_manager, session=_get_session(dialog_manager), filters=filters)
+        page["next_cursor"] = None
+    else:
+        page = await get_open_games(
+            dialog_manager, session=_get_session(dialog_manager), after=cursors[-1], filters=filters, query=query
+        )
+    items = [{**g, "id": str(g["id"])} for g in page["games"]]
+
+    # Current page only: used when clicking an item and for the "next" button
     dialog_manager.dialog_data["search_items"] = {it["id"]: it for it in items}
-    return {"items": items, "count": len(items)}
+    dialog_manager.dialog_data["search_next_cursor"] = page["next_cursor"]
+    return {
+        "items": items,
+        "page": len(cursors),
+        "filtered": not filters.is_empty,
+        "query": "" if recommended else query or "",
+        "recommended": recommended,
+        "has_items": bool(items),
+        "has_prev": len(cursors) > 1,
+        "has_next": page["next_cursor"] is not None,
+    }
+
+
+async def on_next_page(c: CallbackQuery, button: Button, manager: DialogManager):
+    next_cursor = manager.dialog_data.get("search_next_cursor")
+    if next_cursor is not None:
+        _cursors(manager).append(next_cursor)
+
+
+async def on_prev_page(c: CallbackQuery, button: Button, manager: DialogManager):
+    cursors = _cursors(manager)
+    if len(cursors) > 1:
+        cursors.pop()
+
+
+def _filters(dm: DialogManager) -> GameFilters:
+    return GameFilters.from_dict(dm.dialog_data.get("search_filters"))
+
+
+def _set_filters(dm: DialogManager, filters: GameFilters) -> None:
+    """Store filters and restart pagination: old cursors belong to another result set."""
+    dm.dialog_data["search_filters"] = filters.to_dict()
+    dm.dialog_data["search_cursors"] = [None]
+
+
+async def get_filters_data(dialog_manager: DialogManager, **_):
+    f = _filters(dialog_manager)
+    return {
+        "systems": ", ".join(f.systems) or "любая",
+        "format": all_formats[f.format] if f.format is not None else "любой",
+        "city": f.city or "любой",
+        "cost": {None: "любая", False: "бесплатно", True: "платно"}[f.is_paid],
+        "by_age": "да" if f.age is not None else "нет",
+        "by_tz": f"±{f.tz_window} ч" if f.time_zone is not None else "нет",
+        "free_seats": "да" if f.free_seats else "нет",
+        "awaiting_input": dialog_manager.dialog_data.get("filter_input") is not None,
+    }
+
+
+async def on_cycle_format(c: CallbackQuery, button: Button, manager: DialogManager):
+    f = _filters(manager)
+    # любой -> Онлайн -> Оффлайн -> любой
+    fmt = 0 if f.format is None else (f.format + 1 if f.format + 1 < len(all_formats) else None)
+    _set_filters(manager, f.with_changes(format=fmt))
+
+
+async def on_cycle_cost(c: CallbackQuery, button: Button, manager: DialogManager):
+    f = _filters(manager)
+    # любая -> бесплатно -> платно -> любая
+    _set_filters(manager, f.with_changes(is_paid={None: False, False: True, True: None}[f.is_paid]))
+
+
+async def on_toggle_free_seats(c: CallbackQuery, button: Button, manager: DialogManager):
+    f = _filters(manager)
+    _set_filters(manager, f.with_changes(free_seats=not f.free_seats))
+
+
+async def _toggle_by_profile(c: CallbackQuery, manager: DialogManager, field: str, **changes: Any):
+    """Turn a filter taken from the user's profile (age, time zone) on or off."""
+    f = _filters(manager)
+    if getattr(f, field) is not None:
+        defaults = GameFilters()
+        _set_filters(manager, f.with_changes(**{field: None}, **{k: getattr(defaults, k) for k in changes}))
+        return
+    user = await get_user_model(_get_session(manager), c.from_user.id, profile="bare")
+    if user is None:
+        await c.answer("Сначала заполните профиль", show_alert=True)
+        return
+    _set_filters(manager, f.with_changes(**{field: getattr(user, field)}, **changes))
+
+
+async def on_toggle_age(c: CallbackQuery, button: Button, manager: DialogManager):
+    await _toggle_by_profile(c, manager, "age")
+
+
+async def on_toggle_time_zone(c: CallbackQuery, button: Button, manager: DialogManager):
+    await _toggle_by_profile(c, manager, "time_zone", tz_window=TZ_WINDOW)
+
+
+async def on_ask_filter_text(c: CallbackQuery, button: Button, manager: DialogManager):
+    # id кнопки совпадает с полем фильтра: "systems" или "city"
+    manager.dialog_data["filter_input"] = button.widget_id
+
+
+async def on_filter_text(message: Message, _: MessageInput, manager: DialogManager):
+    field = manager.dialog_data.pop("filter_input", None)
+    if field is None:
+        return
+    text = (message.text or "").strip()
+    value: Any = tuple(text.split(",")) if field == "systems" else text
+    _set_filters(manager, _filters(manager).with_changes(**{field: value}))
+
+
+async def on_reset_filters(c: CallbackQuery, button: Button, manager: DialogManager):
+    manager.dialog_data.pop("filter_input", None)
+    _set_filters(manager, GameFilters())
+
+
+async def on_search_text(message: Message, _: MessageInput, manager: DialogManager):
+    """Text typed in the listing window is a search query; results are ranked by relevance."""
+    manager.dialog_data["search_query"] = (message.text or "").strip()
+    manager.dialog_data["search_recommended"] = False
+    manager.dialog_data["search_cursors"] = [None]
+
+
+async def on_toggle_recommended(c: CallbackQuery, button: Button, manager: DialogManager):
+    manager.dialog_data["search_recommended"] = not manager.dialog_data.get("search_recommended", False)
+    manager.dialog_data["search_cursors"] = [None]
+
+
+async def on_clear_search(c: CallbackQuery, button: Button, manager: DialogManager):
+    manager.dialog_data.pop("search_query", None)
+    manager.dialog_data["search_cursors"] = [None]
 
 
 async def on_select_game(
@@ -82,56 +198,106 @@ async def on_select_game(
     item_id: str,
 ):
     """
-    Handle select click: item_id is the game's string id (we set it in Select.item_id=...).
-    You can switch to a details state/window here if you have one.
-    For now, just acknowledge and keep the list.
+    Handle select click: item_id is the game's string id (we set it in Select.item_id_getter).
+    Sends a join request for the chosen game and keeps the list.
     """
     items_map: Dict[str, Dict[str, Any]] = manager.dialog_data.get("search_items", {})
     chosen = items_map.get(item_id)
-    if chosen:
-        await c.answer(f"Вы выбрали игру: {chosen['title']}", show_alert=False)
-    else:
+    if not chosen:
         await c.answer("Игра не найдена", show_alert=False)
+        return
+    if await apply_to_game(_get_session(manager), c.from_user.id, int(item_id)):
+        await c.answer(f"Заявка на игру «{chosen['title']}» отправлена", show_alert=False)
+    else:
+        await c.answer("Заявку подать нельзя: нужна анкета игрока, игра должна быть открытой и не вашей, а заявка — первой", show_alert=True)
 
 
 # === Widgets ===
 
 # One row per game
 row_text = Format(
-    "🎲 <b>{title}</b>\n"
-    "📚 {system}   🏙️ {city}   💵 {cost}\n"
-    "👥 {current_players}/{max_players}   🧭 {format}"
+    "🎲 {item[title]} · {item[system]} · {item[city]} · "
+    "👥 {item[current_players]}/{item[max_players]} · {item[format]}"
 )
 
-# Scrollable list with Select; item_id is a string game id
-list_widget = ScrollingGroup(
+# Page of games; item_id is a string game id
+list_widget = Column(
     Select(
         text=row_text,
         id="open_game",
-        item_id=Format("{id}"),
+        item_id_getter=lambda it: it["id"],
         items="items",
         on_click=on_select_game,
     ),
-    id="open_games_scroll",
-    width=1,
-    height=8,
+)
+
+pager = Row(
+    Button(Const("◀️"), id="search_prev", on_click=on_prev_page, when="has_prev"),
+    Button(Const("▶️"), id="search_next", on_click=on_next_page, when="has_next"),
+)
+
+
+filters_text = Format(
+    "⚙️ <b>Фильтры поиска</b>\n"
+    "📚 Система: {systems}\n"
+    "🧭 Формат: {format}\n"
+    "🏙️ Город: {city}\n"
+    "💵 Стоимость: {cost}\n"
+    "🎂 По моему возрасту: {by_age}\n"
+    "🕒 По моему часовому поясу: {by_tz}\n"
+    "👥 Только со свободными местами: {free_seats}"
 )
 
 
 searching_game_dialog = Dialog(
-    # A short "loading/entering" window; immediately switches to listing on start
+    # A short "loading/entering" window; the dialog switches to listing on start
     Window(
         Const("🔎 Ищу открытые игры…"),
         state=SearchingGame.checking_open_games,
-        on_start=search_on_start,
     ),
     # The main listing window
     Window(
-        Format("Найдено игр: <b>{count}</b>"),
+        Format("Открытые игры, страница <b>{page}</b>", when="has_items"),
+        Const("Открытых игр пока нет", when=~F["has_items"]),
+        Const("(с фильтрами)", when="filtered"),
+        Const("⭐ Игры, которые подходят вам больше всего", when="recommended"),
+        Format("🔤 Поиск: «{query}»", when="query"),
+        Const("Чтобы найти игру по названию, системе или описанию, отправьте текст", when=~F["query"]),
         list_widget,
-        Back(Const("⬅️ Назад")),
+        pager,
+        MessageInput(on_search_text, content_types=[ContentType.TEXT]),
+        Button(Const("✖️ Сбросить поиск"), id="search_clear", on_click=on_clear_search, when="query"),
+        Button(Const("⭐ Подходящие мне"), id="search_recommended", on_click=on_toggle_recommended,
+               when=~F["recommended"]),
+        Button(Const("🔤 Все по алфавиту"), id="search_alphabetical", on_click=on_toggle_recommended,
+               when="recommended"),
+        SwitchTo(Const("⚙️ Фильтры"), id="to_filters", state=SearchingGame.choosing_filters),
         Cancel(Const("❌ Отмена")),
         getter=get_search_data,
         state=SearchingGame.listing_results,
     ),
+    # Filters; every change restarts the listing from the first page
+    Window(
+        filters_text,
+        Const("\nОтправьте значение сообщением (системы — через запятую)", when="awaiting_input"),
+        Row(
+            Button(Const("📚 Система"), id="systems", on_click=on_ask_filter_text),
+            Button(Const("🏙️ Город"), id="city", on_click=on_ask_filter_text),
+        ),
+        Row(
+            Button(Format("🧭 {format}"), id="filter_format", on_click=on_cycle_format),
+            Button(Format("💵 {cost}"), id="filter_cost", on_click=on_cycle_cost),
+        ),
+        Row(
+            Button(Const("🎂 Возраст"), id="filter_age", on_click=on_toggle_age),
+            Button(Const("🕒 Часовой пояс"), id="filter_tz", on_click=on_toggle_time_zone),
+            Button(Const("👥 Места"), id="filter_seats", on_click=on_toggle_free_seats),
+        ),
+        MessageInput(on_filter_text, content_types=[ContentType.TEXT]),
+        Button(Const("♻️ Сбросить"), id="filter_reset", on_click=on_reset_filters),
+        SwitchTo(Const("🔎 Искать"), id="filter_search", state=SearchingGame.listing_results),
+        getter=get_filters_data,
+        state=SearchingGame.choosing_filters,
+    ),
+    on_start=search_on_start,
 )
@@ -12,25 +12,29 @@ from bot.states.games_states import AllGames, GameCreation, SearchingGame
 router = Router()
 
 
+MAIN_MENU_COMMANDS = [
+    BotCommand(command="/register",
+               description="Регистрация"),
+    BotCommand(command="/profile",
+               description="Просмотр и редактирование профиля"),
+    BotCommand(command="/player",
+               description="Анкета игрока"),
+    BotCommand(command="/master",
+               description="Анкета мастера"),
+    BotCommand(command="/games",
+               description="Просмотр статуса и создание игр"),
+    BotCommand(command="/create",
+               description="Создать новую игру"),
+    BotCommand(command="/search",
+               description="Поиск игр"),
+]
+
+# Команды, которые бот обрабатывает (метки метрик bot.base.update_metrics)
+KNOWN_COMMANDS = ["start"] + [c.command.lstrip("/") for c in MAIN_MENU_COMMANDS]
+
+
 async def set_main_menu(bot: Bot):
-    main_menu_commands = [
-        BotCommand(command="/register",
-                   description="Регистрация"),
-        BotCommand(command="/profile",
-                   description="Просмотр и редактирование профиля"),
-        BotCommand(command="/player",
-                   description="Анкета игрока"),
-        BotCommand(command="/master",
-                   description="Анкета мастера"),
-        BotCommand(command="/games",
-                   description="Просмотр статуса и создание игр"),
-        BotCommand(command="/create",
-                   description="Создать новую игру"),
-        BotCommand(command="/search",
-                   description="Поиск игр"),
-    ]
-
-    await bot.set_my_commands(main_menu_commands)
+    await bot.set_my_commands(MAIN_MENU_COMMANDS)
 
 
 # TODO: change description, make in more informative
@@ -12,6 +12,8 @@ class AllGames(StatesGroup):
     listing_player_games = State()
     listing_master_games = State()
     viewing_game = State()
+    finding_players = State()
+    reviewing_requests = State()
 
 
 class GameCreation(StatesGroup):
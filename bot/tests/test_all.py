@@ -9,21 +9,32 @@ from unittest.mock import AsyncMock, MagicMock
 def make_mock_result(obj):
     """
     Создает замоканный результат для session.execute,
-    у которого корректно работают .scalars().first().
+    у которого корректно работают .scalars().first(), .scalar() и .all().
     """
     mock_result = MagicMock()
     mock_scalars = MagicMock()
     mock_scalars.first.return_value = obj
     mock_result.scalars.return_value = mock_scalars
+    mock_result.scalar.return_value = obj
+    mock_result.all.return_value = [(obj,)] if obj is not None else []
     return mock_result
 
+def make_update_result(obj, changes):
+    """
+    Результат UPDATE ... RETURNING: строка уже с новыми значениями полей.
+    """
+    for key, value in changes.items():
+        setattr(obj, key, value)
+    return make_mock_result(obj)
+
 # Импортируем тестируемые сущности
 from bot.db.base import User, Player, Master, Session
 from bot.db.requests import (
     _get_entity, _register_entity, _edit_entity,
     get_user_model, get_player_model, get_master_model, get_game_model,
     register_user, register_player, register_master, register_game,
-    edit_user, edit_player, edit_master, edit_game
+    edit_user, edit_player, edit_master, edit_game,
+    user_cache, invalidate_user
 )
 from bot.db.models import (
     all_roles, all_formats, all_experience_levels,
@@ -108,6 +119,17 @@ def create_mock_db():
 #############################################
 # Фикстуры и утилиты
 #############################################
+@pytest.fixture(autouse=True)
+def clear_user_cache():
+    """Кэши профилей и открытых игр живут в процессе — каждый тест начинает с пустых."""
+    from bot.db.requests import game_candidates_cache
+    user_cache.clear()
+    game_candidates_cache.clear()
+    yield
+    user_cache.clear()
+    game_candidates_cache.clear()
+
+
 @pytest_asyncio.fixture
 async def mock_session():
     session = AsyncMock()
@@ -116,6 +138,9 @@ async def mock_session():
     session.commit = AsyncMock()
     session.refresh = AsyncMock()
     session.add = AsyncMock()
+    # get_bind у AsyncSession синхронный: по диалекту выбирается INSERT ... ON CONFLICT
+    session.get_bind = MagicMock()
+    session.get_bind.return_value.dialect.name = "postgresql"
     return session
 
 def create_dummy_user(**kwargs):
@@ -172,8 +197,8 @@ def create_dummy_session(creator: User, format_index=0, looking_for_index=0):
 @pytest.mark.asyncio
 async def test_register_user_case1_normal(mock_session):
     dummy = create_dummy_user()
-    # Сбрасываем результат запроса, чтобы не находить дубликат
-    mock_session.execute.return_value.scalars.return_value.first.return_value = None
+    # INSERT ... RETURNING вернул новую строку
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy))
     user_model = UserModel(dummy)
     registered = await register_user(user_model, mock_session)
     assert registered.telegram_id == dummy.telegram_id
@@ -184,8 +209,8 @@ async def test_register_user_case2_duplicate(mock_session):
     dummy = create_dummy_user()
     user_model = UserModel(dummy)
 
-    # Correct async mock
-    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy))
+    # ON CONFLICT DO NOTHING не вернул строк — пользователь уже есть
+    mock_session.execute = AsyncMock(return_value=make_mock_result(None))
 
     with pytest.raises(ValueError, match="User already exists"):
         await register_user(user_model, mock_session)
@@ -239,7 +264,7 @@ async def test_register_user_case5_multiple_roles_formats(mock_session):
 async def test_register_user_case6_missing_field(mock_session):
     dummy = create_dummy_user(name="TestUser")
     dummy.name = ""
-    mock_session.execute = AsyncMock(return_value=make_mock_result(None))
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy))
     user_model = UserModel(dummy)
     registered = await register_user(user_model, mock_session)
     assert registered.name == ""
@@ -247,7 +272,7 @@ async def test_register_user_case6_missing_field(mock_session):
 @pytest.mark.asyncio
 async def test_register_user_case7_boundary_age(mock_session):
     dummy = create_dummy_user(age=0)
-    mock_session.execute = AsyncMock(return_value=make_mock_result(None))
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy))
     user_model = UserModel(dummy)
     registered = await register_user(user_model, mock_session)
     assert registered.age == 0
@@ -255,7 +280,7 @@ async def test_register_user_case7_boundary_age(mock_session):
 @pytest.mark.asyncio
 async def test_register_user_case8_extreme_age(mock_session):
     dummy = create_dummy_user(age=150)
-    mock_session.execute = AsyncMock(return_value=make_mock_result(None))
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy))
     user_model = UserModel(dummy)
     registered = await register_user(user_model, mock_session)
     assert registered.age == 150
@@ -264,7 +289,7 @@ async def test_register_user_case8_extreme_age(mock_session):
 async def test_register_user_case9_missing_optional_field(mock_session):
     dummy = create_dummy_user()
     dummy.about_info = None
-    mock_session.execute = AsyncMock(return_value=make_mock_result(None))
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy))
     user_model = UserModel(dummy)
     registered = await register_user(user_model, mock_session)
     assert registered.about_info is None
@@ -272,7 +297,7 @@ async def test_register_user_case9_missing_optional_field(mock_session):
 @pytest.mark.asyncio
 async def test_register_user_case10_commit_failure(mock_session):
     dummy = create_dummy_user()
-    mock_session.execute = AsyncMock(return_value=make_mock_result(None))
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy))
     async def failing_commit():
         raise Exception("Commit error")
     mock_session.commit = AsyncMock(side_effect=failing_commit)
@@ -290,7 +315,7 @@ async def test_register_player_case1_normal(mock_session):
     from bot.db.models import PlayerModel
     dummy_player = create_dummy_player(user, experience_index=1, availability="partial")
     player_model = PlayerModel(dummy_player)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(None)])
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy_player))
     registered = await register_player(player_model, mock_session)
     assert registered.availability == dummy_player.availability
 
@@ -309,7 +334,7 @@ async def test_register_player_case4_missing_availability(mock_session):
     from bot.db.models import PlayerModel
     dummy_player = create_dummy_player(user, availability="")
     player_model = PlayerModel(dummy_player)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(None)])
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy_player))
     registered = await register_player(player_model, mock_session)
     assert registered.availability == ""
 
@@ -319,7 +344,7 @@ async def test_register_player_case5_multiple_players_same_user(mock_session):
     from bot.db.models import PlayerModel
     dummy_player = create_dummy_player(user)
     player_model = PlayerModel(dummy_player)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(MagicMock())])
+    mock_session.execute = AsyncMock(side_effect=[make_mock_result(None), make_mock_result(user)])
     with pytest.raises(ValueError):
         await register_player(player_model, mock_session)
 
@@ -329,7 +354,7 @@ async def test_register_player_case6_commit_failure(mock_session):
     from bot.db.models import PlayerModel
     dummy_player = create_dummy_player(user)
     player_model = PlayerModel(dummy_player)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(None)])
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy_player))
     async def failing_commit():
         raise Exception("Commit failed")
     mock_session.commit = AsyncMock(side_effect=failing_commit)
@@ -342,7 +367,7 @@ async def test_register_player_case7_invalid_session_response(mock_session):
     from bot.db.models import PlayerModel
     dummy_player = create_dummy_player(user)
     player_model = PlayerModel(dummy_player)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), "not None"])
+    mock_session.execute = AsyncMock(side_effect=["not None"])
     with pytest.raises(AttributeError):
         await register_player(player_model, mock_session)
 
@@ -356,7 +381,7 @@ async def test_register_master_case1_normal(mock_session):
     from bot.db.models import MasterModel
     dummy_master = create_dummy_master(user, master_style="Modern", rating=10)
     master_model = MasterModel(dummy_master)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(None)])
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy_master))
     registered = await register_master(master_model, mock_session)
     assert registered.rating == 10
 
@@ -375,7 +400,7 @@ async def test_register_master_case3_missing_master_style(mock_session):
     from bot.db.models import MasterModel
     dummy_master = create_dummy_master(user, master_style="", rating=5)
     master_model = MasterModel(dummy_master)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(None)])
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy_master))
     registered = await register_master(master_model, mock_session)
     assert registered.master_style == ""
 
@@ -385,7 +410,7 @@ async def test_register_master_case4_negative_rating(mock_session):
     from bot.db.models import MasterModel
     dummy_master = create_dummy_master(user, master_style="Style", rating=-1)
     master_model = MasterModel(dummy_master)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(None)])
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy_master))
     registered = await register_master(master_model, mock_session)
     assert registered.rating == -1
 
@@ -395,7 +420,7 @@ async def test_register_master_case5_multiple_masters_same_user(mock_session):
     from bot.db.models import MasterModel
     dummy_master = create_dummy_master(user, master_style="Style", rating=5)
     master_model = MasterModel(dummy_master)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(MagicMock())])
+    mock_session.execute = AsyncMock(side_effect=[make_mock_result(None), make_mock_result(user)])
     with pytest.raises(ValueError):
         await register_master(master_model, mock_session)
 
@@ -405,7 +430,7 @@ async def test_register_master_case6_commit_failure(mock_session):
     from bot.db.models import MasterModel
     dummy_master = create_dummy_master(user, master_style="Style", rating=5)
     master_model = MasterModel(dummy_master)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(None)])
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy_master))
     async def failing_commit():
         raise Exception("Commit error")
     mock_session.commit = AsyncMock(side_effect=failing_commit)
@@ -418,7 +443,7 @@ async def test_register_master_case7_invalid_rating_type(mock_session):
     from bot.db.models import MasterModel
     dummy_master = create_dummy_master(user, master_style="Style", rating="High")
     master_model = MasterModel(dummy_master)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(None)])
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy_master))
     registered = await register_master(master_model, mock_session)
     assert isinstance(registered.rating, str)
 
@@ -428,7 +453,7 @@ async def test_register_master_case8_none_master_style(mock_session):
     from bot.db.models import MasterModel
     dummy_master = create_dummy_master(user, master_style=None, rating=5)
     master_model = MasterModel(dummy_master)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(None)])
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy_master))
     registered = await register_master(master_model, mock_session)
     assert registered.master_style is None
 
@@ -439,7 +464,7 @@ async def test_register_master_case10_non_numeric_rating(mock_session):
     from bot.db.models import MasterModel
     dummy_master = create_dummy_master(user, master_style="Modern", rating="Ten")
     master_model = MasterModel(dummy_master)
-    mock_session.execute = AsyncMock(side_effect=[make_mock_result(user), make_mock_result(None)])
+    mock_session.execute = AsyncMock(return_value=make_mock_result(dummy_master))
     registered = await register_master(master_model, mock_session)
     assert registered.rating == "Ten"
 
@@ -523,7 +548,7 @@ async def test_register_game_case10_incomplete_data(mock_session):
 async def test_edit_game_case1_success(mock_session):
     user = create_dummy_user()
     session_obj = create_dummy_session(user, format_index=0, looking_for_index=0)
-    mock_session.execute = AsyncMock(return_value=make_mock_result(session_obj))
+    mock_session.execute = AsyncMock(return_value=make_update_result(session_obj, {"title": "EditedGame"}))
     updated = await edit_game(session_obj.id, {"title": "EditedGame"}, mock_session)
     assert updated.title == "EditedGame"
 
@@ -548,8 +573,8 @@ async def test_edit_game_case3_invalid_field(mock_session):
 async def test_edit_game_case5_multiple_field_update(mock_session):
     user = create_dummy_user()
     session_obj = create_dummy_session(user, format_index=0, looking_for_index=0)
-    mock_session.execute = AsyncMock(return_value=make_mock_result(session_obj))
     changes = {"title": "NewTitle", "description": "NewDesc", "max_players": 10}
+    mock_session.execute = AsyncMock(return_value=make_update_result(session_obj, changes))
     updated = await edit_game(session_obj.id, changes, mock_session)
     assert updated.title == "NewTitle"
     assert updated.description == "NewDesc"
@@ -560,7 +585,7 @@ async def test_edit_game_case5_multiple_field_update(mock_session):
 async def test_edit_game_case6_partial_update(mock_session):
     user = create_dummy_user()
     session_obj = create_dummy_session(user, format_index=0, looking_for_index=0)
-    mock_session.execute = AsyncMock(return_value=make_mock_result(session_obj))
+    mock_session.execute = AsyncMock(return_value=make_update_result(session_obj, {"max_players": 8}))
     updated = await edit_game(session_obj.id, {"max_players": 8}, mock_session)
     assert updated.max_players == 8
 
@@ -583,8 +608,8 @@ async def test_edit_game_case7_commit_failure(mock_session):
 async def test_edit_game_case9_wrong_data_type(mock_session):
     user = create_dummy_user()
     session_obj = create_dummy_session(user)
-    mock_session.execute = AsyncMock(return_value=make_mock_result(session_obj))
     changes = {"max_players": "ten"}
+    mock_session.execute = AsyncMock(return_value=make_update_result(session_obj, changes))
     updated = await edit_game(session_obj.id, changes, mock_session)
     assert updated.max_players == "ten"
 
@@ -1224,7 +1249,7 @@ async def test_get_game_model_case20_db_non_numeric_id(mock_session):
 @pytest.mark.asyncio
 async def test_register_user_case1_normal(mock_session):
     dummy = create_dummy_user()
-    mock_session.execute.return_value = make_mock_result(None)
+    mock_session.execute.return_value = make_mock_result(dummy)
     user_model = UserModel(dummy)
     registered = await register_user(user_model, mock_session)
     assert registered.telegram_id == dummy.telegram_id
@@ -1234,7 +1259,7 @@ async def test_register_user_case1_normal(mock_session):
 async def test_register_user_case11_db_first_user(mock_session):
     db = create_mock_db()
     target = db["users"][0]
-    mock_session.execute.return_value = make_mock_result(None)
+    mock_session.execute.return_value = make_mock_result(target)
     user_model = UserModel(target)
     registered = await register_user(user_model, mock_session)
     assert registered.telegram_id == target.telegram_id
@@ -1244,7 +1269,7 @@ async def test_register_user_case11_db_first_user(mock_session):
 async def test_register_user_case12_db_last_user(mock_session):
     db = create_mock_db()
     target = db["users"][-1]
-    mock_session.execute.return_value = make_mock_result(None)
+    mock_session.execute.return_value = make_mock_result(target)
     user_model = UserModel(target)
     registered = await register_user(user_model, mock_session)
     assert registered.telegram_id == target.telegram_id
@@ -1265,7 +1290,7 @@ async def test_register_user_case14_db_missing_field(mock_session):
     db = create_mock_db()
     target = db["users"][11]
     target.name = ""
-    mock_session.execute.return_value = make_mock_result(None)
+    mock_session.execute.return_value = make_mock_result(target)
     user_model = UserModel(target)
     registered = await register_user(user_model, mock_session)
     assert registered.name == ""
@@ -1276,7 +1301,7 @@ async def test_register_user_case15_db_boundary_age(mock_session):
     db = create_mock_db()
     target = db["users"][12]
     target.age = 0
-    mock_session.execute.return_value = make_mock_result(None)
+    mock_session.execute.return_value = make_mock_result(target)
     user_model = UserModel(target)
     registered = await register_user(user_model, mock_session)
     assert registered.age == 0
@@ -1287,7 +1312,7 @@ async def test_register_user_case16_db_extreme_age(mock_session):
     db = create_mock_db()
     target = db["users"][13]
     target.age = 150
-    mock_session.execute.return_value = make_mock_result(None)
+    mock_session.execute.return_value = make_mock_result(target)
     user_model = UserModel(target)
     registered = await register_user(user_model, mock_session)
     assert registered.age == 150
@@ -1298,7 +1323,7 @@ async def test_register_user_case17_db_missing_optional(mock_session):
     db = create_mock_db()
     target = db["users"][14]
     target.about_info = None
-    mock_session.execute.return_value = make_mock_result(None)
+    mock_session.execute.return_value = make_mock_result(target)
     user_model = UserModel(target)
     registered = await register_user(user_model, mock_session)
     assert registered.about_info is None
@@ -1308,7 +1333,7 @@ async def test_register_user_case17_db_missing_optional(mock_session):
 async def test_register_user_case18_db_commit_failure(mock_session):
     db = create_mock_db()
     target = db["users"][15]
-    mock_session.execute.return_value = make_mock_result(None)
+    mock_session.execute.return_value = make_mock_result(target)
     async def failing_commit():
         raise Exception("Commit error")
     mock_session.commit.side_effect = failing_commit
@@ -1426,8 +1451,8 @@ async def test_register_game_case20_db_incomplete_data(mock_session):
 @pytest.mark.asyncio
 async def test_edit_user_case1_success(mock_session):
     user = create_dummy_user(name="OldName")
-    mock_session.execute.return_value = make_mock_result(user)
     changes = {"name": "EditedName"}
+    mock_session.execute.return_value = make_update_result(user, changes)
     updated = await edit_user(user.telegram_id, changes, mock_session)
     assert updated.name == "EditedName"
 
@@ -1435,8 +1460,8 @@ async def test_edit_user_case1_success(mock_session):
 async def test_edit_user_case11_db_update_name(mock_session):
     db = create_mock_db()
     target = db["users"][0]
-    mock_session.execute.return_value = make_mock_result(target)
     changes = {"name": "UpdatedName"}
+    mock_session.execute.return_value = make_update_result(target, changes)
     updated = await edit_user(target.telegram_id, changes, mock_session)
     assert updated.name == "UpdatedName"
 
@@ -1444,8 +1469,8 @@ async def test_edit_user_case11_db_update_name(mock_session):
 async def test_edit_user_case12_db_update_city(mock_session):
     db = create_mock_db()
     target = db["users"][1]
-    mock_session.execute.return_value = make_mock_result(target)
     changes = {"city": "NewCity"}
+    mock_session.execute.return_value = make_update_result(target, changes)
     updated = await edit_user(target.telegram_id, changes, mock_session)
     assert updated.city == "NewCity"
 
@@ -1470,8 +1495,8 @@ async def test_edit_user_case14_db_invalid_field(mock_session):
 async def test_edit_user_case15_db_update_multiple_fields(mock_session):
     db = create_mock_db()
     target = db["users"][4]
-    mock_session.execute.return_value = make_mock_result(target)
     changes = {"name": "NewName", "city": "NewCity"}
+    mock_session.execute.return_value = make_update_result(target, changes)
     updated = await edit_user(target.telegram_id, changes, mock_session)
     assert updated.name == "NewName"
     assert updated.city == "NewCity"
@@ -1480,8 +1505,8 @@ async def test_edit_user_case15_db_update_multiple_fields(mock_session):
 async def test_edit_user_case16_db_numeric_to_string(mock_session):
     db = create_mock_db()
     target = db["users"][5]
-    mock_session.execute.return_value = make_mock_result(target)
     changes = {"age": "forty"}
+    mock_session.execute.return_value = make_update_result(target, changes)
     updated = await edit_user(target.telegram_id, changes, mock_session)
     assert updated.age == "forty"
 
@@ -1489,8 +1514,8 @@ async def test_edit_user_case16_db_numeric_to_string(mock_session):
 async def test_edit_user_case17_db_partial_update(mock_session):
     db = create_mock_db()
     target = db["users"][6]
-    mock_session.execute.return_value = make_mock_result(target)
     changes = {"city": "UpdatedCity"}
+    mock_session.execute.return_value = make_update_result(target, changes)
     updated = await edit_user(target.telegram_id, changes, mock_session)
     assert updated.city == "UpdatedCity"
 
@@ -1518,7 +1543,7 @@ async def test_edit_user_case19_db_update_same_value(mock_session):
 async def test_edit_user_case20_db_empty_string_update(mock_session):
     db = create_mock_db()
     target = db["users"][9]
-    mock_session.execute.return_value = make_mock_result(target)
+    mock_session.execute.return_value = make_update_result(target, {"name": ""})
     updated = await edit_user(target.telegram_id, {"name": ""}, mock_session)
     assert updated.name == ""
 
@@ -1530,7 +1555,7 @@ async def test_edit_user_case20_db_empty_string_update(mock_session):
 async def test_edit_player_case1_success(mock_session):
     user = create_dummy_user()
     dummy_player = create_dummy_player(user, availability="full")
-    mock_session.execute.return_value = make_mock_result(dummy_player)
+    mock_session.execute.return_value = make_update_result(dummy_player, {"availability": "edited"})
     updated = await edit_player(user.telegram_id, {"availability": "edited"}, mock_session)
     assert updated.availability == "edited"
 
@@ -1540,7 +1565,7 @@ async def test_edit_player_case11_db_update_availability(mock_session):
     if not db["players"]:
         pytest.skip("Нет игроков")
     target = db["players"][0]
-    mock_session.execute.return_value = make_mock_result(target)
+    mock_session.execute.return_value = make_update_result(target, {"availability": "changed"})
     updated = await edit_player(target.user.telegram_id, {"availability": "changed"}, mock_session)
     assert updated.availability == "changed"
 
@@ -1550,7 +1575,7 @@ async def test_edit_player_case12_db_update_experience(mock_session):
     if not db["players"]:
         pytest.skip("Нет игроков")
     target = db["players"][1]
-    mock_session.execute.return_value = make_mock_result(target)
+    mock_session.execute.return_value = make_update_result(target, {"experience_level": 1})
     updated = await edit_player(target.user.telegram_id, {"experience_level": 1}, mock_session)
     assert updated.experience_level == all_experience_levels[1]
 
@@ -1582,7 +1607,7 @@ async def test_edit_player_case15_db_update_multiple_fields(mock_session):
         pytest.skip("Нет игроков")
     target = db["players"][4]
     changes = {"availability": "no", "experience_level": 2}
-    mock_session.execute.return_value = make_mock_result(target)
+    mock_session.execute.return_value = make_update_result(target, changes)
     updated = await edit_player(target.user.telegram_id, changes, mock_session)
     assert updated.availability == "no"
     assert updated.experience_level == all_experience_levels[2]
@@ -1617,8 +1642,8 @@ async def test_edit_player_case18_db_non_numeric_experience(mock_session):
     if not db["players"]:
         pytest.skip("Нет игроков")
     target = db["players"][7]
-    mock_session.execute.return_value = make_mock_result(target)
     with pytest.raises(TypeError):
+        mock_session.execute.return_value = make_update_result(target, {"experience_level": "Опыт"})
         await edit_player(target.user.telegram_id, {"experience_level": "Опыт"}, mock_session)
 
 @pytest.mark.asyncio
@@ -1627,7 +1652,7 @@ async def test_edit_player_case19_db_update_with_partial_field(mock_session):
     if not db["players"]:
         pytest.skip("Нет игроков")
     target = db["players"][8]
-    mock_session.execute.return_value = make_mock_result(target)
+    mock_session.execute.return_value = make_update_result(target, {"availability": "updated"})
     updated = await edit_player(target.user.telegram_id, {"availability": "updated"}, mock_session)
     assert updated.availability == "updated"
 
@@ -1637,7 +1662,7 @@ async def test_edit_player_case20_db_empty_string_update(mock_session):
     if not db["players"]:
         pytest.skip("Нет игроков")
     target = db["players"][9]
-    mock_session.execute.return_value = make_mock_result(target)
+    mock_session.execute.return_value = make_update_result(target, {"availability": ""})
     updated = await edit_player(target.user.telegram_id, {"availability": ""}, mock_session)
     assert updated.availability == ""
 
@@ -1649,7 +1674,7 @@ async def test_edit_player_case20_db_empty_string_update(mock_session):
 async def test_edit_master_case1_success(mock_session):
     user = create_dummy_user()
     dummy_master = create_dummy_master(user, master_style="OldStyle", rating=3)
-    mock_session.execute.return_value = make_mock_result(dummy_master)
+    mock_session.execute.return_value = make_update_result(dummy_master, {"rating": 7})
     updated = await edit_master(user.telegram_id, {"rating": 7}, mock_session)
     assert updated.rating == 7
 
@@ -1659,7 +1684,7 @@ async def test_edit_master_case11_db_update_style(mock_session):
     if not db["masters"]:
         pytest.skip("Нет мастеров")
     target = db["masters"][0]
-    mock_session.execute.return_value = make_mock_result(target)
+    mock_session.execute.return_value = make_update_result(target, {"master_style": "NewStyle"})
     updated = await edit_master(target.user.telegram_id, {"master_style": "NewStyle"}, mock_session)
     assert updated.master_style == "NewStyle"
 
@@ -1669,9 +1694,10 @@ async def test_edit_master_case12_db_update_rating(mock_session):
     if not db["masters"]:
         pytest.skip("Нет мастеров")
     target = db["masters"][1]
-    mock_session.execute.return_value = make_mock_result(target)
-    updated = await edit_master(target.user.telegram_id, {"rating": target.rating + 2}, mock_session)
-    assert updated.rating == target.rating + 2
+    rating = target.rating + 2
+    mock_session.execute.return_value = make_update_result(target, {"rating": rating})
+    updated = await edit_master(target.user.telegram_id, {"rating": rating}, mock_session)
+    assert updated.rating == rating
 
 @pytest.mark.asyncio
 async def test_edit_master_case13_db_empty_change(mock_session):
@@ -1700,11 +1726,12 @@ async def test_edit_master_case15_db_update_multiple_fields(mock_session):
     if not db["masters"]:
         pytest.skip("Нет мастеров")
     target = db["masters"][4]
-    changes = {"master_style": "UpdatedStyle", "rating": target.rating + 1}
-    mock_session.execute.return_value = make_mock_result(target)
+    rating = target.rating + 1
+    changes = {"master_style": "UpdatedStyle", "rating": rating}
+    mock_session.execute.return_value = make_update_result(target, changes)
     updated = await edit_master(target.user.telegram_id, changes, mock_session)
     assert updated.master_style == "UpdatedStyle"
-    assert updated.rating == target.rating + 1
+    assert updated.rating == rating
 
 @pytest.mark.asyncio
 async def test_edit_master_case16_db_update_same_value(mock_session):
@@ -1736,7 +1763,7 @@ async def test_edit_master_case18_db_update_with_partial_field(mock_session):
     if not db["masters"]:
         pytest.skip("Нет мастеров")
     target = db["masters"][7]
-    mock_session.execute.return_value = make_mock_result(target)
+    mock_session.execute.return_value = make_update_result(target, {"master_style": "PartialUpdate"})
     updated = await edit_master(target.user.telegram_id, {"master_style": "PartialUpdate"}, mock_session)
     assert updated.master_style == "PartialUpdate"
 
@@ -1752,7 +1779,7 @@ async def test_edit_master_case20_db_empty_string_update(mock_session):
     if not db["masters"]:
         pytest.skip("Нет мастеров")
     target = db["masters"][8]
-    mock_session.execute.return_value = make_mock_result(target)
+    mock_session.execute.return_value = make_update_result(target, {"master_style": ""})
     updated = await edit_master(target.user.telegram_id, {"master_style": ""}, mock_session)
     assert updated.master_style == ""
 
@@ -2190,6 +2217,2647 @@ async def test_user_model_get_user_case1_found(mock_session):
 
     assert fetched == user
 
+#############################################
+# Профили загрузки: число запросов к БД
+#############################################
+
+@pytest_asyncio.fixture
+async def sqlite_session():
+    """
+    Настоящая in-memory БД SQLite с одним пользователем, у которого есть
+    профили игрока и мастера и две созданные игры.
+    Возвращает (session, statements) — statements пополняется каждым SQL-запросом.
+    """
+    pytest.importorskip("aiosqlite")
+    from sqlalchemy import event
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from bot.db.base import Base
+
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    maker = async_sessionmaker(engine, expire_on_commit=False)
+    async with maker() as seed:
+        user = create_dummy_user(created_at=None)
+        seed.add(user)
+        await seed.flush()
+        seed.add(Player(id=user.id, experience_level=0, availability="full"))
+        seed.add(Master(id=user.id, master_style="Classic", rating=5))
+        await seed.commit()
+        # Игры — через register_game, как из бота: мастер игры проставляется там же
+        for i in range(2):
+            await register_game(SessionModel(Session(
+                title=f"Game_{i}", date_time=datetime.datetime(2030, 1, 1), format=0, status=True,
+                looking_for=0, max_players=4, creator=create_dummy_user(id=user.id))), seed)
+
+    statements = []
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    async with maker() as session:
+        yield session, statements
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("profile, budget", [("bare", 1), ("profile", 1), ("profile+games", 3)])
+async def test_get_user_model_profile_round_trips(sqlite_session, profile, budget):
+    session, statements = sqlite_session
+    user = await get_user_model(session, 12345, profile=profile)
+    assert user is not None
+    # Обращение к связям после загрузки не должно порождать новых запросов
+    _ = (user.player_profile, user.master_profile, user.sessions)
+    assert len(statements) == budget
+
+
+@pytest.mark.asyncio
+async def test_get_user_model_profile_loads_relations(sqlite_session):
+    session, statements = sqlite_session
+    user = await get_user_model(session, 12345, profile="profile")
+    assert user.player_profile is not None
+    assert user.master_profile is not None
+    # Игры в профиль "profile" не входят
+    assert user.sessions == []
+
+
+@pytest.mark.asyncio
+async def test_get_user_model_profile_games_loads_sessions(sqlite_session):
+    session, statements = sqlite_session
+    user = await get_user_model(session, 12345, profile="profile+games")
+    assert sorted(s.title for s in user.sessions) == ["Game_0", "Game_1"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("getter, budget", [(get_player_model, 1), (get_master_model, 1)])
+async def test_get_role_model_profile_round_trips(sqlite_session, getter, budget):
+    session, statements = sqlite_session
+    model = await getter(session, 12345)
+    assert model.user.telegram_id == 12345
+    assert len(statements) == budget
+
+
+@pytest.mark.asyncio
+async def test_get_game_model_profile_round_trips(sqlite_session):
+    session, statements = sqlite_session
+    game = await get_game_model(session, 1)
+    assert game.creator.telegram_id == 12345
+    assert game.players == []
+    assert len(statements) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_entity_unknown_profile(mock_session):
+    with pytest.raises(ValueError, match="Unknown load profile"):
+        await _get_entity(mock_session, User, {"telegram_id": 1}, profile="everything")
+
+#############################################
+# Игры игрока одним запросом
+#############################################
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("games_number", [3, 60])
+async def test_get_player_games_overview_single_statement(sqlite_session, games_number):
+    from sqlalchemy import insert
+    from bot.db.base import session_players, session_requests
+    from bot.db.requests import get_player_games_overview
+
+    session, statements = sqlite_session
+    expected = {}
+    for i in range(games_number):
+        game = Session(title=f"Applied_{i}", date_time=datetime.datetime(2030, 1, 1),
+                       format=0, looking_for=0, max_players=4, creator_id=1)
+        session.add(game)
+        await session.flush()
+        kind = ("accepted", "pending", "rejected")[i % 3]
+        if kind == "accepted":
+            await session.execute(insert(session_players).values(session_id=game.id, player_id=1))
+        await session.execute(insert(session_requests).values(
+            session_id=game.id, player_id=1, is_pending=(kind == "pending")))
+        expected[game.title] = kind
+    await session.commit()
+    statements.clear()
+
+    rows = await get_player_games_overview(session, 12345)
+
+    assert len(statements) == 1
+    assert {r["title"]: r["request_status"] for r in rows} == expected
+
+
+@pytest.mark.asyncio
+async def test_get_player_games_overview_archive(sqlite_session):
+    from sqlalchemy import insert
+    from bot.db.base import session_players
+    from bot.db.requests import get_player_games_overview
+
+    session, statements = sqlite_session
+    game = Session(title="Finished", date_time=datetime.datetime(2020, 1, 1),
+                   format=0, looking_for=0, max_players=4, creator_id=1, status=False)
+    session.add(game)
+    await session.flush()
+    await session.execute(insert(session_players).values(session_id=game.id, player_id=1))
+    await session.commit()
+
+    assert await get_player_games_overview(session, 12345) == []
+    archive = await get_player_games_overview(session, 12345, archived=True)
+    assert [(r["title"], r["request_status"]) for r in archive] == [("Finished", "accepted")]
+
+
+@pytest.mark.asyncio
+async def test_get_player_games_overview_unknown_user(sqlite_session):
+    from bot.db.requests import get_player_games_overview
+
+    session, statements = sqlite_session
+    assert await get_player_games_overview(session, 999) == []
+
+
+async def _add_second_player(session):
+    user = create_dummy_user(id=2, telegram_id=777, name="Applicant", created_at=None)
+    session.add(user)
+    await session.flush()
+    session.add(Player(id=2, experience_level=1, availability="full"))
+    await session.commit()
+
+
+@pytest.mark.asyncio
+async def test_join_request_accept_flow(sqlite_session):
+    from bot.db.requests import apply_to_game, get_game_requests, accept_request, get_player_games_overview
+
+    session, statements = sqlite_session
+    await _add_second_player(session)
+
+    assert await apply_to_game(session, 777, 1) is True
+    # Повторная заявка и заявка на свою игру не проходят
+    assert await apply_to_game(session, 777, 1) is False
+    assert await apply_to_game(session, 12345, 1) is False
+    assert [r["request_status"] for r in await get_player_games_overview(session, 777)] == ["pending"]
+
+    requests = await get_game_requests(session, 1)
+    assert [(r["player_id"], r["name"], r["experience_level"]) for r in requests] == [(2, "Applicant", "Опыт2")]
+
+    assert await accept_request(session, 1, 2) == "accepted"
+    assert await accept_request(session, 1, 2) == "missing"
+    assert await get_game_requests(session, 1) == []
+    assert [r["request_status"] for r in await get_player_games_overview(session, 777)] == ["accepted"]
+    # Игрок уже в игре — новая заявка не нужна
+    assert await apply_to_game(session, 777, 1) is False
+
+
+@pytest.mark.asyncio
+async def test_join_request_accept_needs_free_seat(sqlite_session):
+    from sqlalchemy import update
+    from bot.db.current_requests import decide_request
+    from bot.db.requests import apply_to_game, accept_request, get_game_requests
+
+    session, _ = sqlite_session
+    await _add_second_player(session)
+    session.add(create_dummy_user(id=3, telegram_id=778, name="Late", created_at=None))
+    await session.flush()
+    session.add(Player(id=3, experience_level=0, availability="full"))
+    await session.execute(update(Session).where(Session.id == 1).values(max_players=1))
+    await session.commit()
+
+    assert await apply_to_game(session, 777, 1) is True
+    assert await apply_to_game(session, 778, 1) is True
+    assert await decide_request(None, 1, 2, True, session=session) == "accepted"
+    # Место одно и уже занято — заявка остаётся на рассмотрении
+    assert await accept_request(session, 1, 3) == "full"
+    assert [r["player_id"] for r in await get_game_requests(session, 1)] == [3]
+    assert await decide_request(None, 1, 3, False, session=session) == "rejected"
+    assert await decide_request(None, 1, 3, False, session=session) == "missing"
+
+
+@pytest.mark.asyncio
+async def test_join_request_reject_flow(sqlite_session):
+    from bot.db.requests import apply_to_game, get_game_requests, reject_request, get_player_games_overview
+
+    session, statements = sqlite_session
+    await _add_second_player(session)
+    # Без анкеты игрока и на закрытую игру заявку подать нельзя
+    assert await apply_to_game(session, 999, 2) is False
+    from sqlalchemy import update
+    await session.execute(update(Session).where(Session.id == 1).values(status=False))
+    await session.commit()
+    assert await apply_to_game(session, 777, 1) is False
+
+    assert await apply_to_game(session, 777, 2) is True
+    assert await reject_request(session, 2, 2) is True
+    assert await reject_request(session, 2, 2) is False
+    assert await get_game_requests(session, 2) == []
+    assert [r["request_status"] for r in await get_player_games_overview(session, 777)] == ["rejected"]
+    assert await apply_to_game(session, 777, 2) is False
+
+
+@pytest.mark.asyncio
+async def test_upgrade_schema_fills_city_key():
+    pytest.importorskip("aiosqlite")
+    from sqlalchemy import text
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from bot.db.base import Base
+    from bot.db.schema import upgrade_schema
+
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        # sessions.city без NOT NULL и без city_key
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(text("DROP INDEX ix_sessions_open_format_city_key"))
+        await conn.execute(text("ALTER TABLE sessions DROP COLUMN city_key"))
+        await conn.execute(text("ALTER TABLE sessions RENAME COLUMN city TO city_old"))
+        await conn.execute(text("ALTER TABLE sessions ADD COLUMN city VARCHAR(100)"))
+        await conn.execute(text("INSERT INTO users (id, telegram_id, name, age, city, time_zone, role, game_format, "
+                                "preferred_systems) VALUES (1, 1, 'u', 30, ' Нижний  Новгород', 3, 1, 1, '')"))
+        await conn.execute(text("INSERT INTO sessions (id, title, date_time, format, status, is_paid, creator_id, "
+                                "city_old, city) VALUES (1, 'a', '2030-01-01', 0, 1, 0, 1, '', NULL), "
+                                "(2, 'b', '2030-01-01', 1, 1, 0, 1, '', 'Казань')"))
+
+        created = await conn.run_sync(upgrade_schema)
+        assert created["columns"] == ["sessions.city_key"]
+        assert created["indexes"] == ["ix_sessions_open_format_city_key"]
+        rows = (await conn.execute(text("SELECT city, city_key FROM sessions ORDER BY id"))).all()
+        assert [tuple(r) for r in rows] == [(" Нижний  Новгород", "нижний новгород"), ("Казань", "казань")]
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_upgrade_schema_from_baseline_tables():
+    pytest.importorskip("aiosqlite")
+    from sqlalchemy import MetaData, Table, Column, Integer, String, Boolean, DateTime, ForeignKey, text
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from bot.db.game_filters import GameFilters
+    from bot.db.game_systems import backfill_game_systems
+    from bot.db.requests import get_open_games_page
+    from bot.db.schema import upgrade_schema
+
+    # Таблица sessions в том виде, в каком её создавала первая версия бота
+    old = MetaData()
+    Table("users", old, Column("id", Integer, primary_key=True), Column("telegram_id", Integer),
+          Column("name", String), Column("age", Integer), Column("city", String), Column("time_zone", Integer),
+          Column("role", Integer), Column("game_format", Integer), Column("preferred_systems", String),
+          Column("about_info", String), Column("created_at", DateTime))
+    Table("sessions", old, Column("id", Integer, primary_key=True), Column("title", String),
+          Column("description", String), Column("game_system", String), Column("date_time", DateTime),
+          Column("format", Integer), Column("status", Boolean), Column("max_players", Integer),
+          Column("looking_for", Integer), Column("creator_id", Integer, ForeignKey("users.id")),
+          Column("master_id", Integer))
+
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(old.create_all)
+        await conn.execute(text("INSERT INTO users VALUES (1, 1, 'u', 30, 'Москва', 3, 1, 1, 'DnD', NULL, NULL)"))
+        await conn.execute(text("INSERT INTO sessions (id, title, game_system, date_time, format, status, creator_id) "
+                                "VALUES (1, 'Old', 'DnD', '2030-01-01 00:00:00', 0, 1, 1)"))
+        created = await conn.run_sync(upgrade_schema)
+        assert {"sessions.city", "sessions.city_key", "sessions.is_paid", "sessions.min_age",
+                "sessions.max_age"} <= set(created["columns"])
+        # Старые игры получили город создателя
+        assert created["filled"] == ["sessions.city", "sessions.city_key"]
+        assert "session_requests" in created["tables"]
+        assert "ix_sessions_open_title_id" in created["indexes"]
+        # Повторный запуск ничего не меняет
+        assert await conn.run_sync(upgrade_schema) == {"tables": [], "columns": [], "filled": [], "indexes": []}
+
+    async with async_sessionmaker(engine)() as session:
+        # Как python -m bot.db.backfill all: после схемы — связи систем
+        await backfill_game_systems(session)
+        # Старые игры получили значения по умолчанию и проходят фильтры по новым колонкам
+        rows, _ = await get_open_games_page(session, filters=GameFilters(is_paid=False, age=30, city="москва",
+                                                                          systems=("dnd",)))
+        assert [(r["title"], r["city"]) for r in rows] == [("Old", "Москва")]
+    await engine.dispose()
+
+#############################################
+# Хранилище FSM в Redis (msgpack)
+#############################################
+
+def _storage_config(**kwargs):
+    from types import SimpleNamespace
+    defaults = {"fsm_storage": "memory", "redis_dsn": "redis://localhost:6379/0",
+                "fsm_state_ttl": 60, "fsm_data_ttl": 120}
+    defaults.update(kwargs)
+    return SimpleNamespace(**defaults)
+
+
+@pytest_asyncio.fixture
+async def redis_storage():
+    fakeredis = pytest.importorskip("fakeredis")
+    from aiogram.fsm.storage.base import DefaultKeyBuilder
+    from bot.base.storage import MsgpackRedisStorage
+
+    redis = fakeredis.FakeAsyncRedis()
+    storage = MsgpackRedisStorage(redis, key_builder=DefaultKeyBuilder(with_destiny=True),
+                                  state_ttl=60, data_ttl=120)
+    yield storage
+    await storage.close()
+
+
+def _storage_key(destiny="default"):
+    from aiogram.fsm.storage.base import StorageKey
+    return StorageKey(bot_id=1, chat_id=10000, user_id=10000, destiny=destiny)
+
+
+@pytest.mark.asyncio
+async def test_redis_storage_data_roundtrip(redis_storage):
+    data = {
+        "new_game": {"title": "Вечер D&D", "date_time": datetime.datetime(2030, 5, 1, 19, 30)},
+        "selected_game": ("player", 3),
+        "birthday": datetime.date(2000, 1, 1),
+        "ids": [1, 2, 3],
+    }
+    await redis_storage.set_data(_storage_key(), data)
+    loaded = await redis_storage.get_data(_storage_key())
+    assert loaded["new_game"] == data["new_game"]
+    assert loaded["selected_game"] == ["player", 3]
+    assert loaded["birthday"] == datetime.date(2000, 1, 1)
+    assert loaded["ids"] == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_redis_storage_is_binary_and_compact(redis_storage):
+    import json
+    data = {"dialog_data": {"player_games": [{"id": i, "title": f"Game {i}"} for i in range(20)]}}
+    await redis_storage.set_data(_storage_key(), data)
+    raw = await redis_storage.redis.get(redis_storage.key_builder.build(_storage_key(), "data"))
+    assert isinstance(raw, bytes)
+    assert len(raw) < len(json.dumps(data).encode())
+
+
+@pytest.mark.asyncio
+async def test_redis_storage_ttl(redis_storage):
+    await redis_storage.set_state(_storage_key(), "Registration:typing_age")
+    await redis_storage.set_data(_storage_key(), {"a": 1})
+    state_ttl = await redis_storage.redis.ttl(redis_storage.key_builder.build(_storage_key(), "state"))
+    data_ttl = await redis_storage.redis.ttl(redis_storage.key_builder.build(_storage_key(), "data"))
+    assert 0 < state_ttl <= 60
+    assert 60 < data_ttl <= 120
+    assert await redis_storage.get_state(_storage_key()) == "Registration:typing_age"
+
+
+@pytest.mark.asyncio
+async def test_redis_storage_empty_data_removes_key(redis_storage):
+    await redis_storage.set_data(_storage_key(), {"a": 1})
+    await redis_storage.set_data(_storage_key(), {})
+    assert await redis_storage.get_data(_storage_key()) == {}
+    assert await redis_storage.redis.keys("*") == []
+
+
+@pytest.mark.asyncio
+async def test_redis_storage_dialog_destinies_are_separate(redis_storage):
+    await redis_storage.set_data(_storage_key("aiogd:stack:"), {"intents": ["abc"]})
+    await redis_storage.set_data(_storage_key("aiogd:context:abc"), {"state": "Profile:checking_info"})
+    assert await redis_storage.get_data(_storage_key("aiogd:stack:")) == {"intents": ["abc"]}
+    assert await redis_storage.get_data(_storage_key("aiogd:context:abc")) == {"state": "Profile:checking_info"}
+
+
+@pytest.mark.asyncio
+async def test_redis_storage_rejects_unknown_types(redis_storage):
+    with pytest.raises(TypeError):
+        await redis_storage.set_data(_storage_key(), {"obj": object()})
+
+
+def test_build_storage_modes():
+    pytest.importorskip("redis")
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from bot.base.storage import build_storage, MsgpackRedisStorage
+
+    assert isinstance(build_storage(_storage_config()), MemoryStorage)
+    storage = build_storage(_storage_config(fsm_storage="redis"))
+    assert isinstance(storage, MsgpackRedisStorage)
+    assert storage.state_ttl == 60 and storage.data_ttl == 120
+    with pytest.raises(ValueError):
+        build_storage(_storage_config(fsm_storage="sqlite"))
+
+
+def test_build_events_isolation_shares_redis_with_storage():
+    pytest.importorskip("redis")
+    from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
+    from aiogram.fsm.storage.redis import RedisEventIsolation
+    from bot.base.storage import build_storage, build_events_isolation
+
+    assert isinstance(build_events_isolation(MemoryStorage()), SimpleEventIsolation)
+    storage = build_storage(_storage_config(fsm_storage="redis"))
+    isolation = build_events_isolation(storage)
+    assert isinstance(isolation, RedisEventIsolation)
+    assert isolation.redis is storage.redis
+    assert isolation.key_builder is storage.key_builder
+
+
+@pytest.mark.asyncio
+async def test_redis_events_isolation_serializes_one_user(redis_storage):
+    pytest.importorskip("lupa")  # блокировки redis-py — Lua-скрипты, fakeredis исполняет их через lupa
+    from bot.base.storage import build_events_isolation
+
+    isolation = build_events_isolation(redis_storage)
+    order = []
+
+    async def handle(name):
+        async with isolation.lock(_storage_key()):
+            order.append(f"{name}:start")
+            await asyncio.sleep(0.05)
+            order.append(f"{name}:end")
+
+    await asyncio.gather(handle("a"), handle("b"))
+    # Второй апдейт того же пользователя ждёт, пока закончится первый
+    assert order in (["a:start", "a:end", "b:start", "b:end"], ["b:start", "b:end", "a:start", "a:end"])
+
+
+@pytest.mark.parametrize("env, ok", [
+    ({"RUN_MODE": "webhook", "WEBHOOK_WORKERS": "4", "FSM_STORAGE": "memory"}, False),
+    ({"RUN_MODE": "webhook", "WEBHOOK_WORKERS": "4", "FSM_STORAGE": "redis"}, True),
+    ({"RUN_MODE": "webhook", "WEBHOOK_WORKERS": "1", "FSM_STORAGE": "memory"}, True),
+    ({"RUN_MODE": "polling", "WEBHOOK_WORKERS": "4", "FSM_STORAGE": "memory"}, True),
+])
+def test_config_requires_redis_for_several_workers(monkeypatch, env, ok):
+    from pydantic import ValidationError
+
+    monkeypatch.setenv("BOT_TOKEN", "1:test")
+    from bot.base.config_reader import TelegramConfig
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    if ok:
+        assert TelegramConfig().webhook_workers == int(env["WEBHOOK_WORKERS"])
+    else:
+        with pytest.raises(ValidationError, match="FSM_STORAGE=redis"):
+            TelegramConfig()
+
+
+#############################################
+# Webhook: приём апдейтов через локальный «Telegram»
+#############################################
+
+@pytest_asyncio.fixture
+async def fake_telegram():
+    """
+    Локальная замена Bot API: принимает вызовы /bot<token>/<method>,
+    запоминает их и отвечает как Telegram.
+    Возвращает (bot, calls), где calls — список (method, payload).
+    """
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    calls = []
+
+    async def handle(request):
+        method = request.match_info["method"].lower()
+        payload = dict(await request.post())
+        calls.append((method, payload))
+        result = True
+        if method == "sendmessage":
+            result = {
+                "message_id": len(calls), "date": 0, "text": payload.get("text", ""),
+                "chat": {"id": int(payload["chat_id"]), "type": "private"},
+            }
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    server = TestServer(app)
+    await server.start_server()
+
+    api = TelegramAPIServer.from_base(str(server.make_url("")).rstrip("/"))
+    bot = Bot(token="42:TEST", session=AiohttpSession(api=api))
+    yield bot, calls
+    await bot.session.close()
+    await server.close()
+
+
+def _message_update(update_id, text="/start", user_id=10000):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+        },
+    }
+
+
+def _echo_dispatcher():
+    from aiogram import Dispatcher, Router
+    from aiogram.types import Message
+
+    router = Router()
+
+    @router.message()
+    async def echo(message: Message):
+        await message.answer(f"echo {message.text}")
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp
+
+
+@pytest_asyncio.fixture
+async def webhook_client(fake_telegram):
+    from aiohttp.test_utils import TestClient, TestServer
+    from bot.base.webhook import build_webhook_app
+
+    bot, calls = fake_telegram
+
+    async def make(handle_in_background):
+        app = build_webhook_app(_echo_dispatcher(), bot, "/webhook", secret_token="s3cret",
+                                handle_in_background=handle_in_background)
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        clients.append(client)
+        return client
+
+    clients = []
+    yield make, calls
+    for client in clients:
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_webhook_app_feeds_dispatcher(webhook_client):
+    make, calls = webhook_client
+    client = await make(handle_in_background=False)
+    resp = await client.post("/webhook", json=_message_update(1, "/start"),
+                             headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+    assert resp.status == 200
+    assert calls == [("sendmessage", {"chat_id": "10000", "text": "echo /start"})]
+
+
+@pytest.mark.asyncio
+async def test_webhook_app_rejects_wrong_secret(webhook_client):
+    make, calls = webhook_client
+    client = await make(handle_in_background=False)
+    resp = await client.post("/webhook", json=_message_update(1),
+                             headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+    assert resp.status == 401
+    assert calls == []
+
+
+@pytest.mark.asyncio
+async def test_webhook_app_background_burst(webhook_client):
+    make, calls = webhook_client
+    client = await make(handle_in_background=True)
+    responses = await asyncio.gather(*[
+        client.post("/webhook", json=_message_update(i, f"/search {i}", user_id=10000 + i),
+                    headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+        for i in range(50)
+    ])
+    assert all(r.status == 200 for r in responses)
+    for _ in range(100):
+        if len(calls) == 50:
+            break
+        await asyncio.sleep(0.02)
+    assert sorted(p["text"] for _, p in calls) == sorted(f"echo /search {i}" for i in range(50))
+
+
+def test_get_webhook_url():
+    from types import SimpleNamespace
+    from bot.base.webhook import get_webhook_url
+
+    cfg = SimpleNamespace(webhook_base_url="https://example.com/", webhook_path="/webhook")
+    assert get_webhook_url(cfg) == "https://example.com/webhook"
+    with pytest.raises(ValueError):
+        get_webhook_url(SimpleNamespace(webhook_base_url="", webhook_path="/webhook"))
+
+
+def _record_worker_pid():
+    import os
+    with open(os.environ["TRG_WORKERS_LOG"], "a") as f:
+        f.write(f"{os.getpid()}\n")
+
+
+def test_run_webhook_workers_fan_out(tmp_path, monkeypatch):
+    import os
+    from bot.base.webhook import run_webhook_workers
+
+    log = tmp_path / "workers.log"
+    monkeypatch.setenv("TRG_WORKERS_LOG", str(log))
+
+    run_webhook_workers(_record_worker_pid, 1)
+    assert log.read_text().split() == [str(os.getpid())]
+
+    log.write_text("")
+    run_webhook_workers(_record_worker_pid, 3)
+    pids = log.read_text().split()
+    assert len(set(pids)) == 3 and str(os.getpid()) not in pids
+
+
+#############################################
+# DbSessionMiddleware: ленивая сессия
+#############################################
+
+def _db_sessions_counts():
+    from bot.base.metrics import DB_UPDATE_SESSIONS
+    return (DB_UPDATE_SESSIONS.labels(used="true")._value.get(),
+            DB_UPDATE_SESSIONS.labels(used="false")._value.get())
+
+
+@pytest.mark.asyncio
+async def test_db_middleware_skips_session_for_plain_updates(mock_session):
+    from bot.base.db_middleware import DbSessionMiddleware
+    maker = MagicMock(return_value=mock_session)
+    middleware = DbSessionMiddleware(maker)
+    used, unused = _db_sessions_counts()
+
+    await middleware(AsyncMock(return_value="ok"), None, {})
+
+    maker.assert_not_called()
+    assert _db_sessions_counts() == (used, unused + 1)
+
+
+@pytest.mark.asyncio
+async def test_db_middleware_creates_session_on_first_use(mock_session):
+    from bot.base.db_middleware import DbSessionMiddleware
+    maker = MagicMock(return_value=mock_session)
+    middleware = DbSessionMiddleware(maker)
+    used, unused = _db_sessions_counts()
+
+    async def handler(event, data):
+        await data["db_session"].execute("SELECT 1")
+        await data["db_session"].commit()
+        return "done"
+
+    assert await middleware(handler, None, {}) == "done"
+
+    maker.assert_called_once()
+    mock_session.execute.assert_awaited_once_with("SELECT 1")
+    mock_session.close.assert_awaited_once()
+    assert _db_sessions_counts() == (used + 1, unused)
+
+
+@pytest.mark.asyncio
+async def test_db_middleware_closes_session_on_error(mock_session):
+    from bot.base.db_middleware import DbSessionMiddleware
+    middleware = DbSessionMiddleware(MagicMock(return_value=mock_session))
+
+    async def handler(event, data):
+        await data["db_session"].execute("SELECT 1")
+        raise RuntimeError("handler failed")
+
+    with pytest.raises(RuntimeError):
+        await middleware(handler, None, {})
+    mock_session.close.assert_awaited_once()
+
+
+def test_extract_session_accepts_lazy_session(mock_session):
+    from bot.db.lazy_session import LazySession
+    from bot.db.current_requests import _extract_session
+    lazy = LazySession(MagicMock(return_value=mock_session))
+    dm = MagicMock(middleware_data={"db_session": lazy})
+    assert _extract_session(dm) is lazy
+    assert lazy.touched is False
+
+
+@pytest.mark.asyncio
+async def test_lazy_session_touched_only_by_database_calls(sqlite_session):
+    from sqlalchemy import select
+    from bot.db.lazy_session import LazySession
+    session, _ = sqlite_session
+    lazy = LazySession(MagicMock(return_value=session))
+
+    lazy.get_bind()
+    lazy.bind
+    lazy.info
+    await lazy.commit()
+    assert lazy.touched is False
+
+    await lazy.scalar(select(User.id).limit(1))
+    assert lazy.touched is True
+
+    lazy = LazySession(MagicMock(return_value=session))
+    lazy.add(create_dummy_user(id=987654, telegram_id=987654))
+    await lazy.commit()
+    assert lazy.touched is True
+
+
+#############################################
+# Пул соединений: настройки и метрики
+#############################################
+
+def test_pool_kwargs_postgres():
+    from bot.base.db_middleware import _pool_kwargs, InstrumentedQueuePool
+    kwargs = _pool_kwargs("postgresql+asyncpg://u:p@localhost/db", 5, 7, 3.0, 600, False, 0)
+    assert kwargs["poolclass"] is InstrumentedQueuePool
+    assert (kwargs["pool_size"], kwargs["max_overflow"], kwargs["pool_timeout"]) == (5, 7, 3.0)
+    assert (kwargs["pool_recycle"], kwargs["pool_pre_ping"]) == (600, False)
+    assert kwargs["connect_args"] == {"statement_cache_size": 0, "prepared_statement_cache_size": 0}
+
+
+def test_pool_kwargs_default_statement_cache():
+    from bot.base.db_middleware import _pool_kwargs
+    kwargs = _pool_kwargs("postgresql+asyncpg://u:p@localhost/db", 5, 7, 3.0, 600, True, None)
+    assert "connect_args" not in kwargs
+
+
+def test_pool_kwargs_sqlite_memory():
+    from bot.base.db_middleware import _pool_kwargs
+    assert _pool_kwargs("sqlite+aiosqlite:///:memory:", 5, 7, 3.0, 600, True, 0) == {}
+
+
+@pytest.mark.asyncio
+async def test_pool_metrics(tmp_path):
+    pytest.importorskip("aiosqlite")
+    from sqlalchemy import text
+    from bot.base.db_middleware import build_session_maker, InstrumentedQueuePool
+    from bot.base.metrics import DB_POOL_SIZE, DB_POOL_CHECKED_OUT, DB_POOL_OVERFLOW, DB_POOL_WAIT_SECONDS
+
+    def value(metric, suffix=""):
+        return next(s.value for m in metric.collect() for s in m.samples if s.name == m.name + suffix)
+
+    engine, maker = build_session_maker(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}",
+                                        pool_size=2, max_overflow=1, pool_timeout=1)
+    assert isinstance(engine.pool, InstrumentedQueuePool)
+    waits_before = value(DB_POOL_WAIT_SECONDS, "_count")
+
+    sessions = [maker() for _ in range(3)]
+    for s in sessions:
+        await s.execute(text("SELECT 1"))
+    assert value(DB_POOL_SIZE) == 2
+    assert value(DB_POOL_CHECKED_OUT) == 3
+    assert value(DB_POOL_OVERFLOW) == 1
+    assert value(DB_POOL_WAIT_SECONDS, "_count") == waits_before + 3
+
+    for s in sessions:
+        await s.close()
+    assert value(DB_POOL_CHECKED_OUT) == 0
+    await engine.dispose()
+
+
+#############################################
+# Поиск открытых игр: keyset-пагинация
+#############################################
+
+async def _add_open_games(session, titles):
+    for title in titles:
+        session.add(Session(title=title, date_time=datetime.datetime(2030, 1, 1),
+                            format=1, looking_for=0, max_players=5, creator_id=1))
+    await session.commit()
+
+
+@pytest.mark.asyncio
+async def test_get_open_games_page_walks_all_games(sqlite_session):
+    from bot.db.requests import get_open_games_page
+
+    session, statements = sqlite_session
+    # Повторяющиеся названия: порядок внутри них задаёт id
+    await _add_open_games(session, [f"Quest_{i % 7}" for i in range(23)])
+    statements.clear()
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        rows, cursor = await get_open_games_page(session, after=cursor, limit=8)
+        pages += 1
+        assert len(rows) <= 8
+        seen.extend((r["title"], r["id"]) for r in rows)
+        if cursor is None:
+            break
+
+    assert pages == 4
+    assert len(statements) == pages
+    assert len(seen) == 25
+    assert seen == sorted(seen)
+
+
+@pytest.mark.asyncio
+async def test_get_open_games_page_exact_page_has_no_next(sqlite_session):
+    from bot.db.requests import get_open_games_page
+
+    session, _ = sqlite_session
+    rows, cursor = await get_open_games_page(session, limit=2)
+    assert [r["title"] for r in rows] == ["Game_0", "Game_1"]
+    assert cursor is None
+
+
+@pytest.mark.asyncio
+async def test_get_open_games_page_skips_closed_and_counts_players(sqlite_session):
+    from sqlalchemy import insert
+    from bot.db.base import session_players
+    from bot.db.requests import get_open_games_page
+
+    session, _ = sqlite_session
+    session.add(Session(title="Closed", date_time=datetime.datetime(2030, 1, 1),
+                        format=0, looking_for=0, creator_id=1, status=False))
+    await session.execute(insert(session_players).values(session_id=1, player_id=1))
+    await session.commit()
+
+    rows, _ = await get_open_games_page(session)
+    assert [r["title"] for r in rows] == ["Game_0", "Game_1"]
+    assert rows[0]["current_players"] == 1
+    assert rows[1]["current_players"] == 0
+    assert (rows[0]["city"], rows[0]["master_name"]) == ("TestCity", "TestUser")
+
+
+def test_open_games_sort_index_is_partial():
+    index = next(i for i in Session.__table__.indexes if i.name == "ix_sessions_open_title_id")
+    assert [c.name for c in index.columns] == ["title", "id"]
+    assert index.dialect_options["postgresql"]["where"] is not None
+
+
+@pytest.mark.asyncio
+async def test_searching_game_pager(sqlite_session):
+    from bot.dialogs.games.searching_game import get_search_data, on_next_page, on_prev_page
+
+    session, _ = sqlite_session
+    await _add_open_games(session, [f"Quest_{i:02}" for i in range(10)])
+    manager = MagicMock()
+    manager.dialog_data = {}
+    manager.middleware_data = {"db_session": session}
+
+    first = await get_search_data(manager)
+    assert first["page"] == 1 and first["has_next"] and not first["has_prev"]
+    assert [it["title"] for it in first["items"]][:2] == ["Game_0", "Game_1"]
+
+    await on_next_page(MagicMock(), MagicMock(), manager)
+    second = await get_search_data(manager)
+    assert second["page"] == 2 and second["has_prev"] and not second["has_next"]
+    assert [it["title"] for it in second["items"]] == ["Quest_06", "Quest_07", "Quest_08", "Quest_09"]
+    # В dialog_data хранится только текущая страница
+    assert set(manager.dialog_data["search_items"]) == {it["id"] for it in second["items"]}
+
+    await on_prev_page(MagicMock(), MagicMock(), manager)
+    assert (await get_search_data(manager))["items"] == first["items"]
+
+
+#############################################
+# Фильтры поиска открытых игр
+#############################################
+
+async def _add_filtered_games(session):
+    from sqlalchemy import insert
+    from bot.db.base import session_players
+
+    base = dict(date_time=datetime.datetime(2030, 1, 1), looking_for=0, creator_id=1)
+    session.add_all([
+        Session(title="Cthulhu online", game_system="Call of Cthulhu", format=0, max_players=1, **base),
+        Session(title="DnD Kazan", game_system="D&D 5e", format=1, city="Казань", is_paid=True, **base),
+        Session(title="DnD online adults", game_system="D&D 5e", format=0, min_age=18, **base),
+        Session(title="Teens only", game_system="D&D 5e", format=0, max_age=17, **base),
+    ])
+    await session.flush()
+    # Игра "Cthulhu online" заполнена
+    await session.execute(insert(session_players).values(session_id=3, player_id=1))
+    await session.commit()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("filters, expected", [
+    (dict(systems=("D&D 5e",)), ["DnD Kazan", "DnD online adults", "Teens only"]),
+    (dict(systems=("D&D 5e", "Call of Cthulhu"), format=0), ["Cthulhu online", "DnD online adults", "Teens only"]),
+    (dict(city="Казань"), ["DnD Kazan"]),
+    # Регистр и лишние пробелы не важны
+    (dict(city=" казань "), ["DnD Kazan"]),
+    (dict(systems=("d&d  5E",)), ["DnD Kazan", "DnD online adults", "Teens only"]),
+    # Игры без своего города ищутся по городу создателя
+    (dict(city="testcity", format=0), ["Cthulhu online", "DnD online adults", "Game_0", "Game_1", "Teens only"]),
+    (dict(is_paid=True), ["DnD Kazan"]),
+    (dict(is_paid=False, systems=("D&D 5e",)), ["DnD online adults", "Teens only"]),
+    (dict(age=16, systems=("D&D 5e",)), ["DnD Kazan", "Teens only"]),
+    (dict(age=30, systems=("D&D 5e",)), ["DnD Kazan", "DnD online adults"]),
+    (dict(free_seats=True, format=0), ["DnD online adults", "Game_0", "Game_1", "Teens only"]),
+    (dict(time_zone=5, tz_window=2), ["Cthulhu online", "DnD Kazan", "DnD online adults", "Game_0",
+                                      "Game_1", "Teens only"]),
+    (dict(time_zone=9, tz_window=2), []),
+])
+async def test_get_open_games_page_filters(sqlite_session, filters, expected):
+    from bot.db.game_filters import GameFilters
+    from bot.db.requests import get_open_games_page
+
+    session, statements = sqlite_session
+    await _add_filtered_games(session)
+    statements.clear()
+
+    rows, _ = await get_open_games_page(session, filters=GameFilters(**filters))
+    assert [r["title"] for r in rows] == expected
+    assert len(statements) == 1
+
+
+@pytest.mark.asyncio
+async def test_get_open_games_page_filters_keep_pagination(sqlite_session):
+    from bot.db.game_filters import GameFilters
+    from bot.db.requests import get_open_games_page
+
+    session, _ = sqlite_session
+    await _add_filtered_games(session)
+    filters = GameFilters(systems=("D&D 5e",))
+
+    first, cursor = await get_open_games_page(session, limit=2, filters=filters)
+    second, last = await get_open_games_page(session, after=cursor, limit=2, filters=filters)
+    assert [r["title"] for r in first + second] == ["DnD Kazan", "DnD online adults", "Teens only"]
+    assert last is None
+    # Город игры важнее города мастера
+    assert first[0]["city"] == "Казань"
+
+
+@pytest.mark.asyncio
+async def test_game_city_follows_edits_and_bulk_import(sqlite_session):
+    from bot.db.game_filters import GameFilters
+    from bot.db.requests import get_open_games_page, register_games_bulk
+
+    session, _ = sqlite_session
+
+    async def titles(city):
+        rows, _ = await get_open_games_page(session, filters=GameFilters(city=city))
+        return [r["title"] for r in rows]
+
+    await edit_game(1, {"city": "  Нижний   Новгород"}, session)
+    assert await titles("нижний новгород") == ["Game_0"]
+    # Пустой город — снова город создателя
+    await edit_game(1, {"city": None}, session)
+    assert await titles("TESTCITY") == ["Game_0", "Game_1"]
+
+    game = {"date_time": "2030-01-01T19:00", "format": "Онлайн", "looking_for": "Игрок", "creator_id": "1"}
+    result = await register_games_bulk([{**game, "title": "Bulk own"}, {**game, "title": "Bulk Omsk", "city": "Омск"}],
+                                       session)
+    assert sorted(result.created) == [0, 1]
+    assert await titles("омск") == ["Bulk Omsk"]
+    assert await titles("testcity") == ["Bulk own", "Game_0", "Game_1"]
+
+
+def test_game_filters_normalize_and_round_trip():
+    from bot.db.game_filters import GameFilters
+
+    f = GameFilters(systems=(" D&D 5e ", "", "GURPS"), city="  ", is_paid=False, time_zone=3, tz_window=2)
+    assert f.systems == ("D&D 5e", "GURPS")
+    assert f.city is None
+    assert f.to_dict() == {"systems": ["D&D 5e", "GURPS"], "is_paid": False, "time_zone": 3, "tz_window": 2}
+    assert GameFilters.from_dict(f.to_dict()) == f
+    assert GameFilters.from_dict(None).is_empty
+    assert GameFilters().to_dict() == {}
+
+
+@pytest.mark.parametrize("kwargs", [dict(format=5), dict(format=-1), dict(tz_window=-1)])
+def test_game_filters_invalid(kwargs):
+    from bot.db.game_filters import GameFilters
+
+    with pytest.raises(ValueError):
+        GameFilters(**kwargs)
+
+
+@pytest.mark.asyncio
+async def test_searching_game_filter_handlers(sqlite_session):
+    from bot.dialogs.games.searching_game import (
+        get_search_data, on_cycle_format, on_toggle_age, on_reset_filters, on_ask_filter_text, on_filter_text,
+    )
+
+    session, _ = sqlite_session
+    await _add_filtered_games(session)
+    manager = MagicMock()
+    manager.dialog_data = {"search_cursors": [None, ["Game_0", 1]]}
+    manager.middleware_data = {"db_session": session}
+    callback = MagicMock()
+    callback.from_user.id = 12345
+    callback.answer = AsyncMock()
+
+    await on_cycle_format(callback, MagicMock(), manager)
+    assert manager.dialog_data["search_filters"] == {"format": 0}
+    # Смена фильтров начинает список с первой страницы
+    assert manager.dialog_data["search_cursors"] == [None]
+
+    button = MagicMock()
+    button.widget_id = "systems"
+    await on_ask_filter_text(callback, button, manager)
+    message = MagicMock()
+    message.text = "D&D 5e, GURPS"
+    await on_filter_text(message, MagicMock(), manager)
+    await on_toggle_age(callback, MagicMock(), manager)
+    assert manager.dialog_data["search_filters"] == {"systems": ["D&D 5e", "GURPS"], "format": 0, "age": 30}
+
+    data = await get_search_data(manager)
+    assert [it["title"] for it in data["items"]] == ["DnD online adults"]
+    assert data["filtered"]
+
+    await on_reset_filters(callback, MagicMock(), manager)
+    assert not (await get_search_data(manager))["filtered"]
+
+
+#############################################
+# Текстовый поиск по играм
+#############################################
+
+def test_parse_query_expands_synonyms():
+    from bot.db.game_search import parse_query, to_tsquery_text
+
+    groups = parse_query("ДнД 5")
+    assert groups == [(("днд",), ("dnd",), ("d", "d")), (("5",),)]
+    assert to_tsquery_text(groups) == "(днд:* | dnd:* | (d:* <-> d:*)) & (5:*)"
+    assert parse_query("  !!! ") == []
+
+
+def test_game_search_index_ranking():
+    from bot.db.game_search import GameSearchIndex
+
+    index = GameSearchIndex()
+    index.add(1, "Проклятие Страда", "D&D 5e", "Готический хоррор")
+    index.add(2, "Зов из глубин", "Call of Cthulhu", "Расследование в Аркхеме")
+    index.add(3, "Pathfinder: Kingmaker", "Pathfinder 2e", "Строим королевство")
+    index.add(4, "Ваншот", "GURPS", "Короткое приключение про проклятие фараона")
+
+    assert [h.id for h in index.search("днд 5")] == [1]
+    assert [h.id for h in index.search("ктулху")] == [2]
+    # Опечатка находится по триграммам
+    assert [h.id for h in index.search("pathfnder")] == [3]
+    # Совпадение в названии выше, чем в описании; окончания не мешают
+    assert [h.id for h in index.search("проклятия")] == [1, 4]
+    assert index.search("проклятия", ids=[4])[0].id == 4
+    assert index.search("эльфы") == []
+
+    index.remove(1)
+    assert [h.id for h in index.search("проклятие")] == [4]
+
+
+@pytest.mark.asyncio
+async def test_search_open_games_fallback(sqlite_session):
+    from bot.db.game_filters import GameFilters
+    from bot.db.requests import search_open_games
+
+    session, statements = sqlite_session
+    base = dict(date_time=datetime.datetime(2030, 1, 1), looking_for=0, creator_id=1)
+    session.add_all([
+        Session(title="Зов Ктулху: Маски", game_system="Call of Cthulhu", format=0, **base),
+        Session(title="Ктулху для новичков", game_system="Call of Cthulhu", format=1, **base),
+        Session(title="Зов из бездны", game_system="Call of Cthulhu", description="Ктулху ждёт", format=0, **base),
+        Session(title="Closed Cthulhu", game_system="Call of Cthulhu", format=0, status=False, **base),
+    ])
+    await session.commit()
+    statements.clear()
+
+    rows, cursor = await search_open_games(session, "ктулху", limit=2)
+    assert [r["title"] for r in rows] == ["Зов Ктулху: Маски", "Ктулху для новичков"]
+    assert rows[0]["rank"] >= rows[1]["rank"]
+    assert rows[0]["master_name"] == "TestUser"
+    assert len(statements) == 2
+
+    rest, last = await search_open_games(session, "ктулху", after=cursor, limit=2)
+    assert [r["title"] for r in rest] == ["Зов из бездны"]
+    assert last is None
+
+    online, _ = await search_open_games(session, "ктулху", filters=GameFilters(format=1))
+    assert [r["title"] for r in online] == ["Ктулху для новичков"]
+    assert await search_open_games(session, "   ") == ([], None)
+
+
+@pytest.mark.asyncio
+async def test_searching_game_text_search(sqlite_session):
+    from bot.dialogs.games.searching_game import get_search_data, on_search_text, on_clear_search
+
+    session, _ = sqlite_session
+    session.add(Session(title="Зов Ктулху", game_system="Call of Cthulhu", date_time=datetime.datetime(2030, 1, 1),
+                        format=0, looking_for=0, creator_id=1))
+    await session.commit()
+    manager = MagicMock()
+    manager.dialog_data = {"search_cursors": [None, ["Game_0", 1]]}
+    manager.middleware_data = {"db_session": session}
+
+    message = MagicMock()
+    message.text = " ктулху "
+    await on_search_text(message, MagicMock(), manager)
+    data = await get_search_data(manager)
+    assert data["query"] == "ктулху"
+    assert [it["title"] for it in data["items"]] == ["Зов Ктулху"]
+
+    await on_clear_search(MagicMock(), MagicMock(), manager)
+    assert len((await get_search_data(manager))["items"]) == 3
+
+
+#############################################
+# Подбор игр для игрока
+#############################################
+
+def _candidate_rows():
+    base = dict(format=0, game_system="D&D 5e", time_zone=3, min_age=None, max_age=None,
+                max_players=5, current_players=0)
+    return [
+        dict(base, id=1),
+        dict(base, id=2, format=1),                        # не тот формат
+        dict(base, id=3, game_system="GURPS"),             # не та система
+        dict(base, id=4, time_zone=9),                     # далёкий часовой пояс
+        dict(base, id=5, min_age=18),                      # игрок слишком молод
+        dict(base, id=6, max_players=2, current_players=2),  # мест нет
+        dict(base, id=7, max_players=None),                # без ограничения мест
+        dict(base, id=8, max_players=6, current_players=5),  # одно место
+    ]
+
+
+def test_game_candidates_scores():
+    import numpy as np
+    from bot.db.recommendations import GameCandidates, PlayerProfile
+
+    games = GameCandidates.from_rows(_candidate_rows())
+    player = PlayerProfile(game_format=0b01, systems=("d&d 5e",), time_zone=3, age=16)
+    scores = dict(zip(games.ids.tolist(), games.scores(player).tolist()))
+
+    assert scores[5] == scores[6] == -np.inf
+    assert scores[1] == scores[7] > scores[8] > scores[4] > scores[3] > scores[2]
+    # Возраст неизвестен — ограничение по возрасту не применяется
+    assert np.isfinite(games.scores(player._replace(age=None))[4])
+
+
+def test_game_candidates_system_keys_match_player_systems():
+    from bot.db.recommendations import GameCandidates, PlayerProfile, split_systems
+
+    rows = [dict(_candidate_rows()[0], id=1, game_system="  D&D   5E "), dict(_candidate_rows()[0], id=2),
+            dict(_candidate_rows()[0], id=3, game_system="Shadowrun, gurps"),
+            dict(_candidate_rows()[0], id=4, game_system="Shadowrun")]
+    games = GameCandidates.from_rows(rows)
+    player = PlayerProfile(game_format=0b01, systems=split_systems("d&d 5e,  GURPS"), time_zone=3)
+    scores = games.scores(player)
+    # Лишние пробелы и регистр в названии системы игры не мешают совпадению,
+    # у игры с несколькими системами совпадает любая из них
+    assert scores[0] == scores[1] == scores[2] > scores[3]
+    assert split_systems(" D&D  5e, gurps,d&d 5e") == ("d&d 5e", "gurps")
+
+
+def test_game_candidates_top_k():
+    from bot.db.recommendations import GameCandidates, PlayerProfile
+
+    games = GameCandidates.from_rows(_candidate_rows())
+    player = PlayerProfile(game_format=0b01, systems=("d&d 5e",), time_zone=3, age=16)
+
+    # Равные оценки упорядочены по id
+    assert [i for i, _ in games.top_k(player, 3)] == [1, 7, 8]
+    assert [i for i, _ in games.top_k(player, 100)] == [1, 7, 8, 4, 3, 2]
+    assert games.top_k(player, 0) == []
+    assert GameCandidates.from_rows([]).top_k(player, 5) == []
+
+
+@pytest.mark.asyncio
+async def test_recommend_games(sqlite_session):
+    from bot.db.game_filters import GameFilters
+    from bot.db.requests import recommend_games
+
+    session, statements = sqlite_session
+    other = create_dummy_user(id=2, telegram_id=777, time_zone=10, game_format=0b10,
+                              preferred_systems="GURPS", created_at=None)
+    session.add(other)
+    base = dict(date_time=datetime.datetime(2030, 1, 1), looking_for=0, creator_id=2, max_players=4)
+    session.add_all([
+        Session(title="GURPS online", game_system="GURPS", format=0, **base),
+        Session(title="D&D offline", game_system="D&D", format=1, **base),
+        Session(title="Adults only", game_system="GURPS", format=1, min_age=40, **base),
+    ])
+    await session.commit()
+    statements.clear()
+
+    # Пользователь 12345: онлайн, 30 лет, пояс 3; свои игры (Game_0, Game_1) ему не предлагаются,
+    # "Adults only" не подходит по возрасту
+    rows = await recommend_games(session, 12345)
+    assert [r["title"] for r in rows] == ["GURPS online", "D&D offline"]
+    assert rows[0]["score"] > rows[1]["score"]
+    assert rows[0]["master_name"] == "TestUser"
+    assert len(statements) == 3
+
+    # Пользователь 777 — оффлайн, а Game_0/Game_1 онлайн: равные оценки, порядок по id
+    assert [r["title"] for r in await recommend_games(session, 777)] == ["Game_0", "Game_1"]
+
+    rows = await recommend_games(session, 12345, filters=GameFilters(format=1))
+    assert [r["title"] for r in rows] == ["D&D offline"]
+    assert await recommend_games(session, 999) == []
+
+
+@pytest.mark.asyncio
+async def test_game_candidates_filter_mask_matches_sql_filters(sqlite_session):
+    from sqlalchemy import select
+    from bot.db.base import session_players
+    from bot.db.game_filters import GameFilters
+    from bot.db.requests import get_game_candidates
+
+    session, _ = sqlite_session
+    session.add(create_dummy_user(id=2, telegram_id=777, time_zone=8, created_at=None))
+    base = dict(date_time=datetime.datetime(2030, 1, 1), looking_for=0, status=True)
+    session.add_all([
+        Session(title="A", game_system="D&D 5e, GURPS", format=1, city="Москва", creator_id=1, max_players=2,
+                is_paid=True, **base),
+        Session(title="B", game_system="  gurps ", format=0, city="  санкт-петербург", creator_id=2, min_age=18,
+                **base),
+        Session(title="C", game_system="Shadowrun", format=1, city="Москва", creator_id=2, max_age=25, **base),
+        Session(title="Closed", game_system="GURPS", format=1, creator_id=1, **dict(base, status=False)),
+    ])
+    await session.commit()
+    await session.execute(session_players.insert(), [{"session_id": 3, "player_id": 1}])
+    await session.commit()
+
+    candidates = await get_game_candidates(session)
+    for filters in [GameFilters(), GameFilters(systems=("gurps",)), GameFilters(systems=("D&D  5E", "shadowrun")),
+                    GameFilters(format=1), GameFilters(city="САНКТ-Петербург "), GameFilters(city="Казань"),
+                    GameFilters(time_zone=2, tz_window=1), GameFilters(time_zone=5), GameFilters(is_paid=True),
+                    GameFilters(is_paid=False, format=1), GameFilters(age=16), GameFilters(age=30),
+                    GameFilters(free_seats=True), GameFilters(systems=("GURPS",), city="москва", free_seats=True)]:
+        expected = (await session.execute(
+            select(Session.id).join(User, User.id == Session.creator_id)
+            .where(Session.status.is_(True), *filters.conditions()))).scalars().all()
+        assert sorted(candidates.ids[candidates.filter_mask(filters)].tolist()) == sorted(expected), filters
+
+
+@pytest.mark.asyncio
+async def test_recommend_games_reuses_cached_candidates(sqlite_session):
+    from bot.db.requests import recommend_games, edit_game, game_candidates_cache
+
+    session, statements = sqlite_session
+    other = create_dummy_user(id=2, telegram_id=777, game_format=0b11, created_at=None)
+    session.add(other)
+    await session.commit()
+    assert [r["title"] for r in await recommend_games(session, 777)] == ["Game_0", "Game_1"]
+
+    statements.clear()
+    assert [r["title"] for r in await recommend_games(session, 777)] == ["Game_0", "Game_1"]
+    # Открытые игры не перечитываются: пользователь и строки выбранных игр
+    assert len(statements) == 2
+
+    # Запись игры сбрасывает набор; новая игра сразу участвует в подборе
+    await register_game(SessionModel(Session(title="Game_2", date_time=datetime.datetime(2030, 1, 1), format=1,
+                                             status=True, looking_for=0, max_players=4,
+                                             creator=create_dummy_user(id=1))), session)
+    assert [r["title"] for r in await recommend_games(session, 777)] == ["Game_0", "Game_1", "Game_2"]
+    await edit_game(1, {"status": False}, session)
+    assert [r["title"] for r in await recommend_games(session, 777)] == ["Game_1", "Game_2"]
+
+    # Уведомление другого воркера тоже сбрасывает набор
+    from sqlalchemy import update
+    await session.execute(update(Session).where(Session.id == 2).values(status=False))
+    await session.commit()
+    from bot.db import invalidation
+    invalidation.dispatch("game:2")
+    assert [r["title"] for r in await recommend_games(session, 777)] == ["Game_2"]
+    assert not game_candidates_cache.stale
+
+
+@pytest.mark.asyncio
+async def test_game_candidates_cache_refreshes_in_background():
+    import asyncio
+    from bot.db.recommendations import GameCandidates, GameCandidatesCache
+
+    loads = []
+    release = asyncio.Event()
+
+    async def loader(session):
+        loads.append(session)
+        if len(loads) > 1:
+            await release.wait()
+        return GameCandidates.from_rows([])
+
+    class Maker:
+        def __call__(self):
+            return self
+
+        async def __aenter__(self):
+            return "background"
+
+        async def __aexit__(self, *exc):
+            return False
+
+    cache = GameCandidatesCache(loader)
+    cache.start(Maker())
+    first = await cache.get("handler")
+    assert loads == ["handler"]
+
+    # Устаревший набор отдаётся сразу, новый строится в фоне своей сессией
+    cache.invalidate()
+    assert await cache.get("handler") is first
+    await asyncio.sleep(0)
+    assert loads == ["handler", "background"]
+    # Запись во время перестроения: прочитанный набор не считается свежим
+    cache.invalidate()
+    release.set()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert cache.stale and await cache.get("handler") is not first
+    await cache.stop()
+
+
+#############################################
+# Подбор игроков под игру
+#############################################
+
+async def _add_player(session, user_id, *, systems="D&D 5e", game_format=0b01, time_zone=3, age=25, experience=0):
+    session.add(create_dummy_user(id=user_id, telegram_id=1000 + user_id, name=f"Player {user_id}",
+                                  preferred_systems=systems, game_format=game_format, time_zone=time_zone,
+                                  age=age, created_at=None))
+    await session.flush()
+    session.add(Player(id=user_id, experience_level=experience, availability="full"))
+    await session.flush()
+
+
+async def _match_keys(session, player_id):
+    from sqlalchemy import select
+    from bot.db.base import player_match_keys
+
+    result = await session.execute(
+        select(player_match_keys.c.system_key, player_match_keys.c.format, player_match_keys.c.time_zone)
+        .where(player_match_keys.c.player_id == player_id)
+        .order_by(player_match_keys.c.system_key, player_match_keys.c.format)
+    )
+    return [tuple(r) for r in result.all()]
+
+
+def test_player_match_rows():
+    from bot.db.player_features import player_match_rows
+
+    rows = player_match_rows(7, 0b11, "D&D 5e, GURPS, d&d 5e", 3, None, 20)
+    assert sorted((r["system_key"], r["format"]) for r in rows) == [
+        ("", 0), ("", 1), ("d&d 5e", 0), ("d&d 5e", 1), ("gurps", 0), ("gurps", 1)]
+    assert {r["experience_level"] for r in rows} == {0}
+    assert player_match_rows(7, 0, "GURPS", 3, 1, 20) == []
+
+
+@pytest.mark.asyncio
+async def test_player_match_keys_follow_profile_changes(sqlite_session):
+    session, _ = sqlite_session
+    # Игрок из фикстуры: онлайн, TestSystem, пояс 3
+    assert await _match_keys(session, 1) == [("", 0, 3), ("testsystem", 0, 3)]
+
+    await edit_user(12345, {"time_zone": 5, "preferred_systems": "GURPS"}, session)
+    assert await _match_keys(session, 1) == [("", 0, 5), ("gurps", 0, 5)]
+
+    await _add_player(session, 2, systems="", game_format=0b10)
+    assert await _match_keys(session, 2) == [("", 1, 3)]
+
+    player = await session.get(Player, 2)
+    await session.delete(player)
+    await session.flush()
+    assert await _match_keys(session, 2) == []
+
+
+@pytest.mark.asyncio
+async def test_rebuild_player_match_keys(sqlite_session):
+    from sqlalchemy import delete as sa_delete
+    from bot.db.base import player_match_keys
+    from bot.db.player_features import rebuild_player_match_keys
+
+    session, _ = sqlite_session
+    await _add_player(session, 2, systems="GURPS, D&D 5e", game_format=0b11)
+    await session.execute(sa_delete(player_match_keys))
+    await session.commit()
+
+    assert await rebuild_player_match_keys(session, batch_size=1) == 2 + 6
+    assert len(await _match_keys(session, 2)) == 6
+
+
+@pytest.mark.asyncio
+async def test_find_players_for_game(sqlite_session):
+    from sqlalchemy import insert
+    from bot.db.base import session_players
+    from bot.db.requests import find_players_for_game
+
+    session, statements = sqlite_session
+    game = Session(title="Strahd", game_system="D&D 5e", date_time=datetime.datetime(2030, 1, 1), format=0,
+                   looking_for=0, creator_id=1, max_age=40)
+    session.add(game)
+    await _add_player(session, 2, experience=0)                        # система, тот же пояс
+    await _add_player(session, 3, experience=2)                        # система, тот же пояс, опытнее
+    await _add_player(session, 4, time_zone=5, experience=2)           # система, пояс +2
+    await _add_player(session, 5, systems="GURPS", experience=2)       # без системы, тот же пояс
+    await _add_player(session, 6, time_zone=8)                         # слишком далеко
+    await _add_player(session, 7, game_format=0b10)                    # только оффлайн
+    await _add_player(session, 8, age=50)                              # старше max_age
+    await _add_player(session, 9)                                      # уже в игре
+    await session.flush()
+    await session.execute(insert(session_players).values(session_id=game.id, player_id=9))
+    await session.commit()
+    statements.clear()
+
+    found = await find_players_for_game(session, game.id)
+    assert [p["player_id"] for p in found] == [3, 2, 4, 5]
+    assert [p["system_match"] for p in found] == [True, True, True, False]
+    assert found[0]["experience_level"] == all_experience_levels[2]
+    assert found[2]["tz_distance"] == 2
+    assert len(statements) == 2
+
+    assert [p["player_id"] for p in await find_players_for_game(session, game.id, limit=2)] == [3, 2]
+    assert await find_players_for_game(session, 999) == []
+
+
+@pytest.mark.asyncio
+async def test_get_master_games_lists_created_games(sqlite_session):
+    from sqlalchemy import select
+    from bot.db.current_requests import get_master_games, get_master_archive
+    from bot.db.requests import register_games_bulk
+
+    session, _ = sqlite_session
+    manager = MagicMock()
+    manager.event.from_user.id = 12345
+    manager.middleware_data = {"db_session": session}
+
+    games = (await get_master_games(manager))["games"]
+    assert [(g["id"], g["title"]) for g in games] == [(1, "Game_0"), (2, "Game_1")]
+    assert (await get_master_archive(manager))["games"] == []
+
+    def new_game(title, looking_for, creator):
+        return SessionModel(Session(title=title, date_time=datetime.datetime(2030, 2, 1), format=1, status=True,
+                                    looking_for=looking_for, max_players=5, creator=creator))
+
+    created = await register_game(new_game("Новая", 0, create_dummy_user(id=1)), session)
+    # Игра, которая ищет мастера, и игра создателя без анкеты мастера — без мастера
+    await register_game(new_game("Ищем мастера", 1, create_dummy_user(id=1)), session)
+    session.add(create_dummy_user(id=2, telegram_id=777, created_at=None))
+    await session.commit()
+    await register_game(new_game("Без анкеты", 0, create_dummy_user(id=2, telegram_id=777)), session)
+    result = await register_games_bulk([
+        {"title": t, "date_time": "2030-03-01T19:00", "format": "Онлайн", "looking_for": role, "creator_id": c}
+        for t, role, c in [("Импорт", "Игрок", "1"), ("Импорт мастера", "Мастер", "1"),
+                           ("Импорт без анкеты", "Игрок", "2")]
+    ], session)
+    assert len(result.created) == 3
+
+    games = (await get_master_games(manager))["games"]
+    assert [g["title"] for g in games] == ["Game_0", "Game_1", "Новая", "Импорт"]
+    assert games[2]["id"] == created.id
+    masters = (await session.execute(select(Session.title, Session.master_id).order_by(Session.id))).all()
+    assert [t for t, m in masters if m is None] == ["Ищем мастера", "Без анкеты", "Импорт мастера", "Импорт без анкеты"]
+
+
+#############################################
+# Справочник игровых систем
+#############################################
+
+def test_split_system_names():
+    from bot.db.game_systems import split_system_names, system_key
+
+    assert split_system_names(" D&D  5e, GURPS,d&d 5e,, ") == {"d&d 5e": "D&D 5e", "gurps": "GURPS"}
+    assert split_system_names(None) == {}
+    assert system_key("  Call of   Cthulhu ") == "call of cthulhu"
+
+
+async def _system_links(session, table, column, owner_id):
+    from sqlalchemy import select
+    from bot.db.base import game_systems
+
+    result = await session.execute(
+        select(game_systems.c.name)
+        .join(table, table.c.system_id == game_systems.c.id)
+        .where(table.c[column] == owner_id)
+        .order_by(game_systems.c.key)
+    )
+    return list(result.scalars().all())
+
+
+@pytest.mark.asyncio
+async def test_game_system_links_follow_changes(sqlite_session):
+    from bot.db.base import user_game_systems, session_game_systems
+    from bot.db.requests import get_user_systems
+
+    session, _ = sqlite_session
+    assert await get_user_systems(session, 12345) == ["TestSystem"]
+
+    await edit_user(12345, {"preferred_systems": "GURPS, d&d 5e"}, session)
+    await _add_player(session, 2, systems="D&D 5e, Shadowrun")
+    # Название в справочнике — как его ввели впервые
+    assert await get_user_systems(session, 12345) == ["d&d 5e", "GURPS"]
+    assert await _system_links(session, user_game_systems, "user_id", 2) == ["d&d 5e", "Shadowrun"]
+
+    game = Session(title="Night", game_system="gurps", date_time=datetime.datetime(2030, 1, 1),
+                   format=0, looking_for=0, creator_id=1)
+    session.add(game)
+    await session.flush()
+    assert await _system_links(session, session_game_systems, "session_id", game.id) == ["GURPS"]
+
+    game.game_system = "Shadowrun"
+    await session.flush()
+    assert await _system_links(session, session_game_systems, "session_id", game.id) == ["Shadowrun"]
+
+    await session.delete(game)
+    await session.flush()
+    assert await _system_links(session, session_game_systems, "session_id", game.id) == []
+
+
+@pytest.mark.asyncio
+async def test_users_by_system_and_popular_systems(sqlite_session):
+    from bot.db.requests import get_users_by_system, get_top_systems
+
+    session, statements = sqlite_session
+    await _add_player(session, 2, systems="D&D 5e, GURPS")
+    await _add_player(session, 3, systems="d&d 5e")
+    session.add(Session(title="Night", game_system="GURPS", date_time=datetime.datetime(2030, 1, 1),
+                        format=0, looking_for=0, creator_id=1))
+    await session.commit()
+    statements.clear()
+
+    users = await get_users_by_system(session, "  D&D 5E ")
+    assert [u["telegram_id"] for u in users] == [1002, 1003]
+    assert await get_users_by_system(session, "GURPS", limit=1) == [
+        {"id": 2, "telegram_id": 1002, "name": "Player 2"}]
+    assert await get_users_by_system(session, "Unknown") == []
+
+    top = await get_top_systems(session)
+    assert [(r["name"], r["uses"]) for r in top] == [("D&D 5e", 2), ("GURPS", 2), ("TestSystem", 1)]
+    assert [r["name"] for r in await get_top_systems(session, limit=1)] == ["D&D 5e"]
+    assert len(statements) == 5
+
+
+@pytest.mark.asyncio
+async def test_backfill_game_systems(sqlite_session):
+    from sqlalchemy import delete as sa_delete, func as sa_func, select
+    from bot.db.base import game_systems, user_game_systems
+    from bot.db.game_systems import backfill_game_systems
+    from bot.db.requests import get_user_systems
+
+    session, _ = sqlite_session
+    await _add_player(session, 2, systems="GURPS, D&D 5e")
+    await session.execute(sa_delete(user_game_systems))
+    await session.execute(sa_delete(game_systems))
+    await session.commit()
+    assert await get_user_systems(session, 1002) == []
+
+    assert await backfill_game_systems(session, batch_size=1) == {"users": 2, "sessions": 2}
+    assert await get_user_systems(session, 1002) == ["D&D 5e", "GURPS"]
+    # Повторный запуск ничего не дублирует
+    await backfill_game_systems(session)
+    assert await session.scalar(select(sa_func.count()).select_from(game_systems)) == 3
+
+
+#############################################
+# Популярные системы для форм
+#############################################
+
+@pytest_asyncio.fixture
+async def popular_cache(sqlite_session):
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    from bot.db.popular_systems import PopularSystemsCache
+
+    session, statements = sqlite_session
+    await _add_player(session, 2, systems="D&D 5e, GURPS")
+    await _add_player(session, 3, systems="d&d 5e")
+    await session.commit()
+    now = [0.0]
+    cache = PopularSystemsCache(async_sessionmaker(session.bind, expire_on_commit=False),
+                                limit=2, ttl=60, clock=lambda: now[0])
+    statements.clear()
+    yield cache, statements, now
+    await cache.stop()
+
+
+@pytest.mark.asyncio
+async def test_popular_systems_cache_serves_from_memory(popular_cache):
+    cache, statements, now = popular_cache
+    assert await cache.refresh() == [{"id": 2, "name": "D&D 5e"}, {"id": 3, "name": "GURPS"}]
+    statements.clear()
+
+    now[0] = 59
+    for _ in range(10):
+        assert [s["name"] for s in cache.items()] == ["D&D 5e", "GURPS"]
+    await asyncio.sleep(0)
+    assert statements == []
+
+
+@pytest.mark.asyncio
+async def test_popular_systems_cache_refreshes_stale_in_background(popular_cache):
+    cache, statements, now = popular_cache
+    # Пока данных нет — пустой список сразу, загрузка уходит в фон
+    assert cache.items() == []
+    assert statements == []
+    await cache._refreshing
+    assert [s["name"] for s in cache.items()] == ["D&D 5e", "GURPS"]
+
+    # Устаревшие данные отдаются как есть, обновление запускается один раз
+    now[0] = 61
+    first = cache.items()
+    cache.items()
+    assert [s["name"] for s in first] == ["D&D 5e", "GURPS"]
+    await cache._refreshing
+    assert not cache.stale
+    assert len(statements) == 2
+
+
+@pytest.mark.asyncio
+async def test_popular_systems_cache_background_loop(popular_cache):
+    cache, statements, now = popular_cache
+    cache.start()
+    for _ in range(50):
+        if not cache.stale:
+            break
+        await asyncio.sleep(0.01)
+    assert [s["name"] for s in cache.items()] == ["D&D 5e", "GURPS"]
+    await cache.stop()
+    assert cache._loop_task is None
+
+
+@pytest.mark.asyncio
+async def test_popular_systems_cache_keeps_old_list_on_error(popular_cache):
+    cache, statements, now = popular_cache
+    await cache.refresh()
+    cache.session_maker = lambda: (_ for _ in ()).throw(RuntimeError("db is down"))
+    now[0] = 100
+    cache.items()
+    assert await cache._refreshing is False
+    assert [s["name"] for s in cache.items()] == ["D&D 5e", "GURPS"]
+
+
+@pytest.mark.asyncio
+async def test_forms_read_popular_systems_from_cache(monkeypatch):
+    from bot.db import current_requests
+    from bot.db.popular_systems import PopularSystemsCache
+    from bot.dialogs.games import game_creation
+
+    cache = PopularSystemsCache()
+    cache._items = [{"id": 5, "name": "GURPS"}]
+    cache._loaded_at = cache._clock()
+    monkeypatch.setattr(current_requests, "popular_systems_cache", cache)
+
+    assert current_requests.get_popular_systems(MagicMock()) == [{"id": 5, "name": "GURPS"}]
+    assert await game_creation._get_popular_systems(MagicMock()) == [{"id": 5, "name": "GURPS"}]
+
+
+#############################################
+# Кэш профилей пользователей
+#############################################
+
+def test_ttl_cache_lru_and_expiry():
+    from bot.db.cache import TTLCache
+
+    now = [0.0]
+    cache = TTLCache("test", maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # "b" читали давнее всех — вытесняется
+    cache.set("c", 3)
+    assert "b" not in cache and cache.get("b") is None
+    assert cache.get("c") == 3
+
+    now[0] = 10
+    assert cache.get("a") is None
+    assert len(cache) == 1
+    cache.pop("c")
+    assert len(cache) == 0
+    assert cache.stats() == {"size": 0, "hits": 2, "misses": 2, "hit_ratio": 0.5}
+
+    with pytest.raises(ValueError):
+        TTLCache("test", maxsize=0, ttl=1)
+
+
+def test_ttl_cache_metrics():
+    from bot.base.metrics import CACHE_HITS, CACHE_MISSES, observe_caches
+    from bot.db.cache import TTLCache
+
+    observe_caches()
+    hits, misses = CACHE_HITS.labels("metrics_test"), CACHE_MISSES.labels("metrics_test")
+    before = hits._value.get(), misses._value.get()
+    cache = TTLCache("metrics_test", maxsize=4, ttl=10)
+    cache.get(1)
+    cache.set(1, "x")
+    cache.get(1)
+    cache.get(1)
+    assert (hits._value.get() - before[0], misses._value.get() - before[1]) == (2, 1)
+
+
+def test_ttl_cache_skips_write_back_after_invalidation():
+    from bot.db.cache import TTLCache
+
+    cache = TTLCache("test", maxsize=2, ttl=10)
+    token = cache.token()
+    cache.pop("a")
+    cache.set("a", "stale", token=token)
+    assert "a" not in cache
+    # Инвалидация другого ключа не мешает
+    cache.set("b", "fresh", token=token)
+    assert cache.get("b") == "fresh"
+    # Токен, взятый после инвалидации, снова кэширует
+    cache.set("a", "fresh", token=cache.token())
+    assert cache.get("a") == "fresh"
+
+    # Забытые сверх maxsize инвалидации и clear() отбрасывают все более старые токены
+    token = cache.token()
+    for key in ("c", "d", "e"):
+        cache.pop(key)
+    cache.set("f", "stale", token=token)
+    assert "f" not in cache
+    token = cache.token()
+    cache.clear()
+    cache.set("a", "stale", token=token)
+    assert "a" not in cache
+
+
+@pytest.mark.asyncio
+async def test_get_user_model_does_not_cache_row_invalidated_during_read(sqlite_session, monkeypatch):
+    import bot.db.requests as requests_module
+
+    session, _ = sqlite_session
+    get_entity = requests_module._get_entity
+
+    async def racing_get_entity(*args, **kwargs):
+        row = await get_entity(*args, **kwargs)
+        # NOTIFY от другого воркера пришёл, пока строка ехала из БД
+        invalidate_user(12345)
+        return row
+
+    monkeypatch.setattr(requests_module, "_get_entity", racing_get_entity)
+    assert await get_user_model(session, 12345) is not None
+    assert (12345, "profile") not in requests_module.user_cache
+
+    monkeypatch.setattr(requests_module, "_get_entity", get_entity)
+    model = await get_user_model(session, 12345)
+    assert await get_user_model(session, 12345) is model
+
+
+@pytest.mark.asyncio
+async def test_get_user_model_reads_through_cache(sqlite_session):
+    session, statements = sqlite_session
+    first = await get_user_model(session, 12345)
+    for _ in range(5):
+        assert await get_user_model(session, 12345) is first
+    assert len(statements) == 1
+
+    # Профиль с играми и отсутствующие пользователи не кэшируются
+    await get_user_model(session, 12345, profile="profile+games")
+    await get_user_model(session, 12345, profile="profile+games")
+    assert await get_user_model(session, 999) is None
+    assert await get_user_model(session, 999) is None
+    assert len(statements) == 1 + 2 * 3 + 2
+
+
+@pytest.mark.asyncio
+async def test_user_cache_invalidated_by_writes(sqlite_session):
+    session, statements = sqlite_session
+    assert (await get_user_model(session, 12345)).city == "TestCity"
+
+    await edit_user(12345, {"city": "Kazan"}, session)
+    assert (await get_user_model(session, 12345)).city == "Kazan"
+
+    await edit_player(12345, {"availability": "weekends"}, session)
+    assert (await get_user_model(session, 12345)).player_profile.availability == "weekends"
+
+    await edit_master(12345, {"master_style": "Strict"}, session)
+    assert (await get_user_model(session, 12345)).master_profile.master_style == "Strict"
+
+    statements.clear()
+    await get_user_model(session, 12345)
+    assert statements == []
+
+
+@pytest.mark.asyncio
+async def test_user_cache_invalidated_by_registration(sqlite_session):
+    session, _ = sqlite_session
+    user = await register_user(UserModel(create_dummy_user(id=None, telegram_id=555, created_at=None)), session)
+    assert (await get_user_model(session, 555)).player_profile is None
+
+    player = PlayerModel(Player(experience_level=1, availability="full",
+                                user=create_dummy_user(id=None, telegram_id=555)))
+    await register_player(player, session)
+    assert (await get_user_model(session, 555)).player_profile.experience_level == "Опыт2"
+    assert user.telegram_id == 555
+
+
+#############################################
+# Сброс кэшей между воркерами (LISTEN/NOTIFY)
+#############################################
+
+def test_invalidation_dispatch_evicts_user_cache(caplog):
+    from bot.db import invalidation
+
+    user_cache.set((12345, "profile"), "cached")
+    user_cache.set((12345, "bare"), "cached")
+    user_cache.set((777, "profile"), "cached")
+    invalidation.dispatch("user:12345")
+    invalidation.dispatch("unknown:1")
+    assert len(user_cache) == 1 and (777, "profile") in user_cache
+
+    invalidation.dispatch("user:not-a-number")
+    assert "handler failed" in caplog.text
+
+    invalidation.reset_all()
+    assert len(user_cache) == 0
+
+
+def test_asyncpg_dsn():
+    from bot.db.invalidation import asyncpg_dsn
+
+    assert asyncpg_dsn("postgresql+asyncpg://u:p@h/db") == "postgresql://u:p@h/db"
+    assert asyncpg_dsn("postgresql://u:p@h/db") == "postgresql://u:p@h/db"
+
+
+@pytest.mark.asyncio
+async def test_writes_publish_invalidations(sqlite_session, monkeypatch):
+    from bot.db import invalidation
+
+    session, _ = sqlite_session
+    sent = []
+    monkeypatch.setattr(invalidation, "notifies", lambda connection: True)
+    monkeypatch.setattr(invalidation, "publish", lambda connection, entity, key: sent.append((entity, key)))
+
+    await edit_user(12345, {"city": "Kazan"}, session)
+    await edit_player(12345, {"availability": "weekends"}, session)
+    await edit_master(12345, {"master_style": "Strict"}, session)
+    await edit_game(1, {"title": "Renamed"}, session)
+    assert sent == [("user", 12345), ("user", 12345), ("user", 12345), ("game", 1)]
+
+
+def test_publish_is_noop_without_postgres():
+    from bot.db import invalidation
+
+    connection = MagicMock()
+    connection.dialect.name = "sqlite"
+    invalidation.publish(connection, "user", 1)
+    connection.execute.assert_not_called()
+
+    connection.dialect.name = "postgresql"
+    invalidation.publish(connection, "user", 1)
+    statement = connection.execute.call_args.args[0]
+    assert "pg_notify" in str(statement)
+
+
+@pytest.mark.asyncio
+async def test_invalidation_listener_receives_and_reconnects(monkeypatch):
+    from bot.db import invalidation
+
+    connects = []
+
+    class FakeConnection:
+        def __init__(self):
+            self.on_close = None
+            self.closed = False
+
+        def add_termination_listener(self, callback):
+            self.on_close = callback
+
+        async def add_listener(self, channel, callback):
+            connects.append(channel)
+            user_cache.set((12345, "profile"), "cached")
+            # Уведомление от другого воркера, затем обрыв соединения
+            callback(self, 1, channel, "user:12345")
+            self.closed = True
+            self.on_close(self)
+
+        def is_closed(self):
+            return self.closed
+
+    async def fake_connect(dsn):
+        assert dsn == "postgresql://u@h/db"
+        return FakeConnection()
+
+    monkeypatch.setattr(invalidation.asyncpg, "connect", fake_connect)
+    listener = invalidation.InvalidationListener("postgresql+asyncpg://u@h/db", reconnect_delay=0)
+    listener.start()
+    for _ in range(100):
+        if len(connects) >= 2:
+            break
+        await asyncio.sleep(0)
+    await listener.stop()
+    assert connects[:2] == [invalidation.CHANNEL] * 2
+    assert (12345, "profile") not in user_cache
+
+
+#############################################
+# Снимки моделей
+#############################################
+
+def _orm_objects_in(snapshot, seen=None):
+    """Все ORM-объекты, достижимые из снимка по его полям."""
+    from bot.db.base import Base
+    from bot.db.models import Snapshot
+
+    seen = set() if seen is None else seen
+    if id(snapshot) in seen:
+        return []
+    seen.add(id(snapshot))
+    found = []
+    for name in snapshot._fields + snapshot._relations:
+        value = getattr(snapshot, name)
+        for v in (value if isinstance(value, list) else [value]):
+            if isinstance(v, Base):
+                found.append(v)
+            elif isinstance(v, Snapshot):
+                found.extend(_orm_objects_in(v, seen))
+    return found
+
+
+def test_snapshot_models_are_frozen():
+    import pickle
+
+    um = UserModel(create_dummy_user())
+    assert not hasattr(um, "__dict__")
+    with pytest.raises(AttributeError):
+        um.name = "Other"
+    with pytest.raises(AttributeError):
+        del um.name
+    copy = pickle.loads(pickle.dumps(um))
+    assert (copy.name, copy.role, copy.sessions) == ("TestUser", "Игрок", [])
+    assert repr(um) == "<UserModel id=1>"
+
+
+def test_snapshot_subclass_requires_fill():
+    from bot.db.models import Snapshot
+
+    class Incomplete(Snapshot):
+        __slots__ = ("id",)
+
+    with pytest.raises(TypeError, match="_fill"):
+        Incomplete(create_dummy_user())
+
+
+@pytest.mark.asyncio
+async def test_snapshot_models_hold_no_orm_objects(sqlite_session):
+    session, statements = sqlite_session
+    user = await get_user_model(session, 12345, profile="profile+games")
+    await session.close()
+    statements.clear()
+
+    assert _orm_objects_in(user) == []
+    # Обратные связи указывают на тот же снимок, а не на новые обёртки
+    assert user.player_profile.user is user
+    assert user.master_profile.user is user
+    assert [g.creator for g in user.sessions] == [user, user]
+    assert user.player_profile is user.player_profile
+    assert [g.title for g in user.sessions] == ["Game_0", "Game_1"]
+    assert statements == []
+
+
+def test_snapshot_rejects_non_orm_relations():
+    from bot.db.models import _snapshot
+
+    assert _snapshot(PlayerModel, None, {}) is None
+    with pytest.raises(TypeError, match="PlayerModel expects an ORM object, got MagicMock"):
+        _snapshot(PlayerModel, MagicMock(), {})
+
+
+@pytest.mark.asyncio
+async def test_snapshot_backrefs_set_during_construction(sqlite_session, monkeypatch):
+    from sqlalchemy import select
+    from sqlalchemy.orm import joinedload, selectinload
+    from bot.db.models import Snapshot
+
+    session, _ = sqlite_session
+    # Игры пользователя приходят и через master_profile.sessions, где creator не загружен
+    user = (await session.execute(select(User).where(User.telegram_id == 12345).options(
+        joinedload(User.master_profile).selectinload(Master.sessions),
+        selectinload(User.sessions),
+    ))).unique().scalar_one()
+
+    built = set()
+    init, set_field = Snapshot.__init__, Snapshot._set
+
+    def tracking_init(self, obj, _memo=None):
+        init(self, obj, _memo)
+        built.add(id(self))
+
+    def checked_set(self, name, value):
+        assert id(self) not in built, f"{type(self).__name__}.{name} set after construction"
+        set_field(self, name, value)
+
+    monkeypatch.setattr(Snapshot, "__init__", tracking_init)
+    monkeypatch.setattr(Snapshot, "_set", checked_set)
+    um = UserModel(user)
+
+    assert um.master_profile.user is um
+    assert [g.creator for g in um.sessions] == [um, um]
+    assert um.master_profile.sessions == um.sessions
+
+
+@pytest.mark.asyncio
+async def test_snapshot_to_dict(sqlite_session):
+    session, _ = sqlite_session
+    user = await get_user_model(session, 12345, profile="profile+games")
+    data = user.to_dict()
+
+    assert data["name"] == "TestUser" and data["role"] == "Игрок"
+    assert data["player_profile"] == {"id": 1, "experience_level": "Опыт1", "availability": "full", "sessions": []}
+    # Ссылка обратно на пользователя пропускается, поэтому у игр нет creator
+    assert [g["title"] for g in data["sessions"]] == ["Game_0", "Game_1"]
+    assert "creator" not in data["sessions"][0]
+    assert data["sessions"][0]["players"] == []
+
+    from bot.base.storage import pack_data, unpack_data
+    assert unpack_data(pack_data({"user": data}))["user"] == data
+
+    game = await get_game_model(session, 1)
+    assert game.to_dict()["creator"]["name"] == "TestUser"
+
+
+#############################################
+# Таблицы масок и вложенные модели без пересоздания
+#############################################
+
+def test_mask_lookup_tables_match_bitwise_decoding():
+    from bot.db.models import ROLE_NAMES, FORMAT_NAMES
+
+    def decode(mask, options):
+        return concat([o for i, o in enumerate(options) if mask & 2 ** i])
+
+    assert ROLE_NAMES == ("", "Игрок", "Мастер", "Игрок, Мастер")
+    for mask in list(range(-4, 40)) + [2 ** 10, 2 ** 40 + 1, True]:
+        assert get_role(create_dummy_user(role=mask)) == decode(mask, all_roles)
+        assert get_game_format(create_dummy_user(game_format=mask)) == decode(mask, all_formats)
+    assert len(FORMAT_NAMES) == 2 ** len(all_formats)
+    with pytest.raises(TypeError):
+        get_role(create_dummy_user(role="1"))
+
+
+def test_nested_models_are_built_once():
+    creator = create_dummy_user()
+    players = [Player(id=i, experience_level=0, availability="full",
+                      user=create_dummy_user(id=i, telegram_id=100 + i)) for i in (2, 3)]
+    game = SessionModel(Session(id=7, title="Game", format=0, looking_for=0, creator=creator, players=players))
+
+    assert game.players is game.players
+    assert game.players[0].user is game.players[0].user
+    assert [p.user.telegram_id for p in game.players] == [102, 103]
+    assert game.creator is game.creator and game.creator.role == "Игрок"
+
+
+#############################################
+# Массовая регистрация
+#############################################
+
+def _bulk_user(tg_id, **kwargs):
+    row = {"telegram_id": str(tg_id), "name": f"User {tg_id}", "age": "25", "city": "Москва",
+           "time_zone": "3", "role": "Игрок", "game_format": "Онлайн", "preferred_systems": "GURPS"}
+    row.update(kwargs)
+    return row
+
+
+def test_bulk_row_parsing():
+    from bot.db.bulk import user_row, player_row, master_row, game_row
+
+    user = user_row(_bulk_user(7, role="Игрок, Мастер", game_format="3", about_info=""))
+    assert (user["telegram_id"], user["role"], user["game_format"], user["about_info"]) == (7, 3, 3, None)
+    assert player_row(_bulk_user(7)) is None
+    assert player_row(_bulk_user(7, experience_level="Опыт3")) == {"experience_level": 2, "availability": None}
+    assert master_row({"rating": 5}) == {"master_style": None, "rating": 5}
+
+    game = game_row({"title": "G", "date_time": "2030-01-01T19:00", "format": "Оффлайн", "looking_for": 0,
+                     "status": "нет", "is_paid": "yes", "creator_telegram_id": "12345"})
+    assert (game["format"], game["status"], game["is_paid"], game["creator_telegram_id"]) == (1, False, True, 12345)
+    assert "id" not in game
+
+    for bad, message in [({"age": "old"}, "age must be an integer"), ({"role": "Гость"}, "unknown value"),
+                         ({"game_format": "4"}, "out of range"), ({"name": " "}, "name is required")]:
+        with pytest.raises(ValueError, match=message):
+            user_row(_bulk_user(7, **bad))
+    with pytest.raises(ValueError, match="ISO date-time"):
+        game_row({"title": "G", "date_time": "tomorrow", "format": 0, "looking_for": 0, "creator_id": 1})
+
+
+def test_bulk_read_rows(tmp_path):
+    from bot.db.bulk import read_rows
+
+    csv_path = tmp_path / "users.csv"
+    csv_path.write_text("telegram_id,name\n1,Аня\n2,Боря\n", encoding="utf-8")
+    assert [r["name"] for r in read_rows(str(csv_path))] == ["Аня", "Боря"]
+
+    jsonl_path = tmp_path / "users.jsonl"
+    jsonl_path.write_text('{"telegram_id": 1}\n\n{"telegram_id": 2}\n', encoding="utf-8")
+    assert [r["telegram_id"] for r in read_rows(str(jsonl_path))] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_register_users_bulk(sqlite_session):
+    from bot.db.requests import register_users_bulk, get_users_by_system
+
+    session, statements = sqlite_session
+    rows = [
+        _bulk_user(501, experience_level="Опыт2", availability="weekends"),
+        _bulk_user(12345),                       # уже зарегистрирован
+        _bulk_user(502, role="Мастер", master_style="Classic", rating="4"),
+        _bulk_user(501),                         # повтор в файле
+        _bulk_user(503, age=""),                 # некорректная строка
+        _bulk_user(504, preferred_systems="D&D 5e, gurps"),
+    ]
+    result = await register_users_bulk(rows, session, batch_size=2)
+    assert sorted(result.created) == [0, 2, 5]
+    assert set(result.conflicts) == {1, 3, 4}
+    assert "already registered" in result.conflicts[1]
+    assert "duplicate" in result.conflicts[3]
+    assert result.conflicts[4] == "age is required"
+    assert result.ids == sorted(result.ids)
+
+    user = await get_user_model(session, 501)
+    assert user.player_profile.experience_level == "Опыт2" and user.master_profile is None
+    assert (await get_user_model(session, 502)).master_profile.rating == 4
+    assert await _match_keys(session, user.id) == [("", 0, 3), ("gurps", 0, 3)]
+    assert [u["telegram_id"] for u in await get_users_by_system(session, "GURPS")] == [501, 502, 504]
+
+
+@pytest.mark.asyncio
+async def test_register_users_bulk_round_trips(sqlite_session):
+    from bot.db.requests import register_users_bulk
+
+    session, statements = sqlite_session
+    statements.clear()
+    result = await register_users_bulk([_bulk_user(600 + i) for i in range(50)], session)
+    assert len(result.created) == 50
+    # Один INSERT на пачку, а не add/commit/refresh на строку
+    inserts = [s for s in statements if s.lstrip().upper().startswith("INSERT INTO USERS")]
+    assert len(inserts) == 1
+    assert len(statements) < 10
+
+
+@pytest.mark.asyncio
+async def test_bulk_import_cli_reports_conflicts_on_stderr(tmp_path, capsys):
+    import json
+    pytest.importorskip("aiosqlite")
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from bot.db.base import Base
+    from bot.db.bulk_import import main
+
+    dsn = f"sqlite+aiosqlite:///{tmp_path / 'import.db'}"
+    engine = create_async_engine(dsn)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    await engine.dispose()
+    path = tmp_path / "users.jsonl"
+    path.write_text("\n".join(json.dumps(row) for row in [_bulk_user(601), _bulk_user(601)]), encoding="utf-8")
+
+    # Отклонённые строки — не ошибка импорта: код 0, строки в stderr
+    assert await main("users", str(path), None, dsn, 10) == 0
+    out, err = capsys.readouterr()
+    assert "users: 1 created, 1 rejected" in out and "row 2" not in out
+    assert "row 2:" in err
+    # --strict: повторный запуск отклоняет обе строки — код 1
+    assert await main("users", str(path), None, dsn, 10, strict=True) == 1
+    assert "users: 0 created, 2 rejected" in capsys.readouterr().out
+
+
+@pytest.mark.asyncio
+async def test_register_games_bulk(sqlite_session):
+    from bot.db.requests import register_games_bulk, get_top_systems
+
+    session, _ = sqlite_session
+    game = {"date_time": "2030-01-01T19:00", "format": "Онлайн", "looking_for": "Игрок"}
+    rows = [
+        {**game, "title": "A", "game_system": "GURPS", "creator_telegram_id": "12345"},
+        {**game, "title": "B", "id": "100", "creator_id": "1"},
+        {**game, "title": "C", "creator_telegram_id": "999"},
+        {**game, "title": "D", "creator_id": "1", "max_players": "4"},
+        {**game, "title": "E", "id": "1", "creator_id": "1"},   # id уже занят Game_0
+        {**game, "title": "F", "creator_id": "999"},
+        {**game, "title": "G", "id": "100", "creator_id": "1"},  # тот же id, что у B
+    ]
+    result = await register_games_bulk(rows, session, batch_size=2)
+    assert result.created[1] == 100
+    assert sorted(result.created) == [0, 1, 3]
+    assert sorted(result.conflicts) == [2, 4, 5, 6]
+    assert "not registered" in result.conflicts[2] and "already exists" in result.conflicts[4]
+    assert result.conflicts[5] == "creator id 999 is not registered"
+    assert result.conflicts[6] == "duplicate game id 100 in input"
+
+    for i, title in [(0, "A"), (1, "B"), (3, "D")]:
+        assert (await get_game_model(session, result.created[i])).title == title
+    assert (await get_game_model(session, result.created[3])).max_players == 4
+    assert [s["name"] for s in await get_top_systems(session)] == ["GURPS", "TestSystem"]
+
+    again = await register_games_bulk([rows[1]], session)
+    assert again.created == {} and "already exists" in again.conflicts[0]
+
+
+#############################################
+# Атомарная регистрация (INSERT ... ON CONFLICT)
+#############################################
+
+def _new_user_model(tg_id, **kwargs):
+    return UserModel(create_dummy_user(id=None, telegram_id=tg_id, preferred_systems="GURPS, D&D 5e", **kwargs))
+
+
+@pytest.mark.asyncio
+async def test_register_user_single_insert(sqlite_session):
+    from bot.db.requests import get_user_systems
+
+    session, statements = sqlite_session
+    statements.clear()
+    registered = await register_user(_new_user_model(777), session)
+    # Без SELECT перед вставкой и без refresh после commit
+    assert statements[0].lstrip().upper().startswith("INSERT INTO USERS")
+    assert "ON CONFLICT" in statements[0].upper()
+    assert not any(s.lstrip().upper().startswith("SELECT USERS") for s in statements)
+    assert registered.id is not None and registered.player_profile is None
+    assert await get_user_systems(session, 777) == ["D&D 5e", "GURPS"]
+
+    with pytest.raises(ValueError, match="User already exists"):
+        await register_user(_new_user_model(777), session)
+    # Сессия после конфликта остаётся рабочей
+    assert (await get_user_model(session, 777)).id == registered.id
+
+
+@pytest.mark.asyncio
+async def test_register_profiles_upsert(sqlite_session):
+    session, _ = sqlite_session
+    user = await register_user(_new_user_model(778, game_format=0b11), session)
+    player = create_dummy_player(create_dummy_user(id=user.id, telegram_id=778), experience_index=1)
+
+    registered = await register_player(PlayerModel(player), session)
+    assert registered.experience_level == all_experience_levels[1]
+    # Строки player_match_keys заполнены без событий маппера
+    assert await _match_keys(session, user.id) == [
+        (k, f, 3) for k in ("", "d&d 5e", "gurps") for f in (0, 1)]
+    with pytest.raises(ValueError, match="Player already exists"):
+        await register_player(PlayerModel(player), session)
+
+    master = create_dummy_master(create_dummy_user(id=user.id, telegram_id=778), master_style="Sandbox")
+    assert (await register_master(MasterModel(master), session)).master_style == "Sandbox"
+    with pytest.raises(ValueError, match="Master already exists"):
+        await register_master(MasterModel(master), session)
+    profile = await get_user_model(session, 778)
+    assert profile.player_profile.experience_level == all_experience_levels[1]
+    assert profile.master_profile.master_style == "Sandbox"
+
+    stranger = create_dummy_player(create_dummy_user(id=None, telegram_id=779))
+    with pytest.raises(ValueError, match="User not found"):
+        await register_player(PlayerModel(stranger), session)
+
+
+@pytest.mark.asyncio
+async def test_register_without_on_conflict_uses_savepoints(sqlite_session, monkeypatch):
+    """На диалекте без INSERT ... ON CONFLICT конфликтующие строки пропускаются по одной."""
+    from bot.db import requests
+    from bot.db.requests import register_users_bulk, register_games_bulk, apply_to_game
+
+    monkeypatch.setattr(requests, "_ON_CONFLICT_INSERTS", {})
+    session, statements = sqlite_session
+    statements.clear()
+    user = await register_user(_new_user_model(777), session)
+    inserts = [s.upper() for s in statements if s.lstrip().upper().startswith("INSERT INTO USERS")]
+    assert inserts and not any("ON CONFLICT" in s for s in inserts)
+    assert any(s.startswith("SAVEPOINT") for s in statements)
+    with pytest.raises(ValueError, match="User already exists"):
+        await register_user(_new_user_model(777), session)
+
+    player = create_dummy_player(create_dummy_user(id=user.id, telegram_id=777))
+    await register_player(PlayerModel(player), session)
+    with pytest.raises(ValueError, match="Player already exists"):
+        await register_player(PlayerModel(player), session)
+
+    result = await register_users_bulk([_bulk_user(777), _bulk_user(780), _bulk_user(12345)], session)
+    assert sorted(result.created) == [1] and sorted(result.conflicts) == [0, 2]
+
+    game = {"date_time": "2030-01-01T19:00", "format": "Онлайн", "looking_for": "Игрок", "creator_id": "1"}
+    result = await register_games_bulk([{**game, "title": "A", "id": "1"}, {**game, "title": "B", "id": "50"}],
+                                       session)
+    assert list(result.created) == [1] and "already exists" in result.conflicts[0]
+
+    assert await apply_to_game(session, 777, 1) is True
+    assert await apply_to_game(session, 777, 1) is False
+
+
+#############################################
+# Правки одним UPDATE ... RETURNING
+#############################################
+
+@pytest.mark.asyncio
+async def test_edit_profile_single_statement(sqlite_session):
+    session, statements = sqlite_session
+    await get_user_model(session, 12345)      # прогрев кэша не должен влиять на правку
+    statements.clear()
+
+    updated = await edit_user(12345, {"about_info": "Новое о себе"}, session)
+    assert updated.about_info == "Новое о себе"
+    assert len(statements) == 1
+    assert statements[0].lstrip().upper().startswith("UPDATE USERS")
+    assert "RETURNING" in statements[0].upper()
+
+    for edit, changes in [(edit_player, {"availability": "weekends"}), (edit_master, {"rating": 9})]:
+        statements.clear()
+        assert await edit(12345, changes, session) is not None
+        # Игрок: UPDATE + пересчёт player_match_keys (DELETE, SELECT, INSERT)
+        assert statements[0].lstrip().upper().startswith("UPDATE")
+        assert len(statements) == (4 if edit is edit_player else 1)
+
+    profile = await get_user_model(session, 12345)
+    assert (profile.about_info, profile.player_profile.availability, profile.master_profile.rating) == \
+        ("Новое о себе", "weekends", 9)
+    assert await edit_player(99999, {"availability": "x"}, session) is None
+
+
+@pytest.mark.asyncio
+async def test_edit_keeps_derived_tables_in_sync(sqlite_session):
+    from bot.db.requests import get_user_systems, get_top_systems
+
+    session, _ = sqlite_session
+    await edit_user(12345, {"preferred_systems": "GURPS", "time_zone": 5}, session)
+    assert await get_user_systems(session, 12345) == ["GURPS"]
+    assert await _match_keys(session, 1) == [("", 0, 5), ("gurps", 0, 5)]
+
+    game = await edit_game(1, {"game_system": "Fate", "title": "Новая"}, session)
+    assert (game.title, game.game_system) == ("Новая", "Fate")
+    assert {s["name"] for s in await get_top_systems(session)} == {"GURPS", "Fate"}
+    assert await edit_game(999, {"title": "x"}, session) is None
+
+
+#############################################
+# Счётчик SQL-запросов на апдейт
+#############################################
+
+@pytest.mark.asyncio
+async def test_query_stats_counts_statements_per_update(sqlite_session, caplog):
+    from sqlalchemy import select
+    from bot.base.metrics import DB_UPDATE_REPEATED_STATEMENTS, DB_UPDATE_OVER_BUDGET
+    from bot.base.query_stats import QueryStatsMiddleware, instrument_queries, current_stats
+
+    session, _ = sqlite_session
+    instrument_queries(session.bind)
+    instrument_queries(session.bind)          # повторная подписка не удваивает счёт
+    middleware = QueryStatsMiddleware(max_statements=5, max_repeats=3)
+    seen = {}
+
+    async def handler(event, data):
+        current_stats().state = "Test:n_plus_one"
+        for game_id in (1, 2, 1, 2):          # запрос в цикле — типичный N+1
+            await session.execute(select(Session.title).where(Session.id == game_id))
+        await session.execute(select(User.name))
+        seen["stats"] = current_stats()
+
+    repeated = DB_UPDATE_REPEATED_STATEMENTS.labels("Test:n_plus_one")
+    over = DB_UPDATE_OVER_BUDGET.labels("Test:n_plus_one")
+    before = repeated._value.get(), over._value.get()
+    with caplog.at_level("WARNING", logger="bot.base.query_stats"):
+        await middleware(handler, None, {})
+
+    stats = seen["stats"]
+    assert (stats.statements, stats.repeated, stats.most_repeated()[1]) == (5, 3, 4)
+    assert stats.seconds > 0
+    assert (repeated._value.get() - before[0], over._value.get() - before[1]) == (3, 1)
+    assert "Test:n_plus_one ran 5 SQL statements" in caplog.text and "x4" in caplog.text
+    # Вне апдейта запросы не считаются
+    assert current_stats() is None
+    await session.execute(select(User.id))
+    assert stats.statements == 5
+
+
+@pytest.mark.asyncio
+async def test_query_stats_failed_statement_leaves_no_timing_behind(sqlite_session):
+    from sqlalchemy import select, text
+    from sqlalchemy.exc import OperationalError
+    from bot.base.query_stats import QueryStatsMiddleware, instrument_queries, current_stats
+
+    session, _ = sqlite_session
+    instrument_queries(session.bind)
+    seen = {}
+
+    async def handler(event, data):
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                await session.execute(text("SELECT * FROM no_such_table"))
+            await session.rollback()
+        await session.execute(select(User.id))
+        seen["stats"] = current_stats()
+        seen["info"] = dict((await session.connection()).info)
+
+    await QueryStatsMiddleware()(handler, None, {})
+    # Упавшие запросы не считаются и не оставляют времени старта на соединении
+    assert seen["stats"].statements == 1
+    assert not any("started" in key for key in seen["info"])
+
+
+@pytest.mark.asyncio
+async def test_query_stats_within_budget_and_dialog_state(caplog):
+    from bot.base.query_stats import QueryStatsMiddleware, current_stats, NO_STATE
+    from bot.base.update_metrics import dialog_state_middleware
+    from bot.states.registration_states import Registration
+
+    middleware = QueryStatsMiddleware()
+    states = []
+
+    async def handler(event, data):
+        states.append(current_stats().state)
+        await dialog_state_middleware(AsyncMock(), event, data)
+        states.append(current_stats().state)
+
+    context = MagicMock(state=Registration.typing_nickname)
+    with caplog.at_level("WARNING", logger="bot.base.query_stats"):
+        await middleware(handler, None, {"aiogd_context": context})
+    assert states == [NO_STATE, Registration.typing_nickname.state]
+    assert caplog.text == ""
+
+
+#############################################
+# Метрики апдейтов и /metrics
+#############################################
+
+def _update(text):
+    from aiogram.types import Update
+    return Update.model_validate(_message_update(1, text))
+
+
+def test_update_metrics_labels():
+    from bot.base.update_metrics import command_name, update_type, NO_COMMAND, OTHER_COMMAND
+    from bot.handlers.default_commands import KNOWN_COMMANDS
+
+    known = frozenset(KNOWN_COMMANDS)
+    assert update_type(_update("hi")) == "message"
+    assert command_name(_update("/games@trg_bot 2"), known) == "games"
+    assert command_name(_update("/START"), known) == "start"
+    assert command_name(_update("/whatever"), known) == OTHER_COMMAND
+    assert command_name(_update("hello /games"), known) == NO_COMMAND
+
+
+@pytest.mark.asyncio
+async def test_update_metrics_middleware():
+    from bot.base.metrics import UPDATE_SECONDS, UPDATE_ERRORS, UPDATES_IN_FLIGHT
+    from bot.base.update_metrics import UpdateMetricsMiddleware, dialog_state_middleware
+    from bot.states.games_states import SearchingGame
+    from prometheus_client import REGISTRY
+
+    middleware = UpdateMetricsMiddleware(["/search"])
+    state = SearchingGame.checking_open_games.state
+    sample = lambda name, **labels: REGISTRY.get_sample_value(name, labels) or 0.0
+    count_labels = {"update_type": "message", "command": "search", "state": state}
+    before = sample("trg_update_seconds_count", **count_labels)
+    in_flight = []
+
+    async def handler(event, data):
+        in_flight.append(UPDATES_IN_FLIGHT.labels("message")._value.get())
+        await dialog_state_middleware(AsyncMock(), event, {"aiogd_context": MagicMock(state=SearchingGame.checking_open_games)})
+        return "ok"
+
+    idle = UPDATES_IN_FLIGHT.labels("message")._value.get()
+    assert await middleware(handler, _update("/search"), {}) == "ok"
+    assert in_flight == [idle + 1]
+    assert UPDATES_IN_FLIGHT.labels("message")._value.get() == idle
+    assert sample("trg_update_seconds_count", **count_labels) == before + 1
+
+    async def failing(event, data):
+        raise KeyError("boom")
+
+    errors = UPDATE_ERRORS.labels("message", "other", "-", "KeyError")
+    errors_before = errors._value.get()
+    with pytest.raises(KeyError):
+        await middleware(failing, _update("/unknown"), {})
+    assert errors._value.get() == errors_before + 1
+    assert UPDATES_IN_FLIGHT.labels("message")._value.get() == idle
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    from aiohttp.test_utils import TestClient, TestServer
+    from prometheus_client import CollectorRegistry, Counter
+    from bot.base.metrics_server import build_metrics_app
+
+    registry = CollectorRegistry()
+    Counter("trg_test_events", "Test counter", registry=registry).inc(3)
+    async with TestClient(TestServer(build_metrics_app(registry))) as client:
+        response = await client.get("/metrics")
+        assert response.status == 200
+        assert response.content_type == "text/plain"
+        assert "trg_test_events_total 3.0" in await response.text()
+
+
+def test_webhook_worker_index(monkeypatch):
+    import multiprocessing
+    from bot.base.webhook import worker_index
+
+    assert worker_index() == 0
+    monkeypatch.setattr(multiprocessing.current_process(), "name", "webhook-worker-2")
+    assert worker_index() == 2
+
+
+#############################################
+# Журнал медленных запросов
+#############################################
+
+def test_slow_query_redact():
+    from bot.base.slow_queries import redact
+
+    assert redact(("Иван", 12345, None, True, 1.5)) == ["<str>", "<int>", None, True, "<float>"]
+    assert redact({"name": "Иван", "ids": [1, 2]}) == {"name": "<str>", "ids": ["<int>", "<int>"]}
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log_records_and_explains(sqlite_session, tmp_path):
+    import json
+    from sqlalchemy import select, update
+    from bot.base.slow_queries import SlowQueryLog
+
+    session, _ = sqlite_session
+    path = tmp_path / "slow.jsonl"
+    log = SlowQueryLog(str(path), threshold=0.0, explain_rate=1.0)
+    log.attach(session.bind)
+    try:
+        titles = (await session.execute(
+            select(Session.title).where(Session.creator_id == 1).order_by(Session.id))).scalars().all()
+        # План снимается на отдельном курсоре — результат запроса не задет
+        assert titles == ["Game_0", "Game_1"]
+        await session.execute(update(User).where(User.telegram_id == 12345).values(city="Казань"))
+        await session.commit()
+    finally:
+        log.close()
+
+    records = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    select_record = next(r for r in records if r["statement"].lstrip().startswith("SELECT sessions.title"))
+    assert select_record["duration_ms"] >= 0 and select_record["parameters"] == ["<int>"]
+    assert select_record["plan"] and "explain_error" not in select_record
+    update_record = next(r for r in records if r["statement"].lstrip().startswith("UPDATE users"))
+    assert update_record["parameters"] == ["<str>", "<int>"]
+    assert "plan" not in update_record           # EXPLAIN не повторяет запись
+    assert "Казань" not in path.read_text(encoding="utf-8")
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log_failed_statement_leaves_no_timing_behind(sqlite_session, tmp_path):
+    import json
+    from sqlalchemy import select, text
+    from sqlalchemy.exc import OperationalError
+    from bot.base.slow_queries import SlowQueryLog
+
+    session, _ = sqlite_session
+    path = tmp_path / "slow.jsonl"
+    log = SlowQueryLog(str(path), threshold=0.0, explain_rate=0.0)
+    log.attach(session.bind)
+    try:
+        with pytest.raises(OperationalError):
+            await session.execute(text("SELECT * FROM no_such_table"))
+        await session.rollback()
+        await session.execute(select(User.id))
+        info = dict((await session.connection()).info)
+    finally:
+        log.close()
+
+    records = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [r["statement"].split()[0] for r in records] == ["SELECT"]
+    assert "no_such_table" not in records[0]["statement"]
+    assert not any("started" in key for key in info)
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log_threshold_and_rotation(sqlite_session, tmp_path):
+    from sqlalchemy import select
+    from bot.base.slow_queries import SlowQueryLog
+
+    session, _ = sqlite_session
+    fast = SlowQueryLog(str(tmp_path / "fast.jsonl"), threshold=60.0)
+    fast.attach(session.bind)
+    rotating = SlowQueryLog(str(tmp_path / "slow.jsonl"), threshold=0.0, explain_rate=0.0, max_bytes=300, backups=2)
+    rotating.attach(session.bind)
+    try:
+        for _ in range(10):
+            await session.execute(select(User.id))
+    finally:
+        fast.close()
+        rotating.close()
+    assert not (tmp_path / "fast.jsonl").exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["slow.jsonl", "slow.jsonl.1", "slow.jsonl.2"]
+
+
+#############################################
+# Базовая линия бенчмарков
+#############################################
+
+def _bench_run(median_ms, node="vm"):
+    return {
+        "machine_info": {"node": node, "system": "Linux", "release": "6", "machine": "x86_64",
+                         "python_implementation": "CPython", "python_version": "3.11", "cpu": {"count": 2}},
+        "commit_info": {"id": "abc", "branch": "main", "dirty": False},
+        "benchmarks": [{"name": "test_get_user_model", "stats": {"median": median_ms / 1000},
+                        "extra_info": {"scale": 1.0, "dialect": "sqlite"}}],
+    }
+
+
+def test_benchmark_baseline_check(tmp_path, capsys):
+    import json
+    from bot.benchmarks.baseline import main
+
+    run_path, baseline_path = tmp_path / "bench.json", tmp_path / "baseline.json"
+    run_path.write_text(json.dumps(_bench_run(1.0)), encoding="utf-8")
+    # Без базовой линии check не проходит, а подсказывает, как её сохранить
+    assert main("check", str(run_path), str(baseline_path), record=False) == 1
+    assert "baseline update" in capsys.readouterr().out
+
+    assert main("update", str(run_path), str(baseline_path), record=False) == 0
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+    assert baseline["machine"]["node"] == "vm" and baseline["machine"]["dialect"] == "sqlite"
+    assert len(baseline["history"]) == 1
+
+    run_path.write_text(json.dumps(_bench_run(1.5, node="laptop")), encoding="utf-8")
+    assert main("check", str(run_path), str(baseline_path), record=False) == 1
+    out = capsys.readouterr().out
+    assert "warning: baseline was recorded on" in out and "regression" in out
+
+
+#############################################
+# Нагрузочный прогон
+#############################################
+
+@pytest.mark.asyncio
+async def test_load_run_smoke(monkeypatch, tmp_path):
+    """Короткий прогон bot.benchmarks.load на SQLite через настоящий Dispatcher."""
+    pytest.importorskip("aiosqlite")
+    monkeypatch.setenv("BOT_TOKEN", "123456:LOAD")
+    from bot.base.config_reader import config
+    from bot.benchmarks.load import SCENARIOS, StubSession, seed, run
+
+    # Конфиг уже мог быть прочитан при импорте другими тестами — правится сам объект
+    dsn = f"sqlite+aiosqlite:///{tmp_path / 'load.db'}"
+    monkeypatch.setattr(config, "postgres_dsn", dsn)
+    monkeypatch.setattr(config, "fsm_storage", "memory")
+    monkeypatch.setattr(config, "metrics_port", 0)
+    from bot.base.__main__ import build_dispatcher
+
+    # Игр хватает на несколько страниц поиска; повторный засев ничего не дублирует
+    for _ in range(2):
+        await seed(dsn, users=2, games=60)
+    from sqlalchemy import func, select
+    from sqlalchemy.ext.asyncio import create_async_engine
+    engine = create_async_engine(dsn)
+    async with engine.connect() as conn:
+        assert await conn.scalar(select(func.count()).select_from(User)) == 2
+        assert await conn.scalar(select(func.count()).select_from(Session)) == 60
+    await engine.dispose()
+    api = StubSession()
+    stats = await run(build_dispatcher(), api, ["search", "games"], concurrency=2, rounds=2)
+
+    for name, flow in stats.items():
+        assert flow.flows == 2, name
+        assert not flow.errors, (name, flow.errors)
+        assert flow.updates == len(SCENARIOS[name]) * 2
+        assert len(flow.latencies) == flow.updates
+        assert 0 < flow.percentile(50) <= flow.percentile(95) <= flow.percentile(99) <= max(flow.latencies)
+    assert api.calls["SendMessage"] > 0 and api.calls["EditMessageText"] > 0
+
+
 def test_main():
     # Для локального запуска тестов
     pytest.main(["-v"])